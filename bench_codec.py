@@ -0,0 +1,70 @@
+"""Benchmark of the codecs on sensor readings, in messages/s."""
+
+import datetime
+import os
+import time
+
+from simpss_common.codec import WireFormat, available_codecs, get_codec
+
+
+def sample_reading(sensor_id=120):
+    """A reading as sent to Kafka by the producer."""
+    return {
+        'id': sensor_id,
+        'uptime': 123456,
+        'T': 2315,
+        'P': 101325,
+        'H': 4521,
+        'Ix': -235,
+        'Iy': 118,
+        'Iz': 983,
+        'M': 56,
+        'time_received': datetime.datetime.now().isoformat(),
+        'sensor_group': 'g1',
+    }
+
+
+def bench(codec, n_messages):
+    """
+    Time decoding and encoding of n_messages readings with codec.
+    Returns messages/s for loads, dumps and a loads + dumps round trip,
+    which is what the producer does for every message.
+    """
+    readings = [sample_reading(120 + i % 4) for i in range(n_messages)]
+    payloads = [codec.dumps(r) for r in readings]
+
+    start = time.perf_counter()
+    for payload in payloads:
+        codec.loads(payload)
+    loads_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for reading in readings:
+        codec.dumps(reading)
+    dumps_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for payload in payloads:
+        codec.dumps(codec.loads(payload))
+    round_trip_time = time.perf_counter() - start
+
+    return (n_messages / loads_time, n_messages / dumps_time,
+            n_messages / round_trip_time)
+
+
+if __name__ == "__main__":
+    n_messages = int(os.environ.get("BENCH_MESSAGES", 200000))
+
+    codecs = [get_codec(name) for name in available_codecs()[::-1]]
+    codecs.append(WireFormat(binary=True))
+
+    print("{:<16} {:>6} {:>14} {:>14} {:>14}".format(
+        'codec', 'bytes', 'loads msg/s', 'dumps msg/s', 'both msg/s'))
+    baseline = None
+    for codec in codecs:
+        loads_rate, dumps_rate, both_rate = bench(codec, n_messages)
+        if baseline is None:
+            baseline = both_rate
+        print("{:<16} {:>6} {:>14,.0f} {:>14,.0f} {:>14,.0f} ({:.2f}x)".format(
+            codec.name, len(codec.dumps(sample_reading())), loads_rate,
+            dumps_rate, both_rate, both_rate / baseline))
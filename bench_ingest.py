@@ -0,0 +1,341 @@
+"""
+Offline benchmark of the ingest hot paths, in items/s.
+
+No MQTT broker, Kafka or Cassandra is needed: every benchmark runs the
+code of the pipeline on synthetic readings. Results are written as JSON
+and, if a baseline file is given, compared with it: the script exits with
+status 1 if a benchmark is slower than the baseline by more than the
+allowed regression.
+
+Configuration through environment variables:
+- BENCH_ITEMS: readings per run (default 20000)
+- BENCH_REPEAT: runs per benchmark, the fastest one is kept (default 5)
+- BENCH_ONLY: comma separated names of the benchmarks to run (default all)
+- BENCH_OUTPUT: file for the results (default bench_results.json)
+- BENCH_BASELINE: results of a previous run to compare with (default none)
+- BENCH_MAX_REGRESSION: allowed throughput loss, 0.1 is 10% (default 0.1)
+"""
+
+import atexit
+import datetime
+import json
+import logging
+import os
+import platform
+import queue
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, Tuple
+
+from simpss.producers import MqttKafkaProducer
+from simpss_common.codec import WireFormat
+from simpss_persistence.data_mapping import compile_mapper, convert
+from simpss_persistence.kafka_consumer import KafkaConsumer
+from simpss_persistence.storage.cassandra_storage import _parse_timestamps
+import utils
+
+# mapping used by link_kafka_cassandra.py
+MAPPING = {
+    'sensor_group': 'sensor_group',
+    'id': 'sensor_id',
+    'time_received': 'time_received',
+    'uptime': 'uptime',
+    'T': 'temperature',
+    'P': 'pressure',
+    'H': 'humidity',
+    'Ix': 'ix',
+    'Iy': 'iy',
+    'Iz': 'iz',
+    'M': 'mask',
+}
+
+N_SENSORS = 100
+
+# name -> function building the benchmark for n items, returning the
+# function to time and the number of items it processes
+BENCHMARKS: Dict[str, Callable[[int], Tuple[Callable[[], None], int]]] = dict()
+
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+
+    return register
+
+
+def sample_reading(i, epoch_ms=False):
+    """The i-th synthetic reading, as sent to Kafka by the producer."""
+    if epoch_ms:
+        time_received = time.time_ns() // 1000000
+    else:
+        time_received = datetime.datetime.now().isoformat()
+    return {
+        'id': 120 + i % N_SENSORS,
+        'uptime': 123456 + i,
+        'T': 2315,
+        'P': 101325,
+        'H': 4521,
+        'Ix': -235,
+        'Iy': 118,
+        'Iz': 983,
+        'M': 56,
+        'time_received': time_received,
+        'sensor_group': 'g{}'.format(i % 4),
+    }
+
+
+def sensor_payload(i):
+    """The i-th synthetic payload, as published by a sensor."""
+    reading = sample_reading(i)
+    del reading['time_received']
+    del reading['sensor_group']
+    return json.dumps(reading).encode('utf-8')
+
+
+class _KafkaMessage(object):
+    """The parts of confluent_kafka.Message used by the consumer."""
+
+    def __init__(self, value):
+        self.__value = value
+
+    def value(self):
+        return self.__value
+
+    def headers(self):
+        return None
+
+    def timestamp(self):
+        return 0, 0
+
+
+class _MqttMessage(object):
+    """The parts of paho.mqtt.client.MQTTMessage used by the producer."""
+
+    def __init__(self, payload):
+        self.payload = payload
+
+
+@benchmark('convert')
+def bench_convert(n):
+    readings = [sample_reading(i) for i in range(n)]
+
+    def run():
+        for reading in readings:
+            convert(reading, MAPPING)
+
+    return run, n
+
+
+def _bench_decode(n, binary):
+    consumer = KafkaConsumer('localhost:9092', 'bench')
+    wire = WireFormat(binary=binary)
+    messages = [_KafkaMessage(wire.dumps(sample_reading(i))) for i in range(n)]
+    decode = consumer._KafkaConsumer__decode
+
+    def run():
+        for message in messages:
+            decode(message)
+
+    return run, n
+
+
+@benchmark('consumer_decode_json')
+def bench_decode_json(n):
+    return _bench_decode(n, binary=False)
+
+
+@benchmark('consumer_decode_binary')
+def bench_decode_binary(n):
+    return _bench_decode(n, binary=True)
+
+
+@benchmark('producer_on_mqtt_message')
+def bench_on_mqtt_message(n):
+    mqtt_config = {
+        'client-id': 'bench',
+        'address': 'localhost',
+        'port': 1883,
+        'transport': 'tcp',
+        'topic': 'simpss',
+        'qos': 0,
+        'max-inflight': 100,
+        'payload-key': 'id',
+    }
+    kafka_config = {
+        'bootstrap.servers': 'localhost:9092',
+        'group.id': 'bench',
+        'client.id': 'bench',
+    }
+    sensor_groups = {120 + i: 'g{}'.format(i % 4) for i in range(N_SENSORS)}
+    producer = MqttKafkaProducer(mqtt_config, kafka_config, sensor_groups)
+    # nothing is produced, silence the connection errors
+    logging.getLogger('bench-bench').setLevel(logging.CRITICAL)
+    # unbounded, the benchmark never drains it while running
+    producer.queue = queue.Queue()
+    messages = [_MqttMessage(sensor_payload(i)) for i in range(n)]
+    on_message = producer._on_mqtt_message
+    userdata = {'payload-key': mqtt_config['payload-key']}
+
+    def run():
+        for message in messages:
+            on_message(None, userdata, message)
+        # a rejected reading would time the error path instead
+        if producer._dead_letters.dead_letters:
+            raise RuntimeError("{} readings were dead-lettered".format(
+                producer._dead_letters.dead_letters))
+        with producer.queue.mutex:
+            producer.queue.queue.clear()
+
+    return run, n
+
+
+def _storage_mapper():
+    """The mapper built by CassandraStorage.set_name_mapping."""
+    return compile_mapper(
+        MAPPING, batch_converters={'time_received': _parse_timestamps})
+
+
+@benchmark('storage_map_row')
+def bench_map_row(n):
+    mapper = _storage_mapper()
+    readings = [sample_reading(i) for i in range(n)]
+
+    def run():
+        for reading in readings:
+            mapper(reading)
+
+    return run, n
+
+
+def _bench_map_batch(n, epoch_ms):
+    mapper = _storage_mapper()
+    readings = [sample_reading(i, epoch_ms) for i in range(n)]
+
+    def run():
+        mapper.map_batch(readings)
+
+    return run, n
+
+
+@benchmark('storage_map_batch')
+def bench_map_batch(n):
+    return _bench_map_batch(n, epoch_ms=False)
+
+
+@benchmark('storage_map_batch_epoch_ms')
+def bench_map_batch_epoch_ms(n):
+    return _bench_map_batch(n, epoch_ms=True)
+
+
+@benchmark('read_sensor_group_mapping')
+def bench_read_sensor_group_mapping(n):
+    with tempfile.NamedTemporaryFile('w', suffix='.csv',
+                                     delete=False) as f:
+        f.write('sensor_id,group_id\n')
+        for i in range(n):
+            f.write('{},g{}\n'.format(i, i % 4))
+    path = f.name
+    atexit.register(os.remove, path)
+
+    def run():
+        utils.read_sensor_group_mapping(path)
+
+    return run, n
+
+
+def run_benchmark(name, n_items, repeat):
+    """
+    Time a benchmark, keeping the fastest of repeat runs.
+
+    Returns
+    -------
+    Dict[str, float]
+        items processed per run, seconds of the fastest run, items/s
+    """
+    run, items = BENCHMARKS[name](n_items)
+    run()  # warm up caches and lazy imports
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return {
+        'items': items,
+        'best_seconds': best,
+        'items_per_second': items / best,
+    }
+
+
+def compare(results, baseline, max_regression):
+    """
+    Compare the results with a baseline.
+
+    Returns
+    -------
+    List[str]
+        names of the benchmarks slower than the baseline
+        by more than max_regression
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        ratio = result['items_per_second'] / reference['items_per_second']
+        print("{:<28} {:>14,.0f} items/s vs {:>14,.0f} ({:+.1%})".format(
+            name, result['items_per_second'], reference['items_per_second'],
+            ratio - 1.0))
+        if ratio < 1.0 - max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    n_items = int(os.environ.get("BENCH_ITEMS", 20000))
+    repeat = int(os.environ.get("BENCH_REPEAT", 5))
+    only = os.environ.get("BENCH_ONLY", None)
+    output = os.environ.get("BENCH_OUTPUT", 'bench_results.json')
+    baseline_path = os.environ.get("BENCH_BASELINE", None)
+    max_regression = float(os.environ.get("BENCH_MAX_REGRESSION", 0.1))
+
+    names = list(BENCHMARKS) if not only else only.split(',')
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        raise ValueError("Unknown benchmarks {}, available are {}".format(
+            unknown, list(BENCHMARKS)))
+
+    results = dict()
+    for name in names:
+        results[name] = run_benchmark(name, n_items, repeat)
+        print("{:<28} {:>14,.0f} items/s".format(
+            name, results[name]['items_per_second']))
+
+    with open(output, 'w') as f:
+        json.dump(
+            {
+                'created': datetime.datetime.now().isoformat(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'items': n_items,
+                'repeat': repeat,
+                'results': results,
+            },
+            f,
+            indent=2)
+    print("results written to {}".format(output))
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            baseline = json.load(f)['results']
+        print("comparing with {}".format(baseline_path))
+        regressions = compare(results, baseline, max_regression)
+        if regressions:
+            print("throughput regressed by more than {:.0%}: {}".format(
+                max_regression, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
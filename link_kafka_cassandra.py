@@ -8,8 +8,10 @@ import time
 from tqdm import tqdm
 
 import cassandra
+import confluent_kafka
 import simpss_persistence
 import utils
+from simpss_common import metrics
 
 LOGGER = simpss_persistence.custom_logging.get_logger('main')
 
@@ -28,67 +30,134 @@ def create_database(db_name, replication_factor,
     LOGGER.debug("query executed")
 
 
-def create_table(keyspace, name, session):
-    query = """
-    CREATE TABLE IF NOT EXISTS %s.%s (
-        time_received timestamp,
-        sensor_group text,
-        sensor_id int,
-        uptime int,
-        temperature int,
-        pressure int,
-        humidity int,
-        ix int,
-        iy int,
-        iz int,
-        mask int,
-        PRIMARY KEY (sensor_group, sensor_id, time_received)
-    )
-    """ % (keyspace, name)
+def create_table(keyspace, name, session, bucket_seconds=None, ttl=None):
+    query = simpss_persistence.storage.sensor_data_table(
+        keyspace, name, bucket_seconds, ttl)
     LOGGER.debug("Create table: executing query {}".format(query))
     session.execute(query)
     LOGGER.debug("query executed")
 
 
-def main():
-    LOGGER.info("reading sensor file")
-    sensor_groups = utils.read_sensor_group_mapping(
-        os.path.join(os.getcwd(), 'sensor_group.csv'))
-    LOGGER.info(f"configuration read: {str(sensor_groups)}")
-    unique_groups = set([x for _, x in sensor_groups.items()])
-    consumer_groups = [g for g in unique_groups]
+def table_config():
+    """
+    Name of the sensor data table, width of its time buckets and TTL in
+    seconds, None if it is not bucketed or has no TTL.
+    """
+    table = os.getenv('CASSANDRA_TABLE', 'sensor_data')
+    bucket_seconds = int(os.getenv('CASSANDRA_BUCKET_SECONDS', '0')) or None
+    ttl = int(os.getenv('CASSANDRA_TTL', '0')) or None
+    return table, bucket_seconds, ttl
+
+
+def count_partitions(bootstrap_servers, topics):
+    """Total number of partitions of the given Kafka topics."""
+    consumer = confluent_kafka.Consumer({
+        'bootstrap.servers': bootstrap_servers,
+        'group.id': 'partition-counter',
+    })
+    try:
+        metadata = consumer.list_topics(timeout=10)
+        return sum(
+            len(metadata.topics[t].partitions) for t in topics
+            if t in metadata.topics)
+    finally:
+        consumer.close()
 
+
+def run_consumer(worker_id, counter, consumer_groups):
+    """
+    Consume from Kafka and write to Cassandra.
+    Every worker process runs this function with its own cluster session.
+
+    Parameters
+    ----------
+    worker_id: int
+        id of the worker, used in the subscriber names
+
+    counter: multiprocessing.Value, optional
+        shared counter of the consumed messages, None if not in a pool
+
+    consumer_groups: List[str]
+        the Kafka topics to consume
+    """
     addresses = os.getenv('CASSANDRA_CLUSTER_ADDRESSES',
                           'localhost').split(';')
     keyspace = os.getenv('CASSANDRA_KEYSPACE', 'simpss')
-    replication_factor = str(os.getenv('CASSANDRA_REPLICATION', '3'))
+    table, bucket_seconds, _ = table_config()
+    async_writes = os.getenv('CASSANDRA_ASYNC_WRITES', '0') == '1'
+    max_in_flight = int(os.getenv('CASSANDRA_MAX_IN_FLIGHT', '128'))
+    batch_max_rows = int(os.getenv('CASSANDRA_BATCH_MAX_ROWS', '50'))
+    batch_max_bytes = int(os.getenv('CASSANDRA_BATCH_MAX_BYTES', '5120'))
 
-    LOGGER.info(f"cassandra addresses: {addresses}")
-    LOGGER.info(f"cassandra keyspace: {keyspace}")
-    LOGGER.info(f"cassandra replication factor: {replication_factor}")
+    # metrics endpoint, port 0 disables it. In a pool every worker
+    # serves its own metrics on the next port.
+    metrics_port = int(os.getenv('METRICS_PORT', '9109'))
+    metrics_address = os.getenv('METRICS_ADDRESS', 'localhost')
+    if metrics_port > 0:
+        metrics.start_http_server(metrics_port + worker_id,
+                                  address=metrics_address)
+        LOGGER.info(f"metrics on http://{metrics_address}:"
+                    f"{metrics_port + worker_id}/metrics")
 
-    cluster = cassandra.cluster.Cluster(addresses)
-    session = cluster.connect()
-    create_database(keyspace, replication_factor, session)
-    create_table(keyspace, 'sensor_data', session)
-    session.shutdown()
+    LOGGER.info(f"cassandra async writes: {async_writes}, "
+                f"max in flight: {max_in_flight}")
+    LOGGER.info(f"cassandra batch limits: {batch_max_rows} rows, "
+                f"{batch_max_bytes} bytes")
 
     cc_cluster = cassandra.cluster.Cluster(addresses)
-    cc = simpss_persistence.storage.CassandraStorage(cc_cluster)
+    cc = simpss_persistence.storage.CassandraStorage(
+        cc_cluster,
+        async_writes=async_writes,
+        max_in_flight=max_in_flight,
+        batch_max_rows=batch_max_rows,
+        batch_max_bytes=batch_max_bytes,
+        time_bucket_seconds=bucket_seconds)
 
     # KAFKA
     bootstrap_servers = str(
         os.environ.get('KAFKA_BOOTSTRAP_SERVERS', 'localhost:9092'))
     consumer_group_id = str(os.environ.get('KAFKA_CONSUMER_GROUP_ID', 'cg1'))
+    consume_batch_size = int(os.environ.get('KAFKA_CONSUME_BATCH_SIZE', 10))
+    consume_timeout = float(os.environ.get('KAFKA_CONSUME_TIMEOUT', 1.0))
+    consume_adaptive = os.environ.get('KAFKA_CONSUME_ADAPTIVE', '0') == '1'
+    consume_max_batch_size = int(
+        os.environ.get('KAFKA_CONSUME_MAX_BATCH_SIZE', 10000))
+    consume_latency_target = float(
+        os.environ.get('KAFKA_CONSUME_LATENCY_TARGET', 0.5))
+    manual_commit = os.environ.get('KAFKA_MANUAL_COMMIT', '0') == '1'
+    commit_interval = float(os.environ.get('KAFKA_COMMIT_INTERVAL', 5.0))
+    commit_every = int(os.environ.get('KAFKA_COMMIT_EVERY', 1000))
+    parallel_dispatch = os.environ.get('PARALLEL_DISPATCH', '0') == '1'
+    dispatch_queue_size = int(os.environ.get('DISPATCH_QUEUE_SIZE', 100))
+    dispatch_overflow = str(os.environ.get('DISPATCH_OVERFLOW', 'block'))
+    dispatch_spill_dir = os.environ.get('DISPATCH_SPILL_DIR', None)
+    trace = os.environ.get('TRACE_ENABLED', '0') == '1'
+    dead_letter_topic = os.environ.get('DEAD_LETTER_TOPIC', None)
+    dead_letter_batch_size = int(os.environ.get('DEAD_LETTER_BATCH_SIZE', 100))
+    # flow control, a high watermark of 0 disables it
+    high_watermark = int(os.environ.get('CONSUMER_HIGH_WATERMARK', 0)) or None
+    low_watermark = os.environ.get('CONSUMER_LOW_WATERMARK', None)
+    if low_watermark is not None:
+        low_watermark = int(low_watermark)
 
     LOGGER.info(f"kafka bootstrap servers: {bootstrap_servers}")
     LOGGER.info(f"kafka consumer group id: {consumer_group_id}")
+    LOGGER.info(f"kafka consume batch size: {consume_batch_size}, "
+                f"timeout: {consume_timeout}, adaptive: {consume_adaptive}")
+    LOGGER.info(f"kafka manual commit: {manual_commit}")
+    LOGGER.info(f"parallel dispatch: {parallel_dispatch}, "
+                f"queue size: {dispatch_queue_size}, "
+                f"overflow: {dispatch_overflow}")
+    LOGGER.info(f"tracing: {trace}")
+    LOGGER.info(f"dead letter topic: {dead_letter_topic}")
+    LOGGER.info(f"flow control watermarks: high {high_watermark}, "
+                f"low {low_watermark}")
 
     try:
         # setup Cassandra
         LOGGER.info("connecting to cassandra")
         cc.connect()
-        cc.set_keyspace_table(keyspace, 'sensor_data')
+        cc.set_keyspace_table(keyspace, table)
 
         mapping = {
             'sensor_group': 'sensor_group',
@@ -108,15 +177,41 @@ def main():
         # setup kafka consumer and subscribe to Kafka
         LOGGER.info("creating kafka consumer")
         kafka_consumer = simpss_persistence.kafka_consumer.KafkaConsumer(
-            bootstrap_servers, consumer_group_id)
+            bootstrap_servers,
+            consumer_group_id,
+            batch_size=consume_batch_size,
+            timeout=consume_timeout,
+            adaptive=consume_adaptive,
+            max_batch_size=consume_max_batch_size,
+            latency_target=consume_latency_target,
+            manual_commit=manual_commit,
+            commit_interval=commit_interval,
+            commit_every=commit_every,
+            parallel_dispatch=parallel_dispatch,
+            dispatch_queue_size=dispatch_queue_size,
+            overflow=dispatch_overflow,
+            spill_dir=dispatch_spill_dir,
+            trace=trace,
+            dead_letter_topic=dead_letter_topic,
+            dead_letter_batch_size=dead_letter_batch_size,
+            high_watermark=high_watermark,
+            low_watermark=low_watermark,
+            # readings the storage cannot map go to the dead letters
+            required_fields=list(mapping))
 
         LOGGER.info(f"subscribing consumer to groups: {consumer_groups}")
         kafka_consumer.kafka_subscribe(consumer_groups)
 
         # add Cassandra storage as a subscriber to the consumer and run it
-        cc.set_subscriber_name('sub-1')
+        cc.set_subscriber_name(f'sub-{worker_id + 1}')
         cc.subscribe(kafka_consumer)
 
+        if counter is not None:
+            counting = simpss_persistence.worker_pool.CountingSubscriber(
+                counter)
+            counting.set_subscriber_name(f'counter-{worker_id + 1}')
+            counting.subscribe(kafka_consumer)
+
         # start
         kafka_consumer.start_consuming()
     except Exception as e:
@@ -125,5 +220,55 @@ def main():
         cc.disconnect()
 
 
+def main():
+    LOGGER.info("reading sensor file")
+    sensor_groups = utils.read_sensor_group_mapping(
+        os.path.join(os.getcwd(), 'sensor_group.csv'))
+    LOGGER.info(f"configuration read: {str(sensor_groups)}")
+    unique_groups = set([x for _, x in sensor_groups.items()])
+    consumer_groups = [g for g in unique_groups]
+
+    addresses = os.getenv('CASSANDRA_CLUSTER_ADDRESSES',
+                          'localhost').split(';')
+    keyspace = os.getenv('CASSANDRA_KEYSPACE', 'simpss')
+    replication_factor = str(os.getenv('CASSANDRA_REPLICATION', '3'))
+
+    LOGGER.info(f"cassandra addresses: {addresses}")
+    LOGGER.info(f"cassandra keyspace: {keyspace}")
+    LOGGER.info(f"cassandra replication factor: {replication_factor}")
+    table, bucket_seconds, ttl = table_config()
+    LOGGER.info(f"cassandra table: {table}, time buckets: {bucket_seconds} "
+                f"seconds, ttl: {ttl}")
+
+    cluster = cassandra.cluster.Cluster(addresses)
+    session = cluster.connect()
+    create_database(keyspace, replication_factor, session)
+    create_table(keyspace, table, session, bucket_seconds, ttl)
+    # no driver threads must be running when the workers are forked
+    cluster.shutdown()
+
+    # number of consumer processes, 0 means one per topic partition
+    n_workers = int(os.environ.get('CONSUMER_WORKERS', 1))
+    if n_workers <= 0:
+        bootstrap_servers = str(
+            os.environ.get('KAFKA_BOOTSTRAP_SERVERS', 'localhost:9092'))
+        n_workers = max(1, count_partitions(bootstrap_servers,
+                                            consumer_groups))
+    LOGGER.info(f"consumer workers: {n_workers}")
+
+    if n_workers == 1:
+        run_consumer(0, None, consumer_groups)
+    else:
+        pool = simpss_persistence.worker_pool.WorkerPool(
+            run_consumer,
+            n_workers,
+            args=(consumer_groups, ),
+            restart_delay=float(
+                os.environ.get('CONSUMER_RESTART_DELAY', 5.0)),
+            report_every=float(os.environ.get('CONSUMER_REPORT_EVERY',
+                                              10.0)))
+        pool.run()
+
+
 if __name__ == "__main__":
     main()
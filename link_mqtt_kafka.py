@@ -3,9 +3,9 @@
 import os
 from typing import Dict
 
-import pandas as pd
-
-from simpss.producers import MqttKafkaProducer
+from simpss.producers import AsyncMqttKafkaProducer, MqttKafkaProducer
+from simpss_common import metrics
+from simpss_common.sensors import SensorRegistry
 import utils
 
 
@@ -20,6 +20,10 @@ def main():
     mqtt_topic = str(os.environ.get("MQTT_TOPIC", 'simpss'))
     mqtt_max_inflight = int(os.environ.get("MQTT_MAX_INFLIGHT", 100))
     mqtt_payload_key = str(os.environ.get("MQTT_PAYLOAD_KEY", 'id'))
+    mqtt_threaded = os.environ.get("MQTT_THREADED", '0') == '1'
+    mqtt_async = os.environ.get("MQTT_ASYNC", '0') == '1'
+    drain_batch_size = int(os.environ.get("DRAIN_BATCH_SIZE", 500))
+    drain_interval_ms = float(os.environ.get("DRAIN_INTERVAL_MS", 50))
     mqtt_config = {
         'client-id': client_id,
         'address': mqtt_address,
@@ -41,6 +45,17 @@ def main():
     kafka_max_inflight = int(os.environ.get("KAFKA_MAX_INFLIGHT", 100))
     kafka_linger_ms = int(os.environ.get("KAFKA_LINGER_MS", 1))
     kafka_group_id = str(os.environ.get("KAFKA_GROUP_ID", '1'))
+    kafka_wire_format = str(os.environ.get("KAFKA_WIRE_FORMAT", 'json'))
+    kafka_keyed = os.environ.get("KAFKA_KEYED", '1') == '1'
+    kafka_key_field = os.environ.get("KAFKA_KEY_FIELD", None)
+    trace_sample_rate = float(os.environ.get("TRACE_SAMPLE_RATE", 0.0))
+    timestamp_format = str(os.environ.get("TIMESTAMP_FORMAT", 'iso'))
+    spool_dir = os.environ.get("SPOOL_DIR", None)
+    spool_segment_mb = int(os.environ.get("SPOOL_SEGMENT_MB", 64))
+    spool_max_mb = int(os.environ.get("SPOOL_MAX_MB", 1024))
+    spool_fsync = str(os.environ.get("SPOOL_FSYNC", 'interval'))
+    dead_letter_topic = os.environ.get("DEAD_LETTER_TOPIC", None)
+    dead_letter_batch_size = int(os.environ.get("DEAD_LETTER_BATCH_SIZE", 100))
     kk_config = {
         'bootstrap.servers': bootstrap_servers,
         'session.timeout.ms': kafka_timeout_ms,
@@ -49,17 +64,75 @@ def main():
         'max.in.flight': kafka_max_inflight,
         'linger.ms': kafka_linger_ms,  # 0.001 seconds
     }
+    logger.info(f"kafka wire format: {kafka_wire_format}")
+    logger.info(f"kafka keyed: {kafka_keyed}, key field: {kafka_key_field}")
+    logger.info(f"trace sample rate: {trace_sample_rate}")
+    logger.info(f"timestamp format: {timestamp_format}")
+    logger.info(f"spool: {spool_dir}")
+    logger.info(f"dead letter topic: {dead_letter_topic}")
+
+    # metrics endpoint, port 0 disables it
+    metrics_port = int(os.environ.get("METRICS_PORT", 9108))
+    metrics_address = str(os.environ.get("METRICS_ADDRESS", 'localhost'))
+    if metrics_port > 0:
+        metrics.start_http_server(metrics_port, address=metrics_address)
+        logger.info(f"metrics on http://{metrics_address}:{metrics_port}"
+                    "/metrics")
 
     logger.info("reading sensor file")
-    sensor_groups = utils.read_sensor_group_mapping(
-        os.path.join(os.getcwd(), 'sensor_group.csv'))
-    logger.info(f"configuration read: {str(sensor_groups)}")
+    # the file is checked for changes every SENSOR_RELOAD_INTERVAL seconds
+    sensor_reload_interval = float(
+        os.environ.get("SENSOR_RELOAD_INTERVAL", 5.0))
+    sensor_groups = SensorRegistry(os.path.join(os.getcwd(),
+                                                'sensor_group.csv'),
+                                   reload_interval=sensor_reload_interval)
+    sensor_groups.start()
+    logger.info(f"configuration read: {len(sensor_groups)} sensors in "
+                f"groups {sorted(sensor_groups.groups())}")
+
+    if mqtt_async:
+        # one connection per broker, each subscribed to all the topics
+        mqtt_configs = [
+            dict(mqtt_config,
+                 address=address,
+                 topic=mqtt_topic.split(','),
+                 **{'client-id': f"{client_id}-{i}"})
+            for i, address in enumerate(mqtt_address.split(';'))
+        ]
+        logger.info(f"async bridge on {len(mqtt_configs)} brokers")
+        bridge = AsyncMqttKafkaProducer(
+            mqtt_configs,
+            kk_config,
+            sensor_groups,
+            wire_format=kafka_wire_format,
+            keyed=kafka_keyed,
+            key_field=kafka_key_field,
+            trace_sample_rate=trace_sample_rate,
+            dead_letter_topic=dead_letter_topic,
+            dead_letter_batch_size=dead_letter_batch_size,
+            timestamp_format=timestamp_format)
+        bridge.run()
+        return
 
     bonzo = MqttKafkaProducer(mqtt_config,
                               kk_config,
                               sensor_groups,
                               mqtt_timeout=1.0,
-                              kafka_timeout=0.3)
+                              kafka_timeout=0.3,
+                              wire_format=kafka_wire_format,
+                              threaded=mqtt_threaded,
+                              drain_batch_size=drain_batch_size,
+                              drain_interval=drain_interval_ms / 1000.0,
+                              keyed=kafka_keyed,
+                              key_field=kafka_key_field,
+                              trace_sample_rate=trace_sample_rate,
+                              dead_letter_topic=dead_letter_topic,
+                              dead_letter_batch_size=dead_letter_batch_size,
+                              timestamp_format=timestamp_format,
+                              spool_dir=spool_dir,
+                              spool_segment_bytes=spool_segment_mb * 2**20,
+                              spool_max_bytes=spool_max_mb * 2**20,
+                              spool_fsync=spool_fsync)
     bonzo.run()
 
 
@@ -0,0 +1,214 @@
+"""
+Copy the sensor data table into a table with time buckets.
+
+The token ring of the source table is split in ranges, copied in parallel
+by worker processes, each one with its own cluster session. Rows are
+written with CassandraStorage, grouped in batches per target partition.
+Writes are upserts, so the migration can run while the consumers already
+write to the target table (CASSANDRA_TABLE and CASSANDRA_BUCKET_SECONDS
+of link_kafka_cassandra.py), and a range copied twice gives the same
+result. Copied ranges are appended to a state file: an interrupted
+migration starts again from the ranges still missing.
+
+With a TTL, rows older than it are not copied. The others get the full
+TTL of the target table from the time they are copied.
+
+Configuration through environment variables:
+- CASSANDRA_CLUSTER_ADDRESSES: nodes of the cluster, separated by ';'
+  (default localhost)
+- CASSANDRA_KEYSPACE: keyspace of both tables (default simpss)
+- MIGRATE_SOURCE_TABLE: table to copy (default sensor_data)
+- MIGRATE_TARGET_TABLE: bucketed table, created if missing
+  (default sensor_data_bucketed)
+- CASSANDRA_BUCKET_SECONDS: width of the time buckets (default 86400)
+- CASSANDRA_TTL: seconds the rows are kept, 0 forever (default 0)
+- MIGRATE_WORKERS: worker processes (default 4)
+- MIGRATE_SPLITS: token ranges the ring is split in (default 256)
+- MIGRATE_FETCH_SIZE: rows per page read from the source (default 1000)
+- MIGRATE_STATE: file of the copied ranges (default migrate_state.txt)
+"""
+
+import multiprocessing as mp
+import os
+import time
+
+from tqdm import tqdm
+
+import cassandra
+import simpss_persistence
+from simpss_persistence.storage import to_epoch_ms
+
+LOGGER = simpss_persistence.custom_logging.get_logger('migrate')
+
+MIN_TOKEN = -2**63
+MAX_TOKEN = 2**63 - 1
+
+# rows written together by a worker
+WRITE_BATCH = 500
+
+# per worker process, set by _init_worker
+_worker = dict()
+
+
+def token_ranges(n_splits):
+    """
+    Split the Murmur3 token ring in n_splits ranges (start, end], start
+    excluded. MIN_TOKEN is never the token of a partition.
+    """
+    if n_splits < 1:
+        raise ValueError(
+            "n_splits should be at least 1, got {} instead".format(n_splits))
+    width = (MAX_TOKEN - MIN_TOKEN) // n_splits
+    bounds = [MIN_TOKEN + i * width for i in range(n_splits)] + [MAX_TOKEN]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_state(path):
+    """Indexes of the ranges already copied."""
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {int(line) for line in f if line.strip()}
+
+
+def _init_worker(config):
+    """Connect a worker process to the cluster."""
+    cluster = cassandra.cluster.Cluster(config['addresses'])
+    session = cluster.connect()
+    table = cluster.metadata.keyspaces[config['keyspace']].tables[
+        config['source']]
+    columns = list(table.columns)
+    partition_key = ', '.join(c.name for c in table.partition_key)
+    query = "SELECT %s FROM %s.%s WHERE token(%s) > ? AND token(%s) <= ?" % (
+        ', '.join(columns), config['keyspace'], config['source'],
+        partition_key, partition_key)
+    select = session.prepare(query)
+    select.fetch_size = config['fetch_size']
+
+    storage = simpss_persistence.storage.CassandraStorage(
+        cluster,
+        async_writes=True,
+        time_bucket_seconds=config['bucket_seconds'])
+    storage.session = session
+    storage.set_keyspace_table(config['keyspace'], config['target'])
+    storage.set_name_mapping({column: column for column in columns})
+
+    _worker.update(config,
+                   session=session,
+                   select=select,
+                   storage=storage)
+
+
+def copy_range(task):
+    """
+    Copy the rows of a token range.
+
+    Returns
+    -------
+    Tuple[int, int, int, List[str]]
+        index of the range, rows copied, rows skipped because expired,
+        errors of the failed reads and writes. A failed read, e.g. a read
+        timeout, fails the range instead of the whole migration.
+    """
+    index, (start, end) = task
+    session = _worker['session']
+    storage = _worker['storage']
+    ttl = _worker['ttl']
+    oldest = (time.time() - ttl) * 1000 if ttl else None
+
+    errors = []
+
+    def on_done(error=None):
+        if error is not None:
+            errors.append(str(error))
+
+    copied = 0
+    skipped = 0
+    rows = []
+    try:
+        for row in session.execute(_worker['select'], (start, end)):
+            row = row._asdict()
+            if oldest is not None and \
+                    to_epoch_ms(row['time_received']) < oldest:
+                skipped += 1
+                continue
+            rows.append(row)
+            if len(rows) >= WRITE_BATCH:
+                storage.insert_rows(rows, on_done=on_done)
+                copied += len(rows)
+                rows = []
+    except Exception as e:
+        # the range is copied again by the next run
+        errors.append('read failed: {}'.format(e))
+    if rows:
+        storage.insert_rows(rows, on_done=on_done)
+        copied += len(rows)
+    storage.flush()
+    return index, copied, skipped, errors
+
+
+def main():
+    addresses = os.getenv('CASSANDRA_CLUSTER_ADDRESSES',
+                          'localhost').split(';')
+    keyspace = os.getenv('CASSANDRA_KEYSPACE', 'simpss')
+    source = os.getenv('MIGRATE_SOURCE_TABLE', 'sensor_data')
+    target = os.getenv('MIGRATE_TARGET_TABLE', 'sensor_data_bucketed')
+    bucket_seconds = int(os.getenv('CASSANDRA_BUCKET_SECONDS', '86400'))
+    ttl = int(os.getenv('CASSANDRA_TTL', '0')) or None
+    n_workers = int(os.getenv('MIGRATE_WORKERS', '4'))
+    n_splits = int(os.getenv('MIGRATE_SPLITS', '256'))
+    fetch_size = int(os.getenv('MIGRATE_FETCH_SIZE', '1000'))
+    state_path = os.getenv('MIGRATE_STATE', 'migrate_state.txt')
+
+    LOGGER.info(f"copying {keyspace}.{source} to {keyspace}.{target}, "
+                f"buckets of {bucket_seconds} seconds, ttl {ttl}")
+
+    cluster = cassandra.cluster.Cluster(addresses)
+    session = cluster.connect()
+    session.execute(
+        simpss_persistence.storage.sensor_data_table(keyspace, target,
+                                                     bucket_seconds, ttl))
+    # no driver threads must be running when the workers are forked
+    cluster.shutdown()
+
+    done = read_state(state_path)
+    tasks = [(i, token_range)
+             for i, token_range in enumerate(token_ranges(n_splits))
+             if i not in done]
+    LOGGER.info(f"{len(tasks)} of {n_splits} token ranges to copy "
+                f"with {n_workers} workers")
+
+    config = {
+        'addresses': addresses,
+        'keyspace': keyspace,
+        'source': source,
+        'target': target,
+        'bucket_seconds': bucket_seconds,
+        'ttl': ttl,
+        'fetch_size': fetch_size,
+    }
+    total_copied = 0
+    total_skipped = 0
+    failed = 0
+    with mp.Pool(n_workers, initializer=_init_worker,
+                 initargs=(config, )) as pool, open(state_path, 'a') as state:
+        for index, copied, skipped, errors in tqdm(
+                pool.imap_unordered(copy_range, tasks), total=len(tasks)):
+            total_copied += copied
+            total_skipped += skipped
+            if errors:
+                failed += 1
+                LOGGER.error(f"range {index}: {len(errors)} errors, "
+                             f"first: {errors[0]}")
+                continue
+            state.write(f"{index}\n")
+            state.flush()
+
+    LOGGER.info(f"copied {total_copied} rows, skipped {total_skipped} "
+                f"expired rows, {failed} ranges failed")
+    if failed:
+        LOGGER.error("run the migration again to copy the failed ranges")
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,4 @@
 from .sensor import *
+from .fleet import (TokenBucket, iter_readings, read_sensor_ids, run_fleet,
+                    run_fleet_processes)
+from .load import LatencyHistogram, Stage, format_report, run_open_loop
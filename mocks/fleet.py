@@ -0,0 +1,314 @@
+"""Fleet of fake sensors publishing at a fixed aggregate rate."""
+
+import asyncio
+import csv
+import datetime
+import itertools
+import logging
+import multiprocessing as mp
+import random
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import paho.mqtt.client as mq
+
+from simpss_common.codec import get_codec
+
+NAME = "Fleet"
+logger = logging.getLogger(name=NAME)
+handler = logging.StreamHandler()
+formatter = logging.Formatter(
+    '%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.INFO)
+
+
+class TokenBucket(object):
+    """
+    Token bucket limiting the rate of an operation.
+
+    Tokens are added at rate per second, up to capacity. Taking a token
+    when the bucket is empty puts it in debt and the caller waits for its
+    turn, so many callers sharing a bucket are served one after the other
+    at exactly rate per second. Late wake-ups are compensated by the
+    following calls, so the long-run rate does not drift.
+    """
+
+    def __init__(self, rate, capacity=1.0, clock=time.monotonic):
+        """
+        Parameters
+        ----------
+        rate: float
+            tokens per second
+
+        capacity: float
+            maximum number of tokens, i.e. the largest burst after a pause
+
+        clock: callable
+            source of the time in seconds
+        """
+        if rate <= 0.0 or capacity <= 0.0:
+            raise ValueError(
+                "rate and capacity should be positive, got {} and {} instead".
+                format(rate, capacity))
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.__clock = clock
+        self.__tokens = 0.0
+        self.__last = clock()
+
+    def reserve(self, tokens=1) -> float:
+        """
+        Take tokens from the bucket.
+
+        Returns
+        -------
+        float
+            seconds to wait before using them
+        """
+        now = self.__clock()
+        self.__tokens = min(self.capacity,
+                            self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+        self.__tokens -= tokens
+        if self.__tokens >= 0.0:
+            return 0.0
+        return -self.__tokens / self.rate
+
+    async def acquire(self, tokens=1):
+        """Wait until tokens are available and take them."""
+        wait = self.reserve(tokens)
+        if wait > 0.0:
+            await asyncio.sleep(wait)
+
+
+def read_sensor_ids(file_path) -> List[int]:
+    """Sensor ids of a sensor_group.csv file."""
+    with open(file_path, newline='') as f:
+        return [int(row['sensor_id']) for row in csv.DictReader(f)]
+
+
+def iter_readings(data_path: Optional[str] = None,
+                  loop=True) -> Iterator[Dict[str, Any]]:
+    """
+    Readings to publish, one dict at a time.
+
+    Parameters
+    ----------
+    data_path: str, optional
+        file with a JSON reading per line, read lazily. If None, synthetic
+        readings are generated.
+
+    loop: bool
+        if True, start again from the beginning of the file at its end
+    """
+    if data_path is None:
+        yield from _synthetic_readings()
+        return
+
+    codec = get_codec()
+    with open(data_path, 'rb') as f:
+        while True:
+            found = False
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    reading = codec.loads(line)
+                except ValueError:
+                    logger.warning("Skipping invalid line {}".format(line))
+                    continue
+                found = True
+                yield reading
+            if not loop or not found:
+                return
+            f.seek(0)
+
+
+def _synthetic_readings():
+    for uptime in itertools.count():
+        yield {
+            'id': 0,
+            'uptime': uptime,
+            'T': random.randint(1500, 3000),
+            'P': random.randint(95000, 105000),
+            'H': random.randint(2000, 8000),
+            'Ix': random.randint(-1000, 1000),
+            'Iy': random.randint(-1000, 1000),
+            'Iz': random.randint(-1000, 1000),
+            'M': random.randint(0, 255),
+        }
+
+
+def run_fleet(sensor_ids: List[int],
+              rate: float,
+              address='localhost',
+              port=1883,
+              topic='simpss',
+              qos=0,
+              n_clients=1,
+              data_path=None,
+              loop=True,
+              duration=None,
+              report_every=10.0,
+              client_prefix='fleet'):
+    """
+    Run a virtual sensor for each id, publishing readings to the MQTT
+    broker at rate messages per second in total.
+
+    Every virtual sensor is a coroutine publishing the next reading of the
+    input with its own id, the sensors share a token bucket holding the
+    aggregate rate and n_clients MQTT connections.
+
+    Parameters
+    ----------
+    sensor_ids: List[int]
+        ids of the virtual sensors, should be known to the producer,
+        see read_sensor_ids
+
+    rate: float
+        aggregate messages per second
+
+    address, port: str, int
+        MQTT broker
+
+    topic: str
+        MQTT topic to publish to
+
+    qos: int
+        MQTT QoS of the messages
+
+    n_clients: int
+        number of MQTT connections, the sensors are spread over them
+
+    data_path: str, optional
+        file with a JSON reading per line, see iter_readings
+
+    loop: bool
+        if True, replay the data file when it ends
+
+    duration: float, optional
+        seconds to run for, forever if None
+
+    report_every: float
+        seconds between two reports of the achieved rate
+
+    client_prefix: str
+        prefix of the MQTT client ids
+
+    Returns
+    -------
+    int
+        number of messages published
+    """
+    if not sensor_ids:
+        raise ValueError("sensor_ids should not be empty")
+    if n_clients < 1:
+        raise ValueError(
+            "n_clients should be at least 1, got {} instead".format(n_clients))
+
+    try:
+        return asyncio.run(
+            _fleet(sensor_ids, rate, address, port, topic, qos, n_clients,
+                   data_path, loop, duration, report_every, client_prefix))
+    except KeyboardInterrupt:
+        logger.info("Fleet stopped")
+        return 0
+
+
+def run_fleet_processes(sensor_ids: List[int], rate: float, processes,
+                        **kwargs):
+    """
+    Split the sensors and the rate among processes, each one running
+    run_fleet with its own MQTT connections. Useful when a single
+    process cannot encode and publish fast enough.
+
+    Other keyword arguments are passed to run_fleet.
+    """
+    if processes < 1:
+        raise ValueError(
+            "processes should be at least 1, got {} instead".format(processes))
+    processes = min(processes, len(sensor_ids))
+    prefix = kwargs.pop('client_prefix', 'fleet')
+
+    workers = []
+    for i in range(processes):
+        worker_kwargs = dict(kwargs, client_prefix='{}-p{}'.format(prefix, i))
+        worker = mp.Process(target=run_fleet,
+                            args=(sensor_ids[i::processes], rate / processes),
+                            kwargs=worker_kwargs,
+                            name='fleet-{}'.format(i))
+        worker.start()
+        workers.append(worker)
+
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # the workers got the interrupt as well
+        for worker in workers:
+            worker.join()
+
+
+async def _fleet(sensor_ids, rate, address, port, topic, qos, n_clients,
+                 data_path, loop, duration, report_every, client_prefix):
+    clients = []
+    for i in range(n_clients):
+        client_id = '{}-{}'.format(client_prefix, i)
+        client = mq.Client(client_id=client_id, clean_session=True)
+        client.max_inflight_messages_set(1000)
+        client.connect(address, port=port, keepalive=60)
+        client.loop_start()
+        clients.append(client)
+    logger.info("Connected {} clients to {}:{}".format(n_clients, address,
+                                                       port))
+
+    bucket = TokenBucket(rate)
+    readings = iter_readings(data_path, loop)
+    codec = get_codec()
+    sent = [0]
+
+    async def sensor(sensor_id, client):
+        while True:
+            await bucket.acquire()
+            reading = next(readings, None)
+            if reading is None:
+                return
+            reading['id'] = sensor_id
+            client.publish(topic, codec.dumps(reading), qos=qos)
+            sent[0] += 1
+
+    async def report():
+        start = last = time.monotonic()
+        last_sent = 0
+        while True:
+            await asyncio.sleep(report_every)
+            now = time.monotonic()
+            logger.info("{} sensors: {} messages, {:.1f} msg/s "
+                        "({:.1f} msg/s overall)".format(
+                            len(sensor_ids), sent[0],
+                            (sent[0] - last_sent) / (now - last),
+                            sent[0] / (now - start)))
+            last, last_sent = now, sent[0]
+
+    logger.info("Starting {} sensors at {} msg/s, started at {}".format(
+        len(sensor_ids), rate,
+        datetime.datetime.now().isoformat()))
+    tasks = [
+        asyncio.ensure_future(sensor(sensor_id, client))
+        for sensor_id, client in zip(sensor_ids, itertools.cycle(clients))
+    ]
+    reporter = asyncio.ensure_future(report())
+    try:
+        await asyncio.wait(tasks, timeout=duration)
+    finally:
+        for task in tasks + [reporter]:
+            task.cancel()
+        for client in clients:
+            client.disconnect()
+            client.loop_stop()
+        logger.info("Published {} messages".format(sent[0]))
+
+    return sent[0]
@@ -0,0 +1,248 @@
+"""
+Open-loop load generation.
+
+Messages are sent at the times of a fixed schedule, whether or not the
+previous ones have completed, and the latency of each message is measured
+from the time it was scheduled to be sent. A closed-loop generator waits
+for every message before sending the next, so when the system stalls it
+stops sending and the stall shows up as one slow message instead of many
+(coordinated omission): here the messages that should have been sent
+during a stall are late, and their latency says so.
+"""
+
+import itertools
+import math
+import threading
+import time
+from typing import Dict, List
+
+PERCENTILES = (50.0, 90.0, 99.0, 99.9, 99.99)
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of latencies with a bounded relative error, in the style of
+    HdrHistogram: bucket bounds grow geometrically, so every recorded value
+    is known within significant_digits digits whatever its magnitude, with
+    a small fixed memory footprint.
+    """
+
+    def __init__(self, lowest=1e-6, highest=3600.0, significant_digits=2):
+        """
+        Parameters
+        ----------
+        lowest, highest: float
+            range of the values in seconds, values outside are clamped
+
+        significant_digits: int
+            precision of the recorded values
+        """
+        if not 0.0 < lowest < highest:
+            raise ValueError(
+                "Range should satisfy 0 < lowest < highest, got {} and {}".
+                format(lowest, highest))
+        if not 1 <= significant_digits <= 5:
+            raise ValueError(
+                "significant_digits should be between 1 and 5, got {}".format(
+                    significant_digits))
+
+        self.lowest = lowest
+        self.highest = highest
+        self.__log_growth = math.log1p(10.0**-significant_digits)
+        n_buckets = int(math.log(highest / lowest) / self.__log_growth) + 2
+        self.__counts = [0] * n_buckets
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def record(self, value):
+        """Record a latency in seconds."""
+        value = min(max(value, 0.0), self.highest)
+        self.__counts[self.__index(value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: 'LatencyHistogram'):
+        """Add the values of another histogram with the same layout."""
+        if len(other.__counts) != len(self.__counts):
+            raise ValueError("Histograms have different layouts")
+        for i, count in enumerate(other.__counts):
+            self.__counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percentile) -> float:
+        """
+        Value below which percentile% of the recorded values fall,
+        i.e. the upper bound of the bucket holding that rank.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = max(1, math.ceil(percentile / 100.0 * self.count))
+        seen = 0
+        for i, count in enumerate(self.__counts):
+            seen += count
+            if seen >= rank:
+                return min(self.__upper_bound(i), self.max)
+        return self.max
+
+    def percentiles(self, percentiles=PERCENTILES) -> Dict[float, float]:
+        return {p: self.percentile(p) for p in percentiles}
+
+    def __index(self, value):
+        if value <= self.lowest:
+            return 0
+        return 1 + int(math.log(value / self.lowest) / self.__log_growth)
+
+    def __upper_bound(self, index):
+        return self.lowest * math.exp(index * self.__log_growth)
+
+
+class Stage(object):
+    """
+    A part of the pipeline under load, e.g. the MQTT broker.
+
+    Subclasses implement send, which must start sending a message without
+    waiting for it: call begin when sending and end when it completes,
+    from any thread.
+    """
+
+    def __init__(self, name, clock=time.monotonic):
+        self.name = name
+        self.clock = clock
+        self.__lock = threading.Lock()
+        self.__tokens = itertools.count()
+        self.reset()
+
+    def reset(self):
+        """Forget the recorded latencies."""
+        with self.__lock:
+            self.histogram = LatencyHistogram()
+            self.__pending: Dict[int, float] = dict()
+            self.completed = 0
+            self.errors = 0
+            self.timeouts = 0
+
+    def send(self, intended: float):
+        """Send a message that was scheduled at time intended."""
+        raise NotImplementedError()
+
+    def close(self):
+        """Release the connections of the stage."""
+
+    def begin(self, intended: float) -> int:
+        """Register a message being sent, returns its token for end."""
+        token = next(self.__tokens)
+        with self.__lock:
+            self.__pending[token] = intended
+        return token
+
+    def end(self, token, error=None, now=None):
+        """Record the completion of a message, optionally failed."""
+        if now is None:
+            now = self.clock()
+        with self.__lock:
+            intended = self.__pending.pop(token, None)
+            if intended is None:
+                # already counted as a timeout
+                return
+            self.histogram.record(now - intended)
+            if error is None:
+                self.completed += 1
+            else:
+                self.errors += 1
+
+    @property
+    def pending(self):
+        return len(self.__pending)
+
+    def drain(self, timeout):
+        """
+        Wait up to timeout seconds for the messages in flight. The ones
+        still pending are recorded as timeouts with their latency so far,
+        so that they are not left out of the percentiles.
+        """
+        deadline = self.clock() + timeout
+        while self.__pending and self.clock() < deadline:
+            time.sleep(0.01)
+
+        now = self.clock()
+        with self.__lock:
+            for intended in self.__pending.values():
+                self.histogram.record(now - intended)
+                self.timeouts += 1
+            self.__pending.clear()
+
+
+def run_open_loop(stage: Stage,
+                  rate: float,
+                  duration: float,
+                  drain_timeout=10.0,
+                  sleep=time.sleep) -> Dict:
+    """
+    Send messages to stage at rate per second for duration seconds,
+    following a fixed schedule, then wait for the ones in flight.
+
+    Returns
+    -------
+    Dict
+        stage name, offered and achieved rate, counts of completed,
+        failed and timed out messages, and the latency percentiles
+    """
+    if rate <= 0.0 or duration <= 0.0:
+        raise ValueError(
+            "rate and duration should be positive, got {} and {} instead".
+            format(rate, duration))
+
+    stage.reset()
+    n_messages = max(1, int(rate * duration))
+    start = stage.clock()
+    for i in range(n_messages):
+        intended = start + i / rate
+        delay = intended - stage.clock()
+        if delay > 0.0:
+            sleep(delay)
+        stage.send(intended)
+    send_time = stage.clock() - start
+    stage.drain(drain_timeout)
+
+    histogram = stage.histogram
+    return {
+        'stage': stage.name,
+        'rate': rate,
+        'achieved_rate': n_messages / send_time if send_time > 0 else 0.0,
+        'sent': n_messages,
+        'completed': stage.completed,
+        'errors': stage.errors,
+        'timeouts': stage.timeouts,
+        'mean': histogram.mean,
+        'max': histogram.max,
+        'percentiles': histogram.percentiles(),
+    }
+
+
+def format_report(results: List[Dict], percentiles=(50.0, 99.0, 99.9)) -> str:
+    """Table of the results of run_open_loop, latencies in milliseconds."""
+    header = "{:<10} {:>9} {:>9} {:>8} {:>6} {:>6}".format(
+        'stage', 'rate', 'achieved', 'done', 'err', 'tmout')
+    header += ''.join(' {:>9}'.format('p{:g}'.format(p)) for p in percentiles)
+    header += ' {:>9}'.format('max')
+    lines = [header]
+    for r in results:
+        line = "{:<10} {:>9,.0f} {:>9,.0f} {:>8} {:>6} {:>6}".format(
+            r['stage'], r['rate'], r['achieved_rate'], r['completed'],
+            r['errors'], r['timeouts'])
+        line += ''.join(' {:>9.2f}'.format(r['percentiles'][p] * 1000.0)
+                        for p in percentiles)
+        line += ' {:>9.2f}'.format(r['max'] * 1000.0)
+        lines.append(line)
+    return '\n'.join(lines)
@@ -1 +1,2 @@
+from .async_mqtt_kafka_producer import AsyncMqttKafkaProducer
 from .mqtt_kafka_producer import MqttKafkaProducer
@@ -0,0 +1,365 @@
+"""File for the asyncio MQTT KAFKA producer class."""
+
+import asyncio
+import collections
+import functools
+import time
+from typing import Any, Dict, List, Union
+
+import paho.mqtt.client as mq
+
+from simpss_common import metrics
+from simpss_common.sensors import SensorRegistry
+
+from .base_producer import BaseMqttKafkaProducer, check_mqtt_config
+
+
+class AsyncMqttKafkaProducer(BaseMqttKafkaProducer):
+    """
+    MQTT Kafka producer running on an asyncio event loop.
+
+    The sockets of the MQTT clients are watched by the event loop, which
+    also polls the Kafka producer, so a single thread serves any number of
+    MQTT connections, to one or more brokers, and readings are produced
+    to Kafka as soon as they are received, without a queue in between.
+    """
+
+    def __init__(self,
+                 mqtt_configs: List[Dict[str, Any]],
+                 kafka_config: Dict[str, Any],
+                 sensor_groups: Union[Dict[int, str], SensorRegistry],
+                 poll_interval=0.05,
+                 max_backlog=10000,
+                 reconnect_delay=1.0,
+                 codec=None,
+                 wire_format='json',
+                 keyed=True,
+                 key_field=None,
+                 partitioner=None,
+                 trace_sample_rate=0.0,
+                 dead_letter_topic=None,
+                 dead_letter_batch_size=100,
+                 timestamp_format='iso'):
+        """
+        Create the MQTT clients and the Kafka producer.
+
+        Parameters
+        ----------
+        mqtt_configs: List[Dict[str, Any]]
+            one configuration per MQTT connection, with the keys required by
+            MqttKafkaProducer. topic can also be a list of topics, all
+            subscribed on the same connection. The payload-key of the first
+            configuration is the default key_field.
+
+        kafka_config: Dict[str, Any]
+            configuration of the Kafka producer
+
+        sensor_groups: Dict[int, str] or SensorRegistry
+            Kafka topic of each sensor id
+
+        poll_interval: float
+            seconds between two polls of the Kafka producer for delivery
+            reports
+
+        max_backlog: int
+            readings and dead letters kept while the local Kafka producer
+            queue is full.
+            When the backlog reaches max_backlog the MQTT sockets are not
+            read until it is empty, so the brokers hold the messages.
+
+        reconnect_delay: float
+            seconds to wait before reconnecting a lost MQTT connection
+
+        The other parameters are the same as MqttKafkaProducer.
+        """
+        if not mqtt_configs:
+            raise ValueError("mqtt_configs should not be empty")
+        if poll_interval <= 0.0 or reconnect_delay <= 0.0:
+            raise ValueError(
+                "poll_interval and reconnect_delay should be positive, "
+                "got {} and {} instead".format(poll_interval, reconnect_delay))
+        if max_backlog < 1:
+            raise ValueError("max_backlog should be at least 1, "
+                             "got {} instead".format(max_backlog))
+        for mqtt_config in mqtt_configs:
+            check_mqtt_config(mqtt_config)
+
+        self._poll_interval = poll_interval
+        self._max_backlog = max_backlog
+        self._reconnect_delay = reconnect_delay
+        self.__loop = None
+        self.__stopped = None
+        self.__paused = False
+        self.__sockets: Dict[mq.Client, Any] = dict()
+        self.__userdata: Dict[mq.Client, Dict[str, Any]] = dict()
+        # sends of readings and dead letters waiting for room in the local
+        # Kafka producer queue, each returns False while there is none
+        self.backlog: collections.deque = collections.deque()
+
+        super().__init__(kafka_config,
+                         sensor_groups,
+                         key_field or mqtt_configs[0]['payload-key'],
+                         codec=codec,
+                         wire_format=wire_format,
+                         keyed=keyed,
+                         partitioner=partitioner,
+                         trace_sample_rate=trace_sample_rate,
+                         dead_letter_topic=dead_letter_topic,
+                         dead_letter_batch_size=dead_letter_batch_size,
+                         timestamp_format=timestamp_format)
+        self.__clients = [self.__setup_mqtt(c) for c in mqtt_configs]
+        self.__setup_metrics()
+        self._logger.info("Finished configuration for mqtt and Kafka")
+
+    def __setup_metrics(self):
+        metrics.gauge('simpss_producer_queue_depth',
+                      'Messages waiting in the producer queue').set_function(
+                          lambda: len(self.backlog))
+
+    def __setup_mqtt(self, mqtt_config: Dict[str, Any]) -> mq.Client:
+        topics = mqtt_config['topic']
+        if isinstance(topics, str):
+            topics = [topics]
+        qos = int(mqtt_config['qos'])
+        client_id = str(mqtt_config['client-id'])
+
+        client = mq.Client(client_id=client_id,
+                           clean_session=True,
+                           transport=str(mqtt_config['transport']))
+        client.max_inflight_messages_set(int(mqtt_config['max-inflight']))
+        userdata = {
+            'address': str(mqtt_config['address']),
+            'port': int(mqtt_config['port']),
+            'topics': [(str(topic), qos) for topic in topics],
+            'payload-key': mqtt_config['payload-key'],
+        }
+        client.user_data_set(userdata)
+        self.__userdata[client] = userdata
+        client.on_connect = self._on_mqtt_connect
+        client.on_disconnect = self._on_mqtt_disconnect
+        client.on_message = self._on_mqtt_message
+        client.on_log = self._on_log
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+        self._logger.info("Created mqtt client with id: " + client_id)
+        return client
+
+    def run(self):
+        """
+        Run the clients on a new event loop until interrupted.
+        """
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            self._logger.info("Stopped mqtt and Kafka clients")
+
+    async def serve(self):
+        """
+        Connect the MQTT clients and forward their messages to Kafka
+        until stop is called or the task is cancelled, then flush the
+        Kafka producer.
+        """
+        self.__loop = asyncio.get_event_loop()
+        self.__stopped = asyncio.Event()
+
+        for client in self.__clients:
+            self.__connect(client)
+        tasks = [asyncio.ensure_future(self.__poll_kafka())]
+        tasks += [
+            asyncio.ensure_future(self.__misc(client))
+            for client in self.__clients
+        ]
+
+        try:
+            await self.__stopped.wait()
+        finally:
+            self._logger.info("Stopping mqtt and Kafka clients")
+            for client in self.__clients:
+                client.disconnect()
+            for task in tasks:
+                task.cancel()
+            self._dead_letters.flush()
+            self.__drain_backlog(5.0)
+            self._logger.info(
+                "Awaiting 5 seconds to flush the Kafka producer")
+            self._kf_producer.flush(5)
+            self._logger.info("Kafka client flushed")
+
+    def stop(self):
+        """Make serve return, from the thread running the event loop."""
+        if self.__stopped is not None:
+            self.__stopped.set()
+
+    def metrics(self):
+        """
+        Number of readings and dead letters waiting for room in the Kafka
+        producer queue,
+        whether the MQTT sockets are paused because of them, and the
+        number of waits for a full Kafka producer queue.
+        """
+        return {
+            'backlog': len(self.backlog),
+            'paused': self.__paused,
+            'buffer_full_waits': self.buffer_full_waits,
+        }
+
+    def __connect(self, client: mq.Client):
+        """
+        Connect a client, the socket is added to the event loop by
+        _on_socket_open. Blocks the loop until the TCP connection is up.
+        """
+        userdata = self.__userdata[client]
+        try:
+            client.connect(userdata['address'],
+                           port=userdata['port'],
+                           keepalive=60)
+        except OSError as e:
+            self._logger.warning("Cannot connect to {}:{}: {}".format(
+                userdata['address'], userdata['port'], e))
+
+    async def __misc(self, client: mq.Client):
+        """
+        Run the periodic work of a client, i.e. keepalive and retries,
+        and reconnect it when the connection is lost.
+        """
+        while True:
+            if client.loop_misc() == mq.MQTT_ERR_NO_CONN:
+                await asyncio.sleep(self._reconnect_delay)
+                self.__connect(client)
+                continue
+            await asyncio.sleep(1.0)
+
+    async def __poll_kafka(self):
+        """
+        Serve the Kafka delivery reports, retry the backlog and flush the
+        dead letters.
+        """
+        while True:
+            self._kf_producer.poll(0)
+            self.__flush_backlog()
+            self._dead_letters.maybe_flush()
+            await asyncio.sleep(self._poll_interval)
+
+    def __flush_backlog(self):
+        """
+        Produce the backlog, in order, while there is room, resuming
+        the MQTT sockets when it is empty.
+        """
+        while self.backlog:
+            if not self.backlog[0]():
+                return
+            self.backlog.popleft()
+        self.__pause(False)
+
+    def __drain_backlog(self, timeout):
+        """
+        Wait up to timeout seconds for the Kafka producer to take the
+        backlog, on shutdown.
+        """
+        deadline = time.monotonic() + timeout
+        self.__flush_backlog()
+        while self.backlog and time.monotonic() < deadline:
+            self._kf_producer.poll(self._poll_interval)
+            self.__flush_backlog()
+        if self.backlog:
+            self._logger.warning(
+                "Kafka producer queue still full, {} messages lost".format(
+                    len(self.backlog)))
+
+    def __keep(self, send):
+        """
+        Append a send that found the Kafka producer queue full to the
+        backlog, pausing the MQTT sockets when the backlog is full.
+        """
+        self.backlog.append(send)
+        if len(self.backlog) >= self._max_backlog:
+            self.__pause(True)
+
+    def __pause(self, paused):
+        """Stop or start reading from the MQTT sockets."""
+        if paused == self.__paused:
+            return
+        self.__paused = paused
+        for client, sock in self.__sockets.items():
+            if paused:
+                self.__loop.remove_reader(sock)
+            else:
+                self.__loop.add_reader(sock, client.loop_read)
+        self._logger.info("MQTT sockets {}".format(
+            'paused, Kafka producer queue full' if paused else 'resumed'))
+
+    def __produce_dict(self, message_dict, traced_at=None) -> bool:
+        """
+        Send a reading to Kafka, see BaseMqttKafkaProducer._message.
+
+        Returns
+        -------
+        bool
+            False if the local Kafka producer queue is full
+        """
+        topic, value, kwargs = self._message(message_dict, traced_at)
+        return self.__produce(topic, value, kwargs)
+
+    def __produce(self, topic, message, kwargs) -> bool:
+        try:
+            self._kf_producer.produce(topic, message, **kwargs)
+            return True
+        except BufferError:
+            self.buffer_full_waits += 1
+            self._m_buffer_full.inc()
+            # serve the delivery reports already there and try once more
+            self._kf_producer.poll(0)
+        try:
+            self._kf_producer.produce(topic, message, **kwargs)
+            return True
+        except BufferError:
+            return False
+
+    def _on_socket_open(self, client, userdata, sock):
+        self.__sockets[client] = sock
+        if not self.__paused:
+            self.__loop.add_reader(sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self.__sockets.pop(client, None)
+        self.__loop.remove_reader(sock)
+        self.__loop.remove_writer(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self.__loop.add_writer(sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self.__loop.remove_writer(sock)
+
+    def _on_mqtt_connect(self, client: mq.Client, userdata, flags, rc):
+        """
+        Subscribe to the topics of the client on connection.
+        """
+        if rc == 0:
+            self._logger.info("Connected to {}:{}, subscribing to {}".format(
+                userdata['address'], userdata['port'], userdata['topics']))
+            client.subscribe(userdata['topics'])
+        else:
+            self._logger.error("Connection refused by {}:{}, rc {}".format(
+                userdata['address'], userdata['port'], rc))
+
+    def _on_mqtt_disconnect(self, client: mq.Client, userdata, rc):
+        if rc != 0:
+            self._logger.warning(
+                "Unexpected disconnection from {}:{}, rc {}".format(
+                    userdata['address'], userdata['port'], rc))
+
+    def _forward(self, message_dict, traced_at):
+        if self.backlog or not self.__produce_dict(message_dict, traced_at):
+            self.__keep(
+                functools.partial(self.__produce_dict, message_dict,
+                                  traced_at))
+
+    def _send_dead_letter(self, topic, value, headers):
+        kwargs = self._produce_kwargs(headers=headers)
+        if self.backlog or not self.__produce(topic, value, kwargs):
+            self.__keep(functools.partial(self.__produce, topic, value,
+                                          kwargs))
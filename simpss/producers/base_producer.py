@@ -0,0 +1,236 @@
+"""Parts shared by the MQTT Kafka producers."""
+
+import datetime
+import logging
+import time
+from typing import Any, Dict, Union
+
+import confluent_kafka as ck
+import paho.mqtt.client as mq
+
+from simpss_common import metrics
+from simpss_common import tracing
+from simpss_common.codec import WIRE_FORMATS, WireFormat, get_codec
+from simpss_common.dead_letter import (MALFORMED, UNKNOWN_SENSOR,
+                                       DeadLetterQueue)
+from simpss_common.sensors import SensorRegistry
+
+TIMESTAMP_FORMATS = ('iso', 'epoch_ms')
+
+MQTT_REQUIRED_KEYS = ('client-id', 'address', 'port', 'transport', 'topic',
+                      'qos', 'max-inflight', 'payload-key')
+
+
+def check_mqtt_config(mqtt_config: Dict[str, Any]):
+    """Raise ValueError if a key of an MQTT configuration is missing."""
+    if not all(k in mqtt_config.keys() for k in MQTT_REQUIRED_KEYS):
+        raise ValueError("Required keys for Mqtt configuration are missing!")
+
+
+class BaseMqttKafkaProducer(object):
+    """
+    Base of the MQTT Kafka producers.
+
+    Checks and stamps the readings received from MQTT, routes the invalid
+    ones to the dead letters, builds the Kafka messages and counts their
+    delivery. Subclasses get the valid readings in _forward and send the
+    dead letters in _send_dead_letter.
+
+    The MQTT clients must have a userdata dict with the payload-key of
+    their configuration.
+    """
+
+    def __init__(self,
+                 kafka_config: Dict[str, Any],
+                 sensor_groups: Union[Dict[int, str], SensorRegistry],
+                 key_field,
+                 codec=None,
+                 wire_format='json',
+                 keyed=True,
+                 partitioner=None,
+                 trace_sample_rate=0.0,
+                 dead_letter_topic=None,
+                 dead_letter_batch_size=100,
+                 timestamp_format='iso'):
+        """
+        See MqttKafkaProducer for the parameters. key_field is required,
+        subclasses default it to the payload-key of the MQTT configuration.
+        """
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError("wire_format should be one of {}, got {}".format(
+                WIRE_FORMATS, wire_format))
+        if timestamp_format not in TIMESTAMP_FORMATS:
+            raise ValueError(
+                "timestamp_format should be one of {}, got {}".format(
+                    TIMESTAMP_FORMATS, timestamp_format))
+        if 'bootstrap.servers' not in kafka_config.keys():
+            raise ValueError("Missing bootstrap.servers key in kafka config")
+
+        self.messages_read_from_mqtt = 0
+        self.messages_sent_to_kafka = 0
+        self.buffer_full_waits = 0
+
+        self._epoch_ms = timestamp_format == 'epoch_ms'
+        self._codec = get_codec(codec)
+        self._wire = WireFormat(self._codec, binary=wire_format == 'binary')
+        self._sensor_map = sensor_groups
+        self._keyed = keyed
+        self._key_field = key_field
+        self._partitioner = partitioner
+        self._sampler = tracing.Sampler(trace_sample_rate)
+        self.__key_cache: Dict[Any, bytes] = dict()
+
+        producer_name = "{}-{}".format(str(kafka_config['group.id']),
+                                       str(kafka_config['client.id']))
+        self._logger = get_logger(producer_name)
+        self._logger.info(
+            "Creating Kafka producer with configuration {}".format(
+                kafka_config))
+        self._kf_producer: ck.Producer = ck.Producer(kafka_config,
+                                                     logger=self._logger)
+        self._logger.info("Created Kafka producer")
+
+        self._m_mqtt_received = metrics.counter(
+            'simpss_mqtt_messages_received_total',
+            'Messages received from the MQTT broker')
+        self._m_delivered = metrics.counter(
+            'simpss_kafka_messages_delivered_total',
+            'Messages delivered to Kafka')
+        self._m_delivery_errors = metrics.counter(
+            'simpss_kafka_delivery_errors_total',
+            'Messages Kafka failed to deliver')
+        self._m_delivery_latency = metrics.histogram(
+            'simpss_kafka_delivery_seconds',
+            'Seconds from produce to delivery report')
+        self._m_buffer_full = metrics.counter(
+            'simpss_kafka_buffer_full_total',
+            'Waits for a full local Kafka producer queue')
+
+        self._dead_letters = DeadLetterQueue('producer',
+                                             send=self._send_dead_letter,
+                                             topic=dead_letter_topic,
+                                             batch_size=dead_letter_batch_size)
+        self._logger.info("Using wire format " + self._wire.name)
+
+    def _forward(self, message_dict, traced_at):
+        """Send a valid reading on its way to Kafka."""
+        raise NotImplementedError
+
+    def _send_dead_letter(self, topic, value, headers):
+        """Produce a dead letter, unchanged, with its reason in the headers."""
+        raise NotImplementedError
+
+    def _on_mqtt_message(self, client: mq.Client, userdata,
+                         message: mq.MQTTMessage):
+        """
+        Called on message received.
+        Forwards message to the appropriate Kafka topic.
+        """
+        traced_at = time.time() if self._sampler.sample() else None
+        self.messages_read_from_mqtt += 1
+        self._m_mqtt_received.inc()
+
+        try:
+            payload = self._codec.loads(message.payload)
+            sensor_id = payload[userdata['payload-key']]
+            group = self._sensor_map.get(sensor_id)
+        except (ValueError, KeyError, TypeError) as e:
+            self._dead_letters.add(message.payload, MALFORMED,
+                                   '{}: {}'.format(type(e).__name__, e))
+            return
+
+        if group is None:
+            self._dead_letters.add(message.payload, UNKNOWN_SENSOR,
+                                   'sensor id {}'.format(sensor_id))
+            return
+
+        if self._epoch_ms:
+            payload['time_received'] = time.time_ns() // 1000000
+        else:
+            # naive UTC, like the epoch ms stamps and the Cassandra driver
+            payload['time_received'] = datetime.datetime.utcnow().isoformat()
+        payload['sensor_group'] = group
+        self._forward(payload, traced_at)
+
+    def _on_log(self, client: mq.Client, userdata, level, buf):
+        """
+        Called on logging by Mqtt client.
+        """
+        self._logger.debug(str(buf))
+
+    def _message(self, message_dict, traced_at=None):
+        """
+        Topic, value and produce arguments of the Kafka message of a reading:
+        the topic of its sensor group, keyed by sensor if keying is enabled.
+        If traced_at is the time the reading was received from MQTT, the
+        trace header is added.
+        """
+        key = None
+        partition = None
+        if self._keyed:
+            key = self.__message_key(message_dict)
+            if self._partitioner is not None:
+                partition = self._partitioner(key, message_dict)
+
+        headers = None
+        if traced_at is not None:
+            headers = [(tracing.TRACE_HEADER,
+                        tracing.encode_header(traced_at, time.time()))]
+
+        return (str(message_dict['sensor_group']),
+                self._wire.dumps(message_dict),
+                self._produce_kwargs(key, partition, headers))
+
+    def _produce_kwargs(self, key=None, partition=None, headers=None):
+        """Keyword arguments of Producer.produce for a message."""
+        kwargs = {'key': key, 'callback': self._delivery_report}
+        if partition is not None:
+            kwargs['partition'] = partition
+        if headers is not None:
+            kwargs['headers'] = headers
+        return kwargs
+
+    def __message_key(self, message_dict):
+        """Kafka key of a reading, cached per key value."""
+        value = message_dict.get(self._key_field)
+        if value is None:
+            return None
+        key = self.__key_cache.get(value)
+        if key is None:
+            key = str(value).encode('utf-8')
+            self.__key_cache[value] = key
+        return key
+
+    def _delivery_report(self, err, msg):
+        """
+        Called once for each message produced to indicate delivery result.
+        Triggered by poll() or flush().
+        """
+        if err is not None:
+            # TODO: fix this to error
+            self._logger.warning('Message delivery failed: {}'.format(err))
+            self._m_delivery_errors.inc()
+        else:
+            self._logger.debug('Message delivered to {} [{}]'.format(
+                msg.topic(), msg.partition()))
+            self.messages_sent_to_kafka += 1
+            self._m_delivered.inc()
+            latency = msg.latency() if hasattr(msg, 'latency') else None
+            if latency is not None:
+                self._m_delivery_latency.observe(latency)
+
+
+def get_logger(name='py-producer'):
+    """
+    Creates a logger for a producer.
+    """
+    logger = logging.getLogger(name=name)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        formatter = logging.Formatter(
+            '%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+
+    return logger
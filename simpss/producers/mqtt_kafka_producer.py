@@ -1,19 +1,21 @@
 """File for the MQTT KAFKA producer class."""
 
-import datetime
-import json
-import logging
-import os
 import queue
 import sys
+import threading
 import time
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Union
 
-import confluent_kafka as ck
 import paho.mqtt.client as mq
 
+from simpss_common import metrics
+from simpss_common.sensors import SensorRegistry
+from simpss_common.spool import DiskSpool, SpooledQueue
 
-class MqttKafkaProducer(object):
+from .base_producer import BaseMqttKafkaProducer, check_mqtt_config
+
+
+class MqttKafkaProducer(BaseMqttKafkaProducer):
     """
     MQTT Kafka producer.
     Consumes from an MQTT topic and produces to a Kafka instance.
@@ -22,9 +24,25 @@ class MqttKafkaProducer(object):
     def __init__(self,
                  mqtt_config,
                  kafka_config: Dict[str, Any],
-                 sensor_groups: Dict[int, str],
+                 sensor_groups: Union[Dict[int, str], SensorRegistry],
                  mqtt_timeout=1.0,
-                 kafka_timeout=0.3):
+                 kafka_timeout=0.3,
+                 codec=None,
+                 wire_format='json',
+                 threaded=False,
+                 drain_batch_size=500,
+                 drain_interval=0.05,
+                 keyed=True,
+                 key_field=None,
+                 partitioner=None,
+                 trace_sample_rate=0.0,
+                 dead_letter_topic=None,
+                 dead_letter_batch_size=100,
+                 timestamp_format='iso',
+                 spool_dir=None,
+                 spool_segment_bytes=64 * 2**20,
+                 spool_max_bytes=2**30,
+                 spool_fsync='interval'):
         """
         Create an instance of the Mqtt client and
         the Kafka producer with the specified configuration.
@@ -32,40 +50,107 @@ class MqttKafkaProducer(object):
         Needs to know a configuration for the mqtt client, a configuration
         for the Kafka producer, and a mapping between sensor ids and kafka topics.
         It assumes that sensors are part of a group, which is the name of the
-        Kafka topic the data will be written to.
+        Kafka topic the data will be written to. If sensor_groups is a
+        SensorRegistry, sensors added to its file while running are
+        picked up without restarting the producer.
+
+        codec is the JSON codec, or its name, used to parse the MQTT payloads
+        and to encode the Kafka messages, see simpss_common.codec.get_codec.
+        wire_format is the format of the Kafka messages, 'json' or 'binary'
+        (see simpss_common.codec.WireFormat).
+
+        If threaded is True, paho runs its own network thread and a drain
+        thread moves the messages from the queue to Kafka in groups of up to
+        drain_batch_size messages, waiting at most drain_interval seconds
+        to fill a group.
+
+        If keyed is True, Kafka messages are keyed by the value of key_field
+        (the sensor id, i.e. the mqtt payload-key, by default), so all the
+        readings of a sensor go to the same partition, in order.
+        partitioner, if given, is called as partitioner(key, message) and
+        returns the partition to write to, or None to let Kafka choose
+        from the key.
+
+        A fraction trace_sample_rate of the messages is traced: the time
+        they are received from MQTT and produced to Kafka is sent in the
+        simpss-trace header, see simpss_common.tracing.
+
+        Payloads that are not valid readings or come from unknown sensors
+        are sent unchanged, in batches of dead_letter_batch_size, to
+        dead_letter_topic with the reason in the headers, or only counted
+        if it is None, see simpss_common.dead_letter.
+
+        timestamp_format is the format of the time_received field: 'iso',
+        an ISO 8601 string in UTC without offset, or 'epoch_ms', the
+        integer milliseconds since the epoch in UTC, cheaper to produce,
+        encode and store. The consumer reads both.
+
+        If spool_dir is given, the queue between MQTT and Kafka is kept in
+        memory-mapped segment files of spool_segment_bytes in that
+        directory, see simpss_common.spool.DiskSpool: receiving from MQTT
+        never waits for Kafka, up to spool_max_bytes of readings are kept
+        while Kafka is slow or down, and the readings not produced yet
+        survive a restart and are produced first, in order. spool_fsync
+        is 'always', 'interval' or 'never'. Readings are removed from the
+        spool once handed to the Kafka client, so the ones in its buffer
+        are still lost in a crash.
         """
-        self.messages_read_from_mqtt = 0
-        self.messages_sent_to_kafka = 0
+        self.last_drain_batch = 0
+        self.last_drain_latency = 0.0
 
         assert mqtt_timeout > 0.0 and mqtt_timeout < 600.0
         assert kafka_timeout >= 0.0 and kafka_timeout < 600.0
         self._mqtt_timeout = mqtt_timeout
         self._kafka_poll_timeout = kafka_timeout
-
-        producer_name = "{}-{}".format(str(kafka_config['group.id']),
-                                       str(kafka_config['client.id']))
-        self.__logger = self.__get_logger(producer_name)
-
-        self.__logger.info("Setting up mqtt and kafka")
+        assert drain_batch_size >= 1 and drain_interval > 0.0
+        self._threaded = threaded
+        self._drain_batch_size = drain_batch_size
+        self._drain_interval = drain_interval
+        check_mqtt_config(mqtt_config)
+
+        super().__init__(kafka_config,
+                         sensor_groups,
+                         key_field or mqtt_config['payload-key'],
+                         codec=codec,
+                         wire_format=wire_format,
+                         keyed=keyed,
+                         partitioner=partitioner,
+                         trace_sample_rate=trace_sample_rate,
+                         dead_letter_topic=dead_letter_topic,
+                         dead_letter_batch_size=dead_letter_batch_size,
+                         timestamp_format=timestamp_format)
         self.__setup_mqtt(mqtt_config)
-        self.__setup_kafka(kafka_config)
-        self.__sensor_map = sensor_groups
-        self.queue: queue.Queue = queue.Queue(maxsize=5000)
-        self.__logger.info("Finished configuration for mqtt and Kafka")
+        if spool_dir is None:
+            self.queue: queue.Queue = queue.Queue(maxsize=5000)
+        else:
+            self.queue = SpooledQueue(
+                DiskSpool(spool_dir,
+                          segment_bytes=spool_segment_bytes,
+                          max_bytes=spool_max_bytes,
+                          fsync=spool_fsync), self._wire)
+            self._logger.info("Spooling to {}, {} readings to replay".format(
+                spool_dir, self.queue.qsize()))
+        self.__setup_metrics()
+        self.__delivered = threading.Condition()
+        self.__waiters = 0
+        self.__polling = False
+        self.__poller = None
+        self.__draining = False
+        self.__drainer = None
+        self._logger.info("Finished configuration for mqtt and Kafka")
+
+    def __setup_metrics(self):
+        self._m_queue_wait = metrics.histogram(
+            'simpss_producer_queue_wait_seconds',
+            'Seconds a message waited in the queue before being produced')
+        metrics.gauge('simpss_producer_queue_depth',
+                      'Messages waiting in the producer queue').set_function(
+                          self.queue.qsize)
 
     def __setup_mqtt(self, mqtt_config: Dict[str, Any]):
-        mq_required_keys = set([
-            'client-id', 'address', 'port', 'transport', 'topic', 'qos',
-            'max-inflight', 'payload-key'
-        ])
-        if not all(k in mqtt_config.keys() for k in mq_required_keys):
-            raise ValueError(
-                "Required keys for Mqtt configuration are missing!")
-
         self._mqtt_address = str(mqtt_config['address'])
         self._mqtt_port = int(mqtt_config['port'])
         self._mqtt_topic = str(mqtt_config['topic'])
-        self._mqtt_payload_key = mqtt_config['payload-key']
 
         mqtt_client_id = str(mqtt_config['client-id'])
         mqtt_transport = str(mqtt_config['transport'])
@@ -76,24 +161,15 @@ class MqttKafkaProducer(object):
                                     clean_session=True,
                                     transport=mqtt_transport)
         self._mq_client.max_inflight_messages_set(mqtt_max_inflight)
+        self._mq_client.user_data_set(
+            {'payload-key': mqtt_config['payload-key']})
         self._mq_client.on_connect = self._on_mqtt_connect(
             self._mqtt_topic, mqtt_qos)
         self._mq_client.on_log = self._on_log
         self._mq_client.on_message = self._on_mqtt_message
         self._mq_client.on_disconnect = self._on_mqtt_disconnect
 
-        self.__logger.info("Created mqtt client with id: " + mqtt_client_id)
-
-    def __setup_kafka(self, kafka_config):
-        if 'bootstrap.servers' not in kafka_config.keys():
-            raise ValueError("Missing bootstrap.servers key in kafka config")
-
-        self.__logger.info(
-            "Creating Kafka producer with configuration {}".format(
-                kafka_config))
-        self._kf_producer: ck.Producer = ck.Producer(kafka_config,
-                                                     logger=self.__logger)
-        self.__logger.info("Created Kafka producer")
+        self._logger.info("Created mqtt client with id: " + mqtt_client_id)
 
     def run(self):
         """
@@ -102,70 +178,241 @@ class MqttKafkaProducer(object):
         self._mq_client.connect(self._mqtt_address,
                                 port=self._mqtt_port,
                                 keepalive=60)
+        self.__start_poller()
 
         try:
-            while True:
-                # poll the mqtt client for network events
-                # things will happen in the on_message callback
-                self._mq_client.loop(timeout=self._mqtt_timeout)
-
-                # the queue should contain messages at this point
-                try:  # get all messages from the queue and send them to Kafka
-                    while True:
-                        # raises if empty, so don't worry of infinite loops
-                        message_dict = self.queue.get_nowait()
-                        kafka_topic = str(message_dict['sensor_group'])
-                        message_str = json.dumps(message_dict,
-                                                 ensure_ascii=False)
-                        message = message_str.encode('utf-8')
-
-                        # produce to kafka and poll for self._kafka_poll_timeout seconds max
-                        self._kf_producer.produce(
-                            kafka_topic,
-                            message,
-                            callback=self.__delivery_report)
-                        self._kf_producer.poll(self._kafka_poll_timeout)
-
-                except queue.Empty:
-                    continue
+            if self._threaded:
+                self.__run_threaded()
+            else:
+                self.__run_single_thread()
 
         except KeyboardInterrupt:
-            self.__logger.info("Stopping mqtt and Kafka clients")
+            self._logger.info("Stopping mqtt and Kafka clients")
             self._mq_client.unsubscribe(self._mqtt_topic)
-            self.__logger.info(
-                "Awaiting 5 seconds to flush the Kafka producer")
-            self._kf_producer.flush(5)
-            self.__logger.info("Kafka client flushed")
+            self.__shutdown()
         finally:
             self._mq_client.loop_start()
             time.sleep(2)
             self._mq_client.loop_stop()
 
+    def __shutdown(self):
+        """
+        Produce what is left in the queue and flush the Kafka producer.
+        """
+        self.__stop_drainer()
+        self._dead_letters.flush()
+        self.__stop_poller()
+        self._logger.info("Awaiting 5 seconds to flush the Kafka producer")
+        self._kf_producer.flush(5)
+        self._logger.info("Kafka client flushed")
+        if isinstance(self.queue, SpooledQueue):
+            self.queue.close()
+
+    def __run_single_thread(self):
+        """
+        MQTT network events and Kafka production take turns
+        in the calling thread.
+        """
+        while True:
+            # poll the mqtt client for network events
+            # things will happen in the on_message callback
+            self._mq_client.loop(timeout=self._mqtt_timeout)
+
+            # the queue should contain messages at this point
+            try:  # get all messages from the queue and send them to Kafka
+                while True:
+                    # raises if empty, so don't worry of infinite loops
+                    enqueued_at, message_dict, traced_at = \
+                        self.queue.get_nowait()
+
+                    # delivery reports are served by the poller thread
+                    self.__produce_dict(message_dict, traced_at)
+                    self.queue.task_done()
+                    self.last_drain_latency = time.monotonic() - enqueued_at
+                    self._m_queue_wait.observe(self.last_drain_latency)
+
+            except queue.Empty:
+                self._dead_letters.maybe_flush()
+                continue
+
+    def __run_threaded(self):
+        """
+        paho runs its network loop in its own thread, the drain thread
+        sends the queued messages to Kafka: the calling thread only waits.
+
+        If the drain thread dies the producer stops and exits with status 1,
+        instead of receiving from MQTT into a queue nobody empties.
+        """
+        self._mq_client.loop_start()
+        self.__draining = True
+        self.__drainer = threading.Thread(target=self.__drain,
+                                          name='queue-drainer',
+                                          daemon=True)
+        self.__drainer.start()
+        while self.__drainer.is_alive():
+            self.__drainer.join(self._mqtt_timeout)
+
+        self._logger.error("Drain thread died, stopping the producer")
+        self.__shutdown()
+        sys.exit(1)
+
+    def __stop_drainer(self):
+        """Stop the drain thread after it emptied the queue."""
+        self.__draining = False
+        if self.__drainer is not None:
+            self.__drainer.join()
+            self.__drainer = None
+            self._mq_client.loop_stop()
+
+    def __drain(self):
+        # a spool keeps what is left for the next run
+        spooled = isinstance(self.queue, SpooledQueue)
+        try:
+            while self.__draining or not (spooled or self.queue.empty()):
+                self.drain_batch()
+                self._dead_letters.maybe_flush()
+        except Exception:
+            self._logger.exception("Drain thread failed")
+
+    def drain_batch(self):
+        """
+        Take up to drain_batch_size messages from the queue, waiting at most
+        drain_interval seconds, and produce them to Kafka.
+
+        Returns
+        -------
+        int
+            number of messages produced
+        """
+        try:
+            batch = [self.queue.get(timeout=self._drain_interval)]
+        except queue.Empty:
+            return 0
+
+        deadline = time.monotonic() + self._drain_interval
+        while len(batch) < self._drain_batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        for _, message_dict, traced_at in batch:
+            self.__produce_dict(message_dict, traced_at)
+            self.queue.task_done()
+
+        now = time.monotonic()
+        self._m_queue_wait.observe_many(
+            [now - enqueued_at for enqueued_at, _, _ in batch])
+        self.last_drain_batch = len(batch)
+        self.last_drain_latency = now - batch[0][0]
+        return len(batch)
+
+    def metrics(self):
+        """
+        Queue depth, size of the last group drained from the queue, seconds
+        its oldest message waited before being produced, and the number of
+        waits for a full Kafka producer queue.
+        """
+        return {
+            'queue_depth': self.queue.qsize(),
+            'last_drain_batch': self.last_drain_batch,
+            'last_drain_latency': self.last_drain_latency,
+            'buffer_full_waits': self.buffer_full_waits,
+        }
+
+    def __produce_dict(self, message_dict, traced_at=None):
+        """Send a reading to Kafka, see BaseMqttKafkaProducer._message."""
+        topic, value, kwargs = self._message(message_dict, traced_at)
+        self.__produce(topic, value, kwargs)
+
+    def produce(self, topic, message, key=None, partition=None, headers=None):
+        """
+        Send a message to Kafka without waiting for its delivery.
+
+        If the local producer queue is full, wait for the poller thread to
+        serve delivery reports and try again, so a slow Kafka cluster
+        slows down the producer instead of crashing it.
+        """
+        self.__produce(topic, message,
+                       self._produce_kwargs(key, partition, headers))
+
+    def __produce(self, topic, message, kwargs):
+        while True:
+            try:
+                self._kf_producer.produce(topic, message, **kwargs)
+                return
+            except BufferError:
+                self.buffer_full_waits += 1
+                self._m_buffer_full.inc()
+                if self.buffer_full_waits % 1000 == 1:
+                    self._logger.warning(
+                        "Kafka producer queue full, waiting for deliveries")
+                if self.__poller is None or \
+                        threading.current_thread() is self.__poller:
+                    # no poller thread, or called by it: nobody else
+                    # serves the delivery reports
+                    self._kf_producer.poll(max(self._kafka_poll_timeout, 0.01))
+                    continue
+                with self.__delivered:
+                    self.__waiters += 1
+                    self.__delivered.wait(max(self._kafka_poll_timeout, 0.01))
+                    self.__waiters -= 1
+
+    def __start_poller(self):
+        """
+        Start the thread serving the Kafka delivery reports.
+        """
+        self.__polling = True
+        self.__poller = threading.Thread(target=self.__poll_kafka,
+                                         name='kafka-poller',
+                                         daemon=True)
+        self.__poller.start()
+
+    def __stop_poller(self):
+        self.__polling = False
+        if self.__poller is not None:
+            self.__poller.join()
+            self.__poller = None
+
+    def __poll_kafka(self):
+        # dead letters are sent by the threads producing the readings:
+        # a send from here waiting for room would stop the polling
+        while self.__polling:
+            self._kf_producer.poll(max(self._kafka_poll_timeout, 0.01))
+
     def _on_mqtt_connect(self, topic, qos):
         def on_connect(client: mq.Client, userdata, flags, rc):
             """
             Callback called on connection event.
             """
             if rc == 0:
-                self.__logger.info("Connected to " + client._host)
+                self._logger.info("Connected to " + client._host)
                 # subscribe to a topic - once subscribed, the callback
                 # will trigger the client loop
-                self.__logger.info("Subscribing to topic " + topic +
+                self._logger.info("Subscribing to topic " + topic +
                                    " with qos=" + str(qos))
                 client.subscribe(topic, qos=qos)
             elif rc == 1:
-                self.__logger.error(
+                self._logger.error(
                     "Connection refused - incorrect protocol version")
             elif rc == 2:
-                self.__logger.error(
+                self._logger.error(
                     "Connection refused - invalid client identifier")
             elif rc == 3:
-                self.__logger.error("Connection refused - server unavailable")
+                self._logger.error("Connection refused - server unavailable")
             elif rc == 4:
-                self.__logger.error(
+                self._logger.error(
                     "Connection refused - bad username or password")
             elif rc == 5:
-                self.__logger.error(" Connection refused - not authorised")
+                self._logger.error(" Connection refused - not authorised")
 
         return on_connect
 
@@ -174,68 +421,31 @@ class MqttKafkaProducer(object):
         Disconnection callback.
         """
         if rc == 0:
-            self.__logger.info("Peacefully disconnected.")
+            self._logger.info("Peacefully disconnected.")
         else:
-            self.__logger.warning("Unexpected disconnection")
+            self._logger.warning("Unexpected disconnection")
 
     def _on_mqtt_subscribe(self, client: mq.Client, userdata, mid,
                            granted_qos: List[int]):
         """
         Called when a subscription answer is received from the broker.
         """
-        self.__logger.info("Subscribed")
+        self._logger.info("Subscribed")
 
     def _on_mqtt_unsubscribe(self, client, userdata, mid):
-        self.__logger.info("Unsubscribed")
+        self._logger.info("Unsubscribed")
         self._mq_client.disconnect()
 
-    def _on_mqtt_message(self, client: mq.Client, userdata,
-                         message: mq.MQTTMessage):
-        """
-        Called on message received.
-        Forwards message to the appropriate Kafka topic.
-        """
-        payload_bytes = message.payload
-        payload_str = payload_bytes.decode("utf-8")
-        payload = json.loads(payload_str)
+    def _forward(self, message_dict, traced_at):
+        self.queue.put((time.monotonic(), message_dict, traced_at))
 
-        payload['time_received'] = datetime.datetime.now().isoformat()
-        sensor_id = payload[self._mqtt_payload_key]
-        try:
-            payload['sensor_group'] = self.__sensor_map[sensor_id]
-            self.queue.put(payload)
-        except KeyError:
-            raise KeyError(
-                f"{sensor_id} is not a known sensor_id, check definition file")
-
-    def _on_log(self, client: mq.Client, userdata, level, buf):
-        """
-        Called on logging by Mqtt client.
-        """
-        self.__logger.debug(str(buf))
-
-    def __delivery_report(self, err, msg):
-        """
-        Called once for each message produced to indicate delivery result.
-        Triggered by poll() or flush().
-        """
-        if err is not None:
-            # TODO: fix this to error
-            self.__logger.warning('Message delivery failed: {}'.format(err))
-        else:
-            self.__logger.info('Message delivered to {} [{}]'.format(
-                msg.topic(), msg.partition()))
-
-    def __get_logger(self, name='py-producer'):
-        """
-        Creates a logger for this class.
-        """
-        logger = logging.getLogger(name=name)
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter(
-            '%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        logger.setLevel(logging.DEBUG)
+    def _send_dead_letter(self, topic, value, headers):
+        self.produce(topic, value, headers=headers)
 
-        return logger
+    def _delivery_report(self, err, msg):
+        super()._delivery_report(err, msg)
+        # wake the producers waiting for room in the Kafka queue, if any:
+        # a waiter missed here wakes up at its timeout anyway
+        if self.__waiters:
+            with self.__delivered:
+                self.__delivered.notify_all()
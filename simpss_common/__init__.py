@@ -0,0 +1 @@
+from . import codec, dead_letter, metrics, sensors, spool, tracing
@@ -0,0 +1,4 @@
+"""Codecs shared by the producer and the consumer."""
+
+from .json_codec import JsonCodec, available_codecs, get_codec
+from .wire_format import WIRE_FORMATS, WireFormat
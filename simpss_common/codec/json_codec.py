@@ -0,0 +1,93 @@
+"""Pluggable JSON codec, using a fast library when one is installed."""
+
+import json
+import os
+from typing import Any, Dict, List, Union
+
+# name of the codec used when none is given, 'auto' picks the fastest one
+CODEC_ENV_VAR = 'SIMPSS_JSON_CODEC'
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # optional dependency
+    ujson = None
+
+
+class JsonCodec(object):
+    """
+    Encodes Python objects to UTF-8 JSON bytes and decodes them back.
+    Decoding accepts both bytes and str, so payloads coming from MQTT or
+    Kafka can be parsed without decoding them to str first.
+    """
+
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return "JsonCodec({})".format(self.name)
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def _ujson_dumps(obj: Any) -> bytes:
+    return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def _build_codecs() -> Dict[str, JsonCodec]:
+    codecs = {'stdlib': JsonCodec('stdlib', json.loads, _stdlib_dumps)}
+    if ujson is not None:
+        codecs['ujson'] = JsonCodec('ujson', ujson.loads, _ujson_dumps)
+    if orjson is not None:
+        codecs['orjson'] = JsonCodec('orjson', orjson.loads, orjson.dumps)
+    return codecs
+
+
+_CODECS = _build_codecs()
+_PREFERENCE = ['orjson', 'ujson', 'stdlib']
+
+
+def available_codecs() -> List[str]:
+    """Names of the codecs that can be used, fastest first."""
+    return [name for name in _PREFERENCE if name in _CODECS]
+
+
+def get_codec(codec: Union[str, JsonCodec, None] = None) -> JsonCodec:
+    """
+    Get a JSON codec.
+
+    Parameters
+    ----------
+    codec: str or JsonCodec, optional
+        a codec instance, returned as is, or the name of a codec:
+        'auto', 'orjson', 'ujson' or 'stdlib'. If None, the name is read
+        from the SIMPSS_JSON_CODEC environment variable (default 'auto').
+        'auto' picks the fastest installed library.
+
+    Returns
+    -------
+    JsonCodec
+        the codec
+    """
+    if isinstance(codec, JsonCodec):
+        return codec
+
+    name = codec or os.environ.get(CODEC_ENV_VAR, 'auto')
+    if name == 'auto':
+        name = available_codecs()[0]
+
+    if name not in _CODECS:
+        raise ValueError(
+            "JSON codec {} is not available, installed codecs are {}".format(
+                name, available_codecs()))
+
+    return _CODECS[name]
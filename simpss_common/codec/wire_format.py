@@ -0,0 +1,171 @@
+"""Compact binary wire format for the sensor readings sent through Kafka."""
+
+import operator
+import struct
+from typing import Any, Dict, Union
+
+from .json_codec import JsonCodec, get_codec
+
+# first byte of every binary message, JSON messages start with '{' instead
+MAGIC = 0xB5
+
+# schema 1: the integer fields of a reading in a fixed layout, followed
+# by sensor_group and time_received as UTF-8 strings
+SCHEMA_SENSOR_V1 = 1
+SENSOR_V1_INT_FIELDS = ('id', 'uptime', 'T', 'P', 'H', 'Ix', 'Iy', 'Iz', 'M')
+SENSOR_V1_FIELDS = SENSOR_V1_INT_FIELDS + ('sensor_group', 'time_received')
+
+# magic, schema id, int fields (uptime is 64 bit), string lengths
+_SENSOR_V1 = struct.Struct('<BBiqiiiiiiiHH')
+_get_v1_ints = operator.itemgetter(*SENSOR_V1_INT_FIELDS)
+
+# schema 2: as schema 1, but time_received is an int of epoch
+# milliseconds stored in the fixed layout, followed by sensor_group
+SCHEMA_SENSOR_V2 = 2
+SENSOR_V2_INT_FIELDS = SENSOR_V1_INT_FIELDS + ('time_received', )
+
+# magic, schema id, int fields (uptime and time_received are 64 bit),
+# sensor_group length
+_SENSOR_V2 = struct.Struct('<BBiqiiiiiiiqH')
+_get_v2_ints = operator.itemgetter(*SENSOR_V2_INT_FIELDS)
+
+WIRE_FORMATS = ('json', 'binary')
+
+
+class WireFormat(object):
+    """
+    Encodes readings for Kafka and decodes them back.
+
+    Decoding always accepts both binary and JSON messages, so producers
+    can be switched to the binary format one at a time. Encoding writes
+    the binary format only if binary is True and the message matches a
+    known schema, anything else is written as JSON. Readings with an ISO
+    string time_received use schema 1, those with epoch milliseconds
+    schema 2.
+    """
+
+    def __init__(self, json_codec: Union[str, JsonCodec, None] = None,
+                 binary=False):
+        """
+        Parameters
+        ----------
+        json_codec: str or JsonCodec, optional
+            codec for the JSON messages, see get_codec
+
+        binary: bool
+            if True, encode readings with the binary format
+        """
+        self.json_codec = get_codec(json_codec)
+        self.binary = binary
+
+    @property
+    def name(self):
+        if self.binary:
+            return 'binary+{}'.format(self.json_codec.name)
+        return self.json_codec.name
+
+    def dumps(self, message: Dict[str, Any]) -> bytes:
+        """Encode a message, falling back to JSON if it has no schema."""
+        if self.binary and len(message) == len(SENSOR_V1_FIELDS):
+            if isinstance(message.get('time_received'), int):
+                encoded = encode_sensor_v2(message)
+            else:
+                encoded = encode_sensor_v1(message)
+            if encoded is not None:
+                return encoded
+        return self.json_codec.dumps(message)
+
+    def loads(self, data: Union[bytes, str]) -> Dict[str, Any]:
+        """Decode a binary or JSON message."""
+        if isinstance(data, bytes) and data and data[0] == MAGIC:
+            return decode_binary(data)
+        return self.json_codec.loads(data)
+
+
+def encode_sensor_v1(message: Dict[str, Any]):
+    """
+    Encode a reading with schema 1.
+
+    Returns
+    -------
+    bytes or None
+        the encoded message, None if the message does not fit the schema
+    """
+    try:
+        group = message['sensor_group'].encode('utf-8')
+        time_received = message['time_received'].encode('utf-8')
+        return b''.join(
+            (_SENSOR_V1.pack(MAGIC, SCHEMA_SENSOR_V1, *_get_v1_ints(message),
+                             len(group), len(time_received)), group,
+             time_received))
+    except (KeyError, AttributeError, struct.error):
+        return None
+
+
+def encode_sensor_v2(message: Dict[str, Any]):
+    """
+    Encode a reading with an epoch milliseconds time_received
+    with schema 2.
+
+    Returns
+    -------
+    bytes or None
+        the encoded message, None if the message does not fit the schema
+    """
+    try:
+        group = message['sensor_group'].encode('utf-8')
+        return _SENSOR_V2.pack(MAGIC, SCHEMA_SENSOR_V2, *_get_v2_ints(message),
+                               len(group)) + group
+    except (KeyError, AttributeError, struct.error):
+        return None
+
+
+def decode_binary(data: bytes) -> Dict[str, Any]:
+    """
+    Decode a binary message, dispatching on its schema id.
+    """
+    if len(data) < 2 or data[0] != MAGIC:
+        raise ValueError("Not a binary message")
+
+    schema = data[1]
+    if schema == SCHEMA_SENSOR_V2:
+        return _decode_sensor_v2(data)
+    if schema == SCHEMA_SENSOR_V1:
+        return _decode_sensor_v1(data)
+
+    raise ValueError("Unknown binary schema {}".format(schema))
+
+
+def _decode_sensor_v1(data: bytes) -> Dict[str, Any]:
+    try:
+        values = _SENSOR_V1.unpack_from(data)
+    except struct.error as e:
+        raise ValueError("Truncated binary message: {}".format(e)) from None
+
+    group_start = _SENSOR_V1.size
+    group_end = group_start + values[-2]
+    time_end = group_end + values[-1]
+    if len(data) != time_end:
+        raise ValueError("Binary message has length {}, expected {}".format(
+            len(data), time_end))
+
+    message = dict(zip(SENSOR_V1_INT_FIELDS, values[2:-2]))
+    message['sensor_group'] = data[group_start:group_end].decode('utf-8')
+    message['time_received'] = data[group_end:time_end].decode('utf-8')
+    return message
+
+
+def _decode_sensor_v2(data: bytes) -> Dict[str, Any]:
+    try:
+        values = _SENSOR_V2.unpack_from(data)
+    except struct.error as e:
+        raise ValueError("Truncated binary message: {}".format(e)) from None
+
+    group_end = _SENSOR_V2.size + values[-1]
+    if len(data) != group_end:
+        raise ValueError("Binary message has length {}, expected {}".format(
+            len(data), group_end))
+
+    message = dict(zip(SENSOR_V2_INT_FIELDS, values[2:-1]))
+    message['sensor_group'] = data[_SENSOR_V2.size:group_end].decode('utf-8')
+    return message
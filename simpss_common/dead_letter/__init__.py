@@ -0,0 +1,4 @@
+"""Routing of the messages that cannot be processed."""
+
+from .dead_letter_queue import (DEAD_LETTER_HEADERS, MALFORMED, UNKNOWN_SENSOR,
+                                DeadLetterQueue)
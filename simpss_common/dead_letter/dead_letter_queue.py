@@ -0,0 +1,136 @@
+"""Batched dead-letter queue backed by a Kafka topic."""
+
+import logging
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from .. import metrics
+
+logger = logging.getLogger('dead-letter')
+
+# reasons
+MALFORMED = 'malformed'
+UNKNOWN_SENSOR = 'unknown_sensor'
+
+# headers of a dead letter: reason, details of the error, pipeline stage
+DEAD_LETTER_HEADERS = ('simpss-dlq-reason', 'simpss-dlq-detail',
+                       'simpss-dlq-stage')
+
+_MAX_DETAIL = 512
+
+
+class DeadLetterQueue(object):
+    """
+    Collects the messages that cannot be processed and sends them in
+    batches to a dead-letter topic, unchanged, with the reason in the
+    headers. Without a topic the messages are only counted and logged.
+
+    Messages are sent when batch_size of them are waiting or when
+    maybe_flush is called interval seconds after the last send.
+    add, flush and maybe_flush can be called from any thread.
+    """
+
+    def __init__(self,
+                 stage: str,
+                 send: Optional[Callable] = None,
+                 topic: Optional[str] = None,
+                 batch_size=100,
+                 interval=1.0):
+        """
+        Parameters
+        ----------
+        stage: str
+            name of the pipeline stage, e.g. 'producer'
+
+        send: callable, optional
+            called as send(topic, value, headers) to produce a message,
+            required if topic is given
+
+        topic: str, optional
+            dead-letter topic, None to drop the messages
+
+        batch_size: int
+            number of waiting messages that triggers a send
+
+        interval: float
+            maximum seconds a message waits, checked by maybe_flush
+        """
+        if topic is not None and send is None:
+            raise ValueError("send is required to use a dead-letter topic")
+        if batch_size < 1:
+            raise ValueError(
+                "batch_size should be at least 1, got {} instead".format(
+                    batch_size))
+
+        self.stage = stage
+        self.topic = topic
+        self.batch_size = batch_size
+        self.interval = interval
+        self.dead_letters = 0
+        self.__send = send
+        self.__lock = threading.Lock()
+        self.__waiting: List[Tuple[bytes, list]] = []
+        self.__last_flush = time.monotonic()
+        self.__counters = dict()
+
+    def add(self, value, reason, detail=''):
+        """
+        Route a message to the dead-letter topic.
+
+        Parameters
+        ----------
+        value: bytes or str
+            the message as it was received
+
+        reason: str
+            why the message is rejected, e.g. MALFORMED
+
+        detail: str
+            description of the error
+        """
+        self.dead_letters += 1
+        self.__counter(reason).inc()
+        if self.dead_letters % 1000 == 1:
+            logger.warning("{} dead letters in {}, last one is {}: {}".format(
+                self.dead_letters, self.stage, reason, detail))
+        if self.topic is None:
+            return
+
+        headers = list(
+            zip(DEAD_LETTER_HEADERS,
+                (reason, str(detail)[:_MAX_DETAIL], self.stage)))
+        with self.__lock:
+            self.__waiting.append((value, headers))
+            full = len(self.__waiting) >= self.batch_size
+        if full:
+            self.flush()
+
+    def maybe_flush(self):
+        """Send the waiting messages if interval seconds have passed."""
+        if self.__waiting and \
+                time.monotonic() - self.__last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Send all the waiting messages."""
+        with self.__lock:
+            waiting, self.__waiting = self.__waiting, []
+            self.__last_flush = time.monotonic()
+
+        for value, headers in waiting:
+            try:
+                self.__send(self.topic, value, headers)
+            except Exception as e:
+                logger.error("Cannot send a dead letter to {}: {}".format(
+                    self.topic, e))
+
+    def __counter(self, reason):
+        counter = self.__counters.get(reason)
+        if counter is None:
+            counter = metrics.counter('simpss_dead_letters_total',
+                                      'Messages routed to the dead letters',
+                                      stage=self.stage,
+                                      reason=reason)
+            self.__counters[reason] = counter
+        return counter
@@ -0,0 +1,5 @@
+"""Metrics shared by all the pipeline stages, in Prometheus text format."""
+
+from .registry import (REGISTRY, Counter, Gauge, Histogram, Registry, counter,
+                       gauge, histogram)
+from .server import start_http_server
@@ -0,0 +1,205 @@
+"""Counters, gauges and histograms kept in a registry."""
+
+import bisect
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+# upper bounds in seconds, from half a millisecond to ten seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    """Monotonically increasing value."""
+    type_name = 'counter'
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Gauge(object):
+    """
+    Value that can go up and down. It can also be computed on demand
+    by a function, e.g. the size of a queue.
+    """
+    type_name = 'gauge'
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__value = 0
+        self.__function: Optional[Callable[[], float]] = None
+
+    def set(self, value):
+        self.__value = value
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.__value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]):
+        """Compute the value calling function every time it is read."""
+        self.__function = function
+
+    @property
+    def value(self):
+        if self.__function is not None:
+            return self.__function()
+        return self.__value
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Histogram(object):
+    """Distribution of observed values over cumulative buckets."""
+    type_name = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.__lock = threading.Lock()
+        self.buckets = tuple(sorted(buckets))
+        # the last slot counts the values above every bucket (+Inf)
+        self.__counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.__counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def observe_many(self, values):
+        """Observe many values holding the lock only once."""
+        indexes = [bisect.bisect_left(self.buckets, v) for v in values]
+        with self.__lock:
+            for i in indexes:
+                self.__counts[i] += 1
+            self.sum += sum(values)
+            self.count += len(indexes)
+
+    def samples(self, name, labels):
+        with self.__lock:
+            counts = list(self.__counts)
+            total, count = self.sum, self.count
+
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'), ),
+                                       counts):
+            cumulative += bucket_count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            samples.append((name + '_bucket', labels + (('le', le), ),
+                            cumulative))
+        samples.append((name + '_sum', labels, total))
+        samples.append((name + '_count', labels, count))
+        return samples
+
+
+class Registry(object):
+    """
+    Collection of metrics, identified by name and label values.
+    Asking twice for the same metric returns the same object.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        # name -> (type, help, {labels: metric})
+        self.__families: Dict[str, Tuple[type, str, Dict[Tuple, object]]] = \
+            dict()
+
+    def counter(self, name, documentation='', **labels) -> Counter:
+        return self.__get(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation='', **labels) -> Gauge:
+        return self.__get(Gauge, name, documentation, labels)
+
+    def histogram(self,
+                  name,
+                  documentation='',
+                  buckets=LATENCY_BUCKETS,
+                  **labels) -> Histogram:
+        return self.__get(Histogram, name, documentation, labels, buckets)
+
+    def __get(self, kind, name, documentation, labels, *args):
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self.__lock:
+            family = self.__families.get(name)
+            if family is None:
+                family = (kind, documentation, dict())
+                self.__families[name] = family
+            elif family[0] is not kind:
+                raise ValueError("Metric {} already registered as {}".format(
+                    name, family[0].type_name))
+
+            metric = family[2].get(key)
+            if metric is None:
+                metric = kind(*args)
+                family[2][key] = metric
+            return metric
+
+    def render(self) -> str:
+        """The metrics in Prometheus text exposition format."""
+        with self.__lock:
+            families = [(name, kind, documentation, list(metrics.items()))
+                        for name, (kind, documentation,
+                                   metrics) in sorted(self.__families.items())]
+
+        lines: List[str] = []
+        for name, kind, documentation, metrics in families:
+            if documentation:
+                lines.append('# HELP {} {}'.format(name, documentation))
+            lines.append('# TYPE {} {}'.format(name, kind.type_name))
+            for labels, metric in metrics:
+                for sample_name, sample_labels, value in metric.samples(
+                        name, labels):
+                    lines.append('{}{} {}'.format(sample_name,
+                                                  _format_labels(sample_labels),
+                                                  _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k,
+        v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+# registry used by all the components of the process
+REGISTRY = Registry()
+
+
+def counter(name, documentation='', **labels) -> Counter:
+    """Get or create a counter in the default registry."""
+    return REGISTRY.counter(name, documentation, **labels)
+
+
+def gauge(name, documentation='', **labels) -> Gauge:
+    """Get or create a gauge in the default registry."""
+    return REGISTRY.gauge(name, documentation, **labels)
+
+
+def histogram(name, documentation='', buckets=LATENCY_BUCKETS,
+              **labels) -> Histogram:
+    """Get or create a histogram in the default registry."""
+    return REGISTRY.histogram(name, documentation, buckets, **labels)
@@ -0,0 +1,44 @@
+"""HTTP endpoint serving the metrics to Prometheus."""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .registry import REGISTRY, Registry
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def start_http_server(port, address='localhost', registry: Registry = REGISTRY):
+    """
+    Serve the metrics of registry at http://address:port/metrics
+    from a daemon thread.
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        the running server, call shutdown() to stop it
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes are too frequent to be logged
+            pass
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-server',
+                              daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,3 @@
+"""Mapping from sensor ids to sensor groups."""
+
+from .registry import SensorRegistry, read_sensor_groups
@@ -0,0 +1,162 @@
+"""Sensor registry, reloaded when its file changes."""
+
+import csv
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger('sensor-registry')
+
+
+def read_sensor_groups(file_path) -> Dict[int, str]:
+    """
+    Read the mapping from sensor_id to group_id of a CSV file
+    with the columns sensor_id and group_id.
+
+    Raises
+    ------
+    ValueError
+        if a value is missing or a sensor_id is repeated
+    """
+    with open(file_path, newline='') as f:
+        reader = csv.reader(f)
+        try:
+            header = [column.strip() for column in next(reader)]
+        except StopIteration:
+            raise ValueError("sensor file {} is empty".format(file_path))
+        try:
+            id_column = header.index('sensor_id')
+            group_column = header.index('group_id')
+        except ValueError:
+            raise ValueError(
+                "sensor file should have the columns sensor_id and group_id, "
+                "got {} instead".format(header)) from None
+        n_columns = len(header)
+
+        mapping: Dict[int, str] = dict()
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < n_columns:
+                raise ValueError("sensor file contains missing values")
+            sensor_id = row[id_column].strip()
+            group_id = row[group_column].strip()
+            if not sensor_id or not group_id:
+                raise ValueError("sensor file contains missing values")
+
+            sensor_id = int(sensor_id)
+            if sensor_id in mapping:
+                raise ValueError(
+                    "column 'sensor_id' contains duplicates, not allowed")
+            mapping[sensor_id] = group_id
+
+    return mapping
+
+
+class SensorRegistry(object):
+    """
+    Mapping from sensor id to sensor group read from a CSV file, see
+    read_sensor_groups, that can be used in place of a dict.
+
+    reload reads the file again if it changed and swaps in the new mapping
+    at once, so readers always see either the old or the new mapping. An
+    invalid file is logged and ignored, the previous mapping stays in use.
+    start runs reload periodically from a daemon thread.
+    """
+
+    def __init__(self, file_path, reload_interval=5.0):
+        """
+        Parameters
+        ----------
+        file_path: str
+            path of the CSV file
+
+        reload_interval: float
+            seconds between two checks of the file in the thread
+            started by start, 0 disables the thread
+        """
+        self.file_path = file_path
+        self.reload_interval = reload_interval
+        self.reloads = 0
+        self.__signature = self.__stat()
+        self.mapping: Dict[int, str] = read_sensor_groups(file_path)
+        self.__stopped = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+
+    def __getitem__(self, sensor_id) -> str:
+        return self.mapping[sensor_id]
+
+    def __contains__(self, sensor_id):
+        return sensor_id in self.mapping
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def get(self, sensor_id, default=None):
+        return self.mapping.get(sensor_id, default)
+
+    def items(self):
+        return self.mapping.items()
+
+    def groups(self):
+        """Distinct sensor groups."""
+        return set(self.mapping.values())
+
+    def reload(self) -> bool:
+        """
+        Read the file again if it changed since the last read.
+
+        Returns
+        -------
+        bool
+            True if a new mapping is in use
+        """
+        signature = self.__stat()
+        if signature == self.__signature:
+            return False
+
+        try:
+            mapping = read_sensor_groups(self.file_path)
+        except (OSError, ValueError) as e:
+            logger.error("Ignoring invalid sensor file {}: {}".format(
+                self.file_path, e))
+            return False
+
+        if self.__stat() != signature:
+            # still being written, read it at the next check
+            return False
+
+        self.__signature = signature
+        self.mapping = mapping
+        self.reloads += 1
+        logger.info("Reloaded {} sensors from {}".format(
+            len(mapping), self.file_path))
+        return True
+
+    def start(self):
+        """Check the file for changes every reload_interval seconds."""
+        if self.__thread is not None or self.reload_interval <= 0.0:
+            return
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__watch,
+                                         name='sensor-registry',
+                                         daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def __watch(self):
+        while not self.__stopped.wait(self.reload_interval):
+            self.reload()
+
+    def __stat(self):
+        try:
+            st = os.stat(self.file_path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
@@ -0,0 +1,3 @@
+"""Disk-backed spool of the messages waiting to be produced."""
+
+from .disk_spool import FSYNC_POLICIES, DiskSpool, SpooledQueue
@@ -0,0 +1,424 @@
+"""Append-only spool of records in memory-mapped segment files."""
+
+import collections
+import logging
+import math
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from .. import metrics
+
+logger = logging.getLogger('spool')
+
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+SEGMENT_SUFFIX = '.spool'
+POSITION_FILE = 'position'
+
+# record header: payload length, crc32 of the payload. A zero length marks
+# the end of the records of a segment, segments are created zero filled.
+_RECORD = struct.Struct('<II')
+# committed read position: segment id, offset in the segment
+_POSITION = struct.Struct('<QQ')
+
+
+class DiskSpool(object):
+    """
+    First in, first out spool of byte records on disk.
+
+    Records are appended to fixed size segment files mapped in memory,
+    and a new segment is started when one is full. Reading does not
+    remove a record: task_done marks the oldest record read as processed
+    and stores the read position, and segments with only processed
+    records are deleted. After a crash the spool is opened again from
+    the last stored position, so records read but not processed are
+    read again.
+
+    When the spool holds max_bytes of unprocessed records, new records
+    are dropped and counted, so the disk footprint is bounded.
+    put, get and task_done can be called from different threads, with a
+    single reader.
+    """
+
+    def __init__(self,
+                 directory,
+                 segment_bytes=64 * 2**20,
+                 max_bytes=2**30,
+                 fsync='interval',
+                 fsync_interval=1.0):
+        """
+        Parameters
+        ----------
+        directory: str
+            directory of the segment files, created if missing.
+            Records already in it are read first.
+
+        segment_bytes: int
+            size of a segment file, the largest record is a bit smaller
+
+        max_bytes: int
+            maximum size of the unprocessed records
+
+        fsync: str
+            when appended records and the read position are flushed to
+            disk: 'always' after every change, 'interval' at most every
+            fsync_interval seconds, 'never' leaves it to the OS. Only
+            'always' keeps every record over a power loss, all of them
+            keep the records over a crash of the process.
+
+        fsync_interval: float
+            seconds between two flushes with the 'interval' policy
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("fsync should be one of {}, got {}".format(
+                FSYNC_POLICIES, fsync))
+        if segment_bytes < mmap.PAGESIZE:
+            raise ValueError("segment_bytes should be at least {}, "
+                             "got {} instead".format(mmap.PAGESIZE,
+                                                     segment_bytes))
+        if max_bytes < segment_bytes:
+            raise ValueError(
+                "max_bytes should be at least segment_bytes, "
+                "got {} and {} instead".format(max_bytes, segment_bytes))
+
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.appended = 0
+        self.replayed = 0
+        self.dropped = 0
+
+        self.__lock = threading.Lock()
+        self.__readable = threading.Condition(self.__lock)
+        self.__maps: Dict[int, mmap.mmap] = dict()
+        # offset after the last record of the segments before the last one
+        self.__ends: Dict[int, int] = dict()
+        # (segment, offset after the record) of records read, not processed
+        self.__unacked: Deque[Tuple[int, int]] = collections.deque()
+        self.__last_flush = time.monotonic()
+
+        os.makedirs(directory, exist_ok=True)
+        self.__position = self.__map_file(
+            os.path.join(directory, POSITION_FILE), _POSITION.size)
+        self.__recover()
+        self.__setup_metrics()
+
+    def __setup_metrics(self):
+        self._m_appended = metrics.counter('simpss_spool_appended_total',
+                                           'Records appended to the spool')
+        self._m_replayed = metrics.counter(
+            'simpss_spool_replayed_total', 'Records read back from the spool')
+        self._m_dropped = metrics.counter(
+            'simpss_spool_dropped_total',
+            'Records dropped because the spool was full')
+        metrics.gauge('simpss_spool_bytes',
+                      'Bytes of unprocessed records in the spool'
+                      ).set_function(lambda: self.size_bytes)
+        metrics.gauge('simpss_spool_records',
+                      'Records in the spool not read yet').set_function(
+                          lambda: self.records)
+        metrics.gauge('simpss_spool_segments',
+                      'Segment files of the spool').set_function(
+                          lambda: len(self.__segments))
+
+    def __recover(self):
+        """Find the read position and the end of the stored records."""
+        segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX))
+        read_segment, read_offset = _POSITION.unpack_from(self.__position)
+
+        # segments before the read position were processed already
+        for segment in segments:
+            if segment < read_segment:
+                os.remove(self.__segment_path(segment))
+        segments = [s for s in segments if s >= read_segment]
+        if not segments or segments[0] != read_segment:
+            read_offset = 0
+        if not segments:
+            segments = [read_segment]
+
+        self.__segments = segments
+        self.__read = (segments[0], read_offset)
+        self.__committed = self.__read
+        self.records = 0
+        self.size_bytes = 0
+        offset = read_offset
+        for segment in segments:
+            end, n_records = self.__scan(segment, offset)
+            self.__ends[segment] = end
+            self.records += n_records
+            self.size_bytes += end - offset
+            offset = 0
+        del self.__ends[segments[-1]]
+        self.__write = (segments[-1], end)
+        self.__flushed = end
+        for segment in segments[1:-1]:
+            self.__unmap(segment)
+        if self.records:
+            logger.info("Spool {} holds {} records to replay".format(
+                self.directory, self.records))
+
+    def __scan(self, segment, offset):
+        """Offset after the last valid record of a segment, and the count."""
+        data = self.__map(segment)
+        n_records = 0
+        while True:
+            record = self.__record_at(data, offset)
+            if record is None:
+                return offset, n_records
+            offset += _RECORD.size + len(record)
+            n_records += 1
+
+    def __record_at(self, data, offset) -> Optional[bytes]:
+        """Record at offset, None at the end or at a torn write."""
+        if offset + _RECORD.size > len(data):
+            return None
+        length, crc = _RECORD.unpack_from(data, offset)
+        start = offset + _RECORD.size
+        if length == 0 or start + length > len(data):
+            return None
+        record = data[start:start + length]
+        if zlib.crc32(record) != crc:
+            return None
+        return record
+
+    def put(self, record: bytes) -> bool:
+        """
+        Append a record, without waiting.
+
+        Returns
+        -------
+        bool
+            False if the record was dropped because the spool is full
+        """
+        size = _RECORD.size + len(record)
+        if size > self.segment_bytes:
+            raise ValueError("Record of {} bytes does not fit in a segment "
+                             "of {} bytes".format(len(record),
+                                                  self.segment_bytes))
+
+        with self.__lock:
+            if self.size_bytes + size > self.max_bytes:
+                self.dropped += 1
+                self._m_dropped.inc()
+                if self.dropped % 1000 == 1:
+                    logger.warning("Spool full, {} records dropped".format(
+                        self.dropped))
+                return False
+
+            segment, offset = self.__write
+            if offset + size > self.segment_bytes:
+                self.__flush(force=True)
+                self.__ends[segment] = offset
+                segment, offset = segment + 1, 0
+                self.__segments.append(segment)
+                self.__flushed = 0
+            data = self.__map(segment)
+            _RECORD.pack_into(data, offset, len(record), zlib.crc32(record))
+            data[offset + _RECORD.size:offset + size] = record
+            self.__write = (segment, offset + size)
+
+            self.records += 1
+            self.size_bytes += size
+            self.appended += 1
+            self._m_appended.inc()
+            self.__flush()
+            self.__readable.notify()
+        return True
+
+    def get(self, timeout=None) -> bytes:
+        """
+        Read the next record, waiting up to timeout seconds, forever if
+        None, for one to be appended.
+
+        Raises
+        ------
+        queue.Empty
+            if no record was appended in time
+        """
+        with self.__readable:
+            if not self.__readable.wait_for(lambda: self.records > 0,
+                                            timeout):
+                raise queue.Empty()
+
+            while True:
+                segment, offset = self.__read
+                record = self.__record_at(self.__map(segment), offset)
+                if record is not None:
+                    break
+                if segment == self.__write[0]:
+                    # cannot happen unless the file changed under us
+                    self.records = 0
+                    raise queue.Empty()
+                self.__read = (segment + 1, 0)
+                self.__unmap(segment)
+
+            end = offset + _RECORD.size + len(record)
+            self.__read = (segment, end)
+            self.__unacked.append(self.__read)
+            self.records -= 1
+            self.replayed += 1
+            self._m_replayed.inc()
+            return record
+
+    def get_nowait(self) -> bytes:
+        return self.get(timeout=0)
+
+    def task_done(self):
+        """
+        Mark the oldest record read as processed, storing the read
+        position and deleting the segments it leaves behind.
+        """
+        with self.__lock:
+            if not self.__unacked:
+                raise ValueError("task_done() called too many times")
+            segment, offset = self.__unacked.popleft()
+            previous = self.__committed
+            self.__committed = (segment, offset)
+            self.size_bytes -= self.__size_between(previous,
+                                                   self.__committed)
+            _POSITION.pack_into(self.__position, 0, segment, offset)
+            while self.__segments[0] < segment:
+                old = self.__segments.pop(0)
+                self.__unmap(old)
+                del self.__ends[old]
+                os.remove(self.__segment_path(old))
+            if self.fsync == 'always':
+                self.__position.flush()
+
+    def qsize(self):
+        """Number of records not read yet."""
+        return self.records
+
+    def empty(self):
+        return self.records == 0
+
+    def close(self):
+        """Flush and close the segment files."""
+        with self.__lock:
+            self.__flush(force=True)
+            self.__position.flush()
+            for data in self.__maps.values():
+                data.close()
+            self.__maps.clear()
+            self.__position.close()
+
+    def __size_between(self, start, end):
+        """Bytes of records between two positions, across segments."""
+        if start[0] == end[0]:
+            return end[1] - start[1]
+        # a segment is unused after its last record
+        tail = self.__ends[start[0]] - start[1]
+        middle = sum(self.__ends[s] for s in range(start[0] + 1, end[0]))
+        return tail + middle + end[1]
+
+    def __flush(self, force=False):
+        """Flush the appended records as the fsync policy says."""
+        if self.fsync == 'never':
+            return
+        now = time.monotonic()
+        if (not force and self.fsync == 'interval'
+                and now - self.__last_flush < self.fsync_interval):
+            return
+        segment, end = self.__write
+        start = self.__flushed - self.__flushed % mmap.PAGESIZE
+        if end > start:
+            self.__map(segment).flush(start, end - start)
+        self.__flushed = end
+        if self.fsync == 'interval':
+            self.__position.flush()
+        self.__last_flush = now
+
+    def __map(self, segment) -> mmap.mmap:
+        data = self.__maps.get(segment)
+        if data is None:
+            data = self.__map_file(self.__segment_path(segment),
+                                   self.segment_bytes)
+            self.__maps[segment] = data
+        return data
+
+    def __unmap(self, segment):
+        data = self.__maps.pop(segment, None)
+        if data is not None:
+            if segment == self.__write[0]:
+                # still needed by the writer
+                self.__maps[segment] = data
+                return
+            data.close()
+
+    def __segment_path(self, segment):
+        return os.path.join(self.directory,
+                            '{:020d}{}'.format(segment, SEGMENT_SUFFIX))
+
+    @staticmethod
+    def __map_file(path, size) -> mmap.mmap:
+        """Map a file of size bytes, created zero filled if missing."""
+        with open(path, 'a+b') as f:
+            if os.fstat(f.fileno()).st_size < size:
+                f.truncate(size)
+            return mmap.mmap(f.fileno(), size)
+
+
+class SpooledQueue(object):
+    """
+    Queue of the MqttKafkaProducer, i.e. of (monotonic time, reading,
+    trace time or None) items, kept in a DiskSpool: put never blocks,
+    and items survive a restart of the producer.
+    """
+
+    _HEADER = struct.Struct('<dd')
+
+    def __init__(self, spool: DiskSpool, codec):
+        """
+        Parameters
+        ----------
+        spool: DiskSpool
+            where the items are stored
+
+        codec: object
+            with dumps and loads methods, used to encode the readings
+        """
+        self.spool = spool
+        self.__codec = codec
+
+    def put(self, item: Tuple[float, Dict[str, Any], Optional[float]]):
+        """Append an item, dropping it if the spool is full."""
+        enqueued_at, reading, traced_at = item
+        # wall clock, to measure the wait across restarts
+        spooled_at = time.time() - (time.monotonic() - enqueued_at)
+        header = self._HEADER.pack(
+            spooled_at, math.nan if traced_at is None else traced_at)
+        self.spool.put(header + self.__codec.dumps(reading))
+
+    def get(self, block=True, timeout=None):
+        record = self.spool.get(timeout=timeout if block else 0)
+        spooled_at, traced_at = self._HEADER.unpack_from(record)
+        enqueued_at = time.monotonic() - (time.time() - spooled_at)
+        reading = self.__codec.loads(record[self._HEADER.size:])
+        return (enqueued_at, reading,
+                None if math.isnan(traced_at) else traced_at)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        self.spool.task_done()
+
+    def qsize(self):
+        return self.spool.qsize()
+
+    def empty(self):
+        return self.spool.empty()
+
+    def close(self):
+        self.spool.close()
@@ -0,0 +1,4 @@
+"""Sampled tracing of the readings through the pipeline."""
+
+from .trace import (HOPS, TRACE_HEADER, TRACE_KEY, Sampler, decode_header,
+                    encode_header, find_header, hop_histogram)
@@ -0,0 +1,100 @@
+"""
+Trace timestamps carried by the sampled readings.
+
+The producer stamps a sampled reading when it is received from MQTT and
+when it is produced to Kafka, and sends the stamps in a Kafka header.
+The consumer adds the time it consumed the message and the subscribers
+record the time the reading was stored. Stamps are wall clock seconds
+(time.time()), so the hops between machines are only as accurate as
+their clock synchronization.
+"""
+
+import random
+import struct
+from typing import List, Optional, Tuple
+
+from .. import metrics
+
+# Kafka header with the producer stamps
+TRACE_HEADER = 'simpss-trace'
+
+# key of the decoded message holding its stamps, a dict with the keys
+# 'received', 'produced' and 'consumed'
+TRACE_KEY = '_trace'
+
+HOPS = (
+    'mqtt_to_produce',  # producer queue and encoding
+    'produce_to_broker',  # only with LogAppendTime topics
+    'broker_to_consume',  # only with LogAppendTime topics
+    'produce_to_consume',  # Kafka transit and consumer lag
+    'consume_to_store',  # subscriber queues and Cassandra write
+    'end_to_end',  # from MQTT to Cassandra
+)
+
+# MQTT receive time, produce time
+_STAMPS = struct.Struct('<dd')
+
+
+class Sampler(object):
+    """Decides which messages are traced."""
+
+    def __init__(self, rate=0.0):
+        """
+        Parameters
+        ----------
+        rate: float
+            fraction of the messages to trace, between 0 and 1
+        """
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError(
+                "rate should be between 0 and 1, got {} instead".format(rate))
+        self.rate = rate
+
+    @property
+    def enabled(self):
+        return self.rate > 0.0
+
+    def sample(self) -> bool:
+        """True if the next message should be traced."""
+        if self.rate >= 1.0:
+            return True
+        return self.rate > 0.0 and random.random() < self.rate
+
+
+def encode_header(received: float, produced: float) -> bytes:
+    """Value of the trace header."""
+    return _STAMPS.pack(received, produced)
+
+
+def decode_header(value: bytes) -> Optional[Tuple[float, float]]:
+    """
+    Stamps of a trace header.
+
+    Returns
+    -------
+    Tuple[float, float] or None
+        receive and produce time, None if the header is malformed
+    """
+    if value is None or len(value) != _STAMPS.size:
+        return None
+    return _STAMPS.unpack(value)
+
+
+def find_header(headers: Optional[List[Tuple[str, bytes]]]) -> Optional[bytes]:
+    """Value of the trace header among the headers of a Kafka message."""
+    if not headers:
+        return None
+    for key, value in headers:
+        if key == TRACE_HEADER:
+            return value
+    return None
+
+
+def hop_histogram(hop: str) -> metrics.Histogram:
+    """Histogram of the latency of a hop of the pipeline."""
+    if hop not in HOPS:
+        raise ValueError("hop should be one of {}, got {} instead".format(
+            HOPS, hop))
+    return metrics.histogram('simpss_trace_hop_seconds',
+                             'Latency of the traced messages by hop',
+                             hop=hop)
@@ -1 +1 @@
-from . import custom_logging, kafka_consumer, pub_sub, storage, data_mapping
+from . import custom_logging, kafka_consumer, pub_sub, storage, data_mapping, worker_pool
@@ -1 +1 @@
-from .data_mapper import convert
+from .data_mapper import RowMapper, compile_mapper, convert
@@ -1,5 +1,8 @@
 """Map between the data from the Kafka consumer to the Cassandra db."""
 
+import operator
+from typing import List, Tuple
+
 
 def convert(source, name_map):
     """
@@ -30,3 +33,118 @@ def convert(source, name_map):
         for k_source, k_dest in name_map.items()
     }
     return converted
+
+
+class RowMapper(object):
+    """
+    Mapping compiled from a name mapping, which extracts the values of a
+    source message directly as a tuple ordered like the destination columns.
+
+    Unlike convert it builds no intermediate dict: fields of the source
+    that are not in the mapping are ignored, missing fields raise ValueError.
+    """
+
+    def __init__(self, name_map, converters=None, batch_converters=None):
+        """
+        Parameters
+        ----------
+        name_map: Dict[str, str]
+            mapping of the key names from the source to the destination
+
+        converters: Dict[str, Callable], optional
+            functions applied to the values of some destination columns
+
+        batch_converters: Dict[str, Callable], optional
+            functions applied at once to all the values of a destination
+            column in a batch, taking a list and returning a sequence, or
+            the same list if no value needs converting
+        """
+        if not name_map:
+            raise ValueError("Name mapping should not be empty")
+
+        converters = converters or dict()
+        self.source_keys = list(name_map.keys())
+        self.columns = list(name_map.values())
+        self.__getter = operator.itemgetter(*self.source_keys)
+        self.__single = len(self.source_keys) == 1
+        self.__converters = [(i, converters[column])
+                             for i, column in enumerate(self.columns)
+                             if column in converters]
+        batch_converters = batch_converters or dict()
+        self.__batch_converters = [(i, batch_converters[column])
+                                   for i, column in enumerate(self.columns)
+                                   if column in batch_converters]
+
+    def __call__(self, source) -> Tuple:
+        """
+        Map a source message to the tuple of destination values.
+        """
+        return self.map_batch([source])[0]
+
+    def map_batch(self, sources) -> List[Tuple]:
+        """
+        Map many source messages to tuples of destination values.
+        """
+        try:
+            rows = list(map(self.__getter, sources))
+        except KeyError as e:
+            raise ValueError(
+                "Source message is missing the key {}".format(e)) from None
+
+        if self.__single:
+            rows = [(value, ) for value in rows]
+
+        if self.__converters:
+            converted = []
+            for row in rows:
+                row = list(row)
+                for i, converter in self.__converters:
+                    row[i] = converter(row[i])
+                converted.append(tuple(row))
+            rows = converted
+
+        if not rows:
+            return rows
+
+        changed = []
+        for i, converter in self.__batch_converters:
+            column = [row[i] for row in rows]
+            converted = converter(column)
+            # the same list back means nothing to convert
+            if converted is not column:
+                changed.append((i, converted))
+
+        if changed:
+            columns = list(zip(*rows))
+            for i, converted in changed:
+                columns[i] = converted
+            rows = list(zip(*columns))
+
+        return rows
+
+
+def compile_mapper(name_map, converters=None,
+                   batch_converters=None) -> RowMapper:
+    """
+    Compile a name mapping into a RowMapper.
+
+    Parameters
+    ----------
+    name_map: Dict[str, str]
+        mapping of the key names from the source to the destination message
+
+    converters: Dict[str, Callable], optional
+        functions applied to the values of some destination columns,
+        keyed by destination column name
+
+    batch_converters: Dict[str, Callable], optional
+        functions converting all the values of a destination column in
+        a batch at once, keyed by destination column name
+
+    Returns
+    -------
+    RowMapper
+        callable mapping a source message to a tuple of values ordered
+        like name_map.values()
+    """
+    return RowMapper(name_map, converters, batch_converters)
@@ -1 +1,3 @@
+from .batch_sizer import AdaptiveBatchSizer
 from .consumer import KafkaConsumer
+from .offset_tracker import OffsetTracker
@@ -0,0 +1,119 @@
+"""Adaptive sizing of the batches consumed from Kafka."""
+
+
+class AdaptiveBatchSizer(object):
+    """
+    Chooses how many messages to consume from Kafka at once and how long
+    to wait for them.
+
+    The batch grows while subscribers process it within the latency target
+    and shrinks as soon as they are slower than that. The timeout shrinks
+    when batches come back partially filled, so light traffic is delivered
+    quickly, and grows back to its maximum when no message arrives at all.
+    """
+
+    def __init__(self,
+                 batch_size=10,
+                 timeout=1.0,
+                 adaptive=True,
+                 min_batch_size=1,
+                 max_batch_size=10000,
+                 min_timeout=0.01,
+                 latency_target=0.5,
+                 growth_factor=1.5,
+                 shrink_factor=0.5):
+        """
+        Parameters
+        ----------
+        batch_size: int
+            initial number of messages per consume call
+
+        timeout: float
+            initial and maximum seconds to wait for a batch
+
+        adaptive: bool
+            if False, batch size and timeout never change
+
+        min_batch_size, max_batch_size: int
+            bounds for the batch size
+
+        min_timeout: float
+            lower bound for the timeout, in seconds
+
+        latency_target: float
+            maximum seconds subscribers should take to process a batch
+
+        growth_factor, shrink_factor: float
+            multipliers applied to the batch size when growing or shrinking
+        """
+        if not 1 <= min_batch_size <= batch_size <= max_batch_size:
+            raise ValueError(
+                "Batch sizes should satisfy 1 <= min <= initial <= max, "
+                "got {}, {}, {} instead".format(min_batch_size, batch_size,
+                                                max_batch_size))
+        if not 0.0 < min_timeout <= timeout:
+            raise ValueError(
+                "Timeouts should satisfy 0 < min <= initial, got {} and {} instead"
+                .format(min_timeout, timeout))
+        if growth_factor <= 1.0 or not 0.0 < shrink_factor < 1.0:
+            raise ValueError("growth_factor should be > 1 and shrink_factor "
+                             "should be in (0, 1)")
+
+        self.batch_size = int(batch_size)
+        self.timeout = float(timeout)
+        self.adaptive = adaptive
+        self.min_batch_size = int(min_batch_size)
+        self.max_batch_size = int(max_batch_size)
+        self.min_timeout = float(min_timeout)
+        self.max_timeout = float(timeout)
+        self.latency_target = float(latency_target)
+        self.growth_factor = growth_factor
+        self.shrink_factor = shrink_factor
+
+        self.last_batch_received = 0
+        self.last_processing_time = 0.0
+
+    def update(self, received, processing_time):
+        """
+        Record the outcome of a consume call and choose the next
+        batch size and timeout.
+
+        Parameters
+        ----------
+        received: int
+            number of messages returned by the last consume call
+
+        processing_time: float
+            seconds spent by the subscribers on those messages
+        """
+        self.last_batch_received = received
+        self.last_processing_time = processing_time
+
+        if not self.adaptive:
+            return
+
+        requested = self.batch_size
+        if processing_time > self.latency_target:
+            self.batch_size = max(self.min_batch_size,
+                                  int(self.batch_size * self.shrink_factor))
+        elif received >= requested:
+            self.batch_size = min(
+                self.max_batch_size,
+                max(self.batch_size + 1,
+                    int(self.batch_size * self.growth_factor)))
+
+        if received == 0:
+            self.timeout = min(self.max_timeout, self.timeout * 2.0)
+        elif received < requested:
+            self.timeout = max(self.min_timeout, self.timeout / 2.0)
+
+    def metrics(self):
+        """
+        Current batch size, timeout and outcome of the last batch.
+        """
+        return {
+            'batch_size': self.batch_size,
+            'timeout': self.timeout,
+            'last_batch_received': self.last_batch_received,
+            'last_processing_time': self.last_processing_time,
+        }
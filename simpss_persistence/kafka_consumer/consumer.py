@@ -1,11 +1,18 @@
 """Kafka consumer."""
-import json
+import time
 from typing import Any, Dict, List, Union
 
-from confluent_kafka import Consumer, KafkaError, Message
+from confluent_kafka import (TIMESTAMP_LOG_APPEND_TIME, Consumer, KafkaError,
+                             Message, Producer, TopicPartition)
+
+from simpss_common import metrics, tracing
+from simpss_common.codec import WireFormat, get_codec
+from simpss_common.dead_letter import MALFORMED, DeadLetterQueue
 
 from ..custom_logging import get_logger
-from ..pub_sub import Publisher, Subscriber
+from ..pub_sub import Publisher, QueuedSubscriber, Subscriber
+from .batch_sizer import AdaptiveBatchSizer
+from .offset_tracker import OffsetTracker
 
 
 class KafkaConsumer(Publisher):
@@ -13,7 +20,29 @@ class KafkaConsumer(Publisher):
     Consumer for Kafka, which publishes to all subscribed clients.
     """
 
-    def __init__(self, bootstrap_servers: str, group_id: str):
+    def __init__(self,
+                 bootstrap_servers: str,
+                 group_id: str,
+                 batch_size=10,
+                 timeout=1.0,
+                 adaptive=False,
+                 max_batch_size=10000,
+                 latency_target=0.5,
+                 manual_commit=False,
+                 commit_interval=5.0,
+                 commit_every=1000,
+                 parallel_dispatch=False,
+                 dispatch_queue_size=100,
+                 overflow='block',
+                 spill_dir=None,
+                 codec=None,
+                 trace=False,
+                 dead_letter_topic=None,
+                 dead_letter_batch_size=100,
+                 high_watermark=None,
+                 low_watermark=None,
+                 paused_timeout=0.1,
+                 required_fields=None):
         """
         Kafka consumer class which implements also the Publisher interface.
         Messages consumed from Kafka should be strings representing valid
@@ -26,36 +55,208 @@ class KafkaConsumer(Publisher):
 
         group_id: str
             consumer group id
+
+        batch_size: int
+            number of messages to consume at once (initial value if adaptive)
+
+        timeout: float
+            seconds to wait for a batch (maximum value if adaptive)
+
+        adaptive: bool
+            if True, batch size and timeout are adjusted after every batch,
+            see AdaptiveBatchSizer
+
+        max_batch_size: int
+            upper bound for the batch size in adaptive mode
+
+        latency_target: float
+            seconds the subscribers should take at most to process a batch
+            in adaptive mode
+
+        manual_commit: bool
+            if True, auto commit is disabled and the offset of a partition is
+            committed only after every subscriber acknowledged the messages
+            up to that offset (at-least-once delivery)
+
+        commit_interval: float
+            in manual commit mode, seconds between two commits
+
+        commit_every: int
+            in manual commit mode, number of acknowledged messages that
+            triggers a commit before commit_interval expires
+
+        parallel_dispatch: bool
+            if True, every subscriber gets a bounded queue and a dedicated
+            thread, see QueuedSubscriber
+
+        dispatch_queue_size: int
+            maximum number of batches queued for each subscriber
+
+        overflow: str
+            policy when a subscriber queue is full, one of 'block',
+            'drop-oldest', 'spill'
+
+        spill_dir: str, optional
+            directory of the spill files for the 'spill' policy
+
+        codec: str or JsonCodec, optional
+            JSON codec used to decode the messages, see
+            simpss_common.codec.get_codec. Messages in the binary wire
+            format are always accepted as well.
+
+        trace: bool
+            if True, the stamps in the trace header of the sampled messages
+            are recorded in the per-hop latency histograms and passed to the
+            subscribers under the simpss_common.tracing.TRACE_KEY key,
+            see simpss_common.tracing
+
+        dead_letter_topic: str, optional
+            topic where the messages that cannot be decoded are sent
+            unchanged, in batches of dead_letter_batch_size, with the reason
+            in the headers. If None they are only counted and logged.
+
+        high_watermark: int, optional
+            number of messages outstanding in a subscriber, see
+            Subscriber.outstanding, above which the assigned partitions
+            are paused. Consuming goes on while paused, returning no
+            messages, so the consumer stays in the group. None disables
+            the flow control.
+
+        low_watermark: int, optional
+            number of outstanding messages of every subscriber below which
+            the partitions are resumed, half high_watermark by default
+
+        paused_timeout: float
+            seconds to wait for a consume call while paused
+
+        required_fields: List[str], optional
+            fields every message must have, e.g. the ones mapped to the
+            table columns by the storage. Messages without them are sent
+            to the dead letters instead of the subscribers.
         """
+        if high_watermark is not None:
+            if low_watermark is None:
+                low_watermark = high_watermark // 2
+            if not 0 <= low_watermark < high_watermark:
+                raise ValueError(
+                    "Watermarks should satisfy 0 <= low < high, "
+                    "got {} and {} instead".format(low_watermark,
+                                                   high_watermark))
         self.__logger = get_logger('consumer-{}'.format(group_id))
         self.subscribers: Dict[str, Subscriber] = dict()
         self.running = False
+        self.codec = get_codec(codec)
+        self.wire_format = WireFormat(self.codec)
+        self.trace = trace
+        self.required_fields = tuple(required_fields or ())
+        self.__dlq_producer = None
+        if dead_letter_topic is not None:
+            self.__dlq_producer = Producer(
+                {'bootstrap.servers': bootstrap_servers})
+        self.dead_letters = DeadLetterQueue('consumer',
+                                            send=self.__send_dead_letter,
+                                            topic=dead_letter_topic,
+                                            batch_size=dead_letter_batch_size)
+        self.batch_sizer = AdaptiveBatchSizer(
+            batch_size=batch_size,
+            timeout=timeout,
+            adaptive=adaptive,
+            max_batch_size=max(batch_size, max_batch_size),
+            min_timeout=min(timeout, 0.01),
+            latency_target=latency_target)
+
+        self.manual_commit = manual_commit
+        self.commit_interval = commit_interval
+        self.commit_every = commit_every
+        self.offset_tracker = OffsetTracker()
+        self.__setup_metrics()
+        self.parallel_dispatch = parallel_dispatch
+        self.dispatch_queue_size = dispatch_queue_size
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.__last_commit = time.monotonic()
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.paused_timeout = paused_timeout
+        self.paused = False
+        self.pauses = 0
 
         config = {
             'bootstrap.servers': bootstrap_servers,
             'group.id': group_id,
-            'enable.auto.commit': True,
+            'enable.auto.commit': not manual_commit,
+            'on_commit': self.__on_commit,
             'default.topic.config': {
                 'auto.offset.reset': 'smallest'
             },
         }
         self.kafka = Consumer(config)
 
+    def __setup_metrics(self):
+        self._m_messages = metrics.counter(
+            'simpss_consumer_messages_total', 'Valid messages consumed from Kafka')
+        self._m_errors = metrics.counter('simpss_consumer_errors_total',
+                                         'Errors returned by Kafka')
+        self._m_batch_size = metrics.histogram(
+            'simpss_consumer_batch_size',
+            'Messages returned by a consume call',
+            buckets=(1, 10, 50, 100, 500, 1000, 5000, 10000))
+        self._m_processing = metrics.histogram(
+            'simpss_consumer_batch_processing_seconds',
+            'Seconds spent publishing a consumed batch to the subscribers')
+        metrics.gauge('simpss_consumer_target_batch_size',
+                      'Batch size asked to Kafka').set_function(
+                          lambda: self.batch_sizer.batch_size)
+        metrics.gauge('simpss_consumer_timeout_seconds',
+                      'Timeout of the consume calls').set_function(
+                          lambda: self.batch_sizer.timeout)
+        metrics.gauge('simpss_consumer_pending_batches',
+                      'Batches waiting for acknowledgement').set_function(
+                          lambda: self.offset_tracker.pending_batches)
+        metrics.gauge('simpss_consumer_failed_batches',
+                      'Batches that failed and were consumed again').set_function(
+                          lambda: self.offset_tracker.failed_batches)
+        self._m_pauses = metrics.counter(
+            'simpss_consumer_pauses_total',
+            'Pauses of the partitions because a subscriber was behind')
+        metrics.gauge('simpss_consumer_paused',
+                      '1 if the partitions are paused').set_function(
+                          lambda: int(self.paused))
+        metrics.gauge('simpss_consumer_outstanding_messages',
+                      'Messages not handled yet by the slowest subscriber'
+                      ).set_function(self.outstanding)
+        self._m_hops = {
+            hop: tracing.hop_histogram(hop)
+            for hop in tracing.HOPS
+        }
+
     def kafka_subscribe(self, topic: Union[str, List[str]]):
         if isinstance(topic, list):
-            self.kafka.subscribe(topic)
+            self.kafka.subscribe(topic,
+                                 on_assign=self.__on_assign,
+                                 on_revoke=self.__on_revoke)
         elif isinstance(topic, str):
-            self.kafka.subscribe([topic])
+            self.kafka.subscribe([topic],
+                                 on_assign=self.__on_assign,
+                                 on_revoke=self.__on_revoke)
 
     def start_consuming(self):
         """
         Start consuming messages from Kafka.
         Every consumed message is then passed to all subscribers.
+
+        On KeyboardInterrupt or SystemExit, and on any other error, which
+        is raised again, the consumer is shut down, see on_shutdown.
         """
+        self.running = True
         try:
-            self.running = True
             while self.running:
-                messages = self.kafka.consume(10, timeout=1.0)
+                timeout = self.batch_sizer.timeout
+                if self.paused:
+                    timeout = min(timeout, self.paused_timeout)
+                messages = self.kafka.consume(self.batch_sizer.batch_size,
+                                              timeout=timeout)
+                start = time.monotonic()
 
                 if messages:  # consumed some messages from Kafka
                     valid_messages = []
@@ -66,15 +267,91 @@ class KafkaConsumer(Publisher):
                             if err.code() != KafkaError._PARTITION_EOF:
                                 self.__logger.error("Kafka error {}".format(
                                     message.error().str()))
+                                self._m_errors.inc()
                         else:
                             valid_messages.append(message)
 
                     self.__logger.info("Valid messages: {}".format(
                         len(valid_messages)))
-                    for message in valid_messages:
-                        self.publish(message)
+                    self.publish_batch(valid_messages)
+                    self._m_messages.inc(len(valid_messages))
+
+                received = len(messages) if messages else 0
+                processing_time = time.monotonic() - start
+                if not self.paused or received:
+                    self._m_batch_size.observe(received)
+                    self._m_processing.observe(processing_time)
+                    self.batch_sizer.update(received, processing_time)
+                if self.high_watermark is not None:
+                    self.__apply_backpressure()
+
+                if self.manual_commit:
+                    self.__rewind_failed()
+                    self.__maybe_commit()
+                self.dead_letters.maybe_flush()
+                if self.__dlq_producer is not None:
+                    self.__dlq_producer.poll(0)
         except (KeyboardInterrupt, SystemExit):
-            self.on_shutdown()
+            pass
+        finally:
+            # on errors too: the subscriber threads are stopped and the
+            # group rebalances without waiting for the session timeout
+            if self.running:
+                self.on_shutdown()
+
+    def metrics(self):
+        """
+        Batch size and timeout chosen for consuming, the outcome
+        of the last batch and, with parallel dispatch, the queue
+        metrics of every subscriber.
+        """
+        metrics = self.batch_sizer.metrics()
+        if self.high_watermark is not None:
+            metrics['paused'] = self.paused
+            metrics['outstanding'] = self.outstanding()
+        if self.parallel_dispatch:
+            metrics['subscribers'] = {
+                name: subscriber.metrics()
+                for name, subscriber in self.subscribers.items()
+            }
+        return metrics
+
+    def outstanding(self):
+        """Messages not handled yet by the slowest subscriber."""
+        if not self.subscribers:
+            return 0
+        return max(subscriber.outstanding()
+                   for subscriber in self.subscribers.values())
+
+    def __apply_backpressure(self):
+        """
+        Pause the assigned partitions when a subscriber is above the high
+        watermark, resume them when all are below the low watermark.
+        """
+        outstanding = self.outstanding()
+        if not self.paused and outstanding >= self.high_watermark:
+            self.__set_paused(True, outstanding)
+        elif self.paused and outstanding <= self.low_watermark:
+            self.__set_paused(False, outstanding)
+
+    def __set_paused(self, paused, outstanding):
+        partitions = self.kafka.assignment()
+        try:
+            if paused:
+                self.kafka.pause(partitions)
+            else:
+                self.kafka.resume(partitions)
+        except Exception as e:
+            self.__logger.error("Cannot {} partitions: {}".format(
+                'pause' if paused else 'resume', e))
+            return
+
+        self.paused = paused
+        if paused:
+            self.pauses += 1
+            self._m_pauses.inc()
+        self.__logger.info("{} {} partitions, {} messages outstanding".format(
+            'Paused' if paused else 'Resumed', len(partitions), outstanding))
 
     def add_subscriber(self, sub_obj, sub_name):
         """
@@ -89,6 +366,12 @@ class KafkaConsumer(Publisher):
             name of the subscriber. If already present, raises ValueError
         """
         if sub_name not in self.subscribers:
+            if self.parallel_dispatch:
+                sub_obj = QueuedSubscriber(sub_obj,
+                                           sub_name,
+                                           max_size=self.dispatch_queue_size,
+                                           overflow=self.overflow,
+                                           spill_dir=self.spill_dir)
             self.subscribers[sub_name] = sub_obj
         else:
             raise ValueError(
@@ -109,6 +392,8 @@ class KafkaConsumer(Publisher):
             self.__logger.error(
                 "Trying to remove subscriber with name {}, which does not exist."
                 .format(name))
+        elif isinstance(subscriber, QueuedSubscriber):
+            subscriber.stop()
 
     def publish(self, message: Any):
         """
@@ -119,25 +404,230 @@ class KafkaConsumer(Publisher):
         message: Any
             the message to send
         """
+        if self.manual_commit:
+            self.publish_batch([message])
+            return
+
         # pylint: disable=E1120
-        decoded = self.__decode(message)
+        if self.trace:
+            decoded = self.__decode_traced(message, time.time())
+        else:
+            decoded = self.__decode(message)
         if decoded:  # if it's not None :)
             for _, subscriber in self.subscribers.items():
                 subscriber.receive(decoded)
 
+    def publish_batch(self, messages: List[Any]):
+        """
+        Decode a batch of messages and send it to all subscribers at once.
+
+        Parameters
+        ----------
+        messages: List[Any]
+            the messages to send
+        """
+        if self.trace:
+            consumed_at = time.time()
+            decoded = [
+                self.__decode_traced(message, consumed_at)
+                for message in messages
+            ]
+        else:
+            decoded = [self.__decode(message) for message in messages]
+        decoded = [message for message in decoded if message]
+
+        if not self.manual_commit:
+            if decoded:
+                for _, subscriber in self.subscribers.items():
+                    subscriber.receive_batch(decoded)
+            return
+
+        # the offsets of undecodable messages are committed as well
+        subscribers = list(self.subscribers.values()) if decoded else []
+        batch_id = self.offset_tracker.add_batch(messages, len(subscribers))
+        for subscriber in subscribers:
+            subscriber.receive_batch(decoded, on_done=self.__acker(batch_id))
+
     def __decode(self, message: Message):
         """
-        Decode a message coming from Kafka.
+        Decode a message coming from Kafka, either JSON or binary.
         It will become a Python Dict
         """
         value = message.value()  # can be None, str, bytes
 
         if value:
-            value = json.loads(value, encoding='utf-8')
+            try:
+                decoded = self.wire_format.loads(value)
+            except ValueError as e:
+                self.__dead_letter(message, e)
+                return None
+            if not isinstance(decoded, dict):
+                self.__dead_letter(message, 'not an object')
+                return None
+            missing = [f for f in self.required_fields if f not in decoded]
+            if missing:
+                self.__dead_letter(message,
+                                   'missing fields {}'.format(missing))
+                return None
+            return decoded
+
+        return value
+
+    def __dead_letter(self, message: Message, error):
+        self.dead_letters.add(
+            message.value(), MALFORMED, '{} [{}] @{}: {}'.format(
+                message.topic(), message.partition(), message.offset(),
+                error))
+
+    def __send_dead_letter(self, topic, value, headers):
+        while True:
+            try:
+                self.__dlq_producer.produce(topic, value, headers=headers)
+                return
+            except BufferError:
+                self.__dlq_producer.poll(0.1)
+
+    def __decode_traced(self, message: Message, consumed_at: float):
+        """
+        Decode a message and, if it carries a trace header, record the
+        latency of the hops up to the consumer and attach its stamps.
+        """
+        value = self.__decode(message)
+        if not isinstance(value, dict):
+            return value
+
+        stamps = tracing.decode_header(tracing.find_header(message.headers()))
+        if stamps is None:
+            return value
 
+        received, produced = stamps
+        self._m_hops['mqtt_to_produce'].observe(produced - received)
+        self._m_hops['produce_to_consume'].observe(consumed_at - produced)
+        timestamp_type, timestamp = message.timestamp()
+        if timestamp_type == TIMESTAMP_LOG_APPEND_TIME:
+            appended = timestamp / 1000.0
+            self._m_hops['produce_to_broker'].observe(appended - produced)
+            self._m_hops['broker_to_consume'].observe(consumed_at - appended)
+
+        value[tracing.TRACE_KEY] = {
+            'received': received,
+            'produced': produced,
+            'consumed': consumed_at,
+        }
         return value
 
+    def __acker(self, batch_id):
+        """
+        Create the callback a subscriber calls when it has handled a batch.
+        """
+
+        def on_done(error=None):
+            if error is None:
+                self.offset_tracker.ack(batch_id)
+            else:
+                self.__logger.error(
+                    "Batch {} failed, it will be consumed again: {}".format(
+                        batch_id, error))
+                self.offset_tracker.fail(batch_id)
+
+        return on_done
+
+    def __rewind_failed(self):
+        """
+        Seek the partitions of the failed batches back to their first
+        offset, so they are consumed and handed to the subscribers again.
+        The batches that followed are consumed again as well.
+
+        If a seek fails the error is raised and stops the consumer: the
+        offsets of the partition are not committed past the failed batch,
+        so it is consumed again after a restart.
+        """
+        rewinds = self.offset_tracker.pop_failed()
+        for (topic, partition), offset in rewinds.items():
+            try:
+                self.kafka.seek(TopicPartition(topic, partition, offset))
+            except Exception as e:
+                self.__logger.error("Cannot seek {} [{}] to {}: {}".format(
+                    topic, partition, offset, e))
+                raise
+            self.__logger.warning(
+                "Consuming {} [{}] again from offset {}".format(
+                    topic, partition, offset))
+
+    def __maybe_commit(self):
+        """
+        Commit the acknowledged offsets if enough time has passed or
+        enough messages have been acknowledged since the last commit.
+        """
+        now = time.monotonic()
+        if (now - self.__last_commit < self.commit_interval and
+                self.offset_tracker.acked_messages < self.commit_every):
+            return
+
+        self.__last_commit = now
+        self.commit(asynchronous=True)
+
+    def commit(self, asynchronous=True):
+        """
+        Commit the offsets acknowledged by all subscribers.
+        Only meaningful in manual commit mode.
+        """
+        committable = self.offset_tracker.pop_committable()
+        if not committable:
+            return
+
+        offsets = [
+            TopicPartition(topic, partition, offset)
+            for (topic, partition), offset in committable.items()
+        ]
+        try:
+            self.kafka.commit(offsets=offsets, asynchronous=asynchronous)
+        except Exception as e:
+            self.__logger.error("Offset commit failed: {}".format(e))
+
+    def __on_commit(self, err, partitions):
+        """
+        Called by the Kafka client with the result of a commit.
+        """
+        if err is not None:
+            self.__logger.error("Offset commit failed: {}".format(err))
+        else:
+            self.__logger.debug("Committed offsets {}".format(partitions))
+
+    def __on_assign(self, consumer, partitions):
+        """
+        Called with the partitions assigned by a rebalance: they are
+        paused right away if the others are.
+        """
+        consumer.assign(partitions)
+        if self.paused:
+            consumer.pause(partitions)
+
+    def __on_revoke(self, consumer, partitions):
+        """
+        Called before the partitions are reassigned by a rebalance:
+        commit what has been acknowledged and forget the rest, it will be
+        delivered again to the new owner.
+        """
+        if not self.manual_commit:
+            return
+
+        self.commit(asynchronous=False)
+        self.offset_tracker.forget([(p.topic, p.partition)
+                                    for p in partitions])
+
     def on_shutdown(self):
         self.running = False
+        if self.manual_commit or self.parallel_dispatch:
+            for _, subscriber in self.subscribers.items():
+                subscriber.flush()
+        if self.manual_commit:
+            self.commit(asynchronous=False)
+        if self.parallel_dispatch:
+            for _, subscriber in self.subscribers.items():
+                subscriber.stop()
+        self.dead_letters.flush()
+        if self.__dlq_producer is not None:
+            self.__dlq_producer.flush(5)
         self.subscribers = None
         self.kafka.close()
@@ -0,0 +1,177 @@
+"""Tracking of the Kafka offsets acknowledged by all subscribers."""
+
+import collections
+import threading
+from typing import Any, Deque, Dict, List, Tuple
+
+
+class OffsetTracker(object):
+    """
+    Keeps track of the batches handed to subscribers and tells which
+    offsets can be committed.
+
+    Every batch must be acknowledged by all the subscribers it was sent to.
+    The offset of a partition advances only over a contiguous prefix of
+    acknowledged batches, so a slow batch holds back the commit of every
+    later batch of the same partition (at-least-once delivery). A failed
+    batch is dropped together with the later batches of its partitions
+    by pop_failed, which tells where to consume them again from.
+
+    Acknowledgements can arrive from any thread.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__next_id = 0
+        # batch id -> [missing acks, failed, number of messages,
+        #              {(topic, partition): (min offset, max offset)}]
+        self.__batches: Dict[int, List[Any]] = dict()
+        self.__partitions: Dict[Tuple[str, int], Deque[int]] = dict()
+        self.__acked_messages = 0
+        self.failed_batches = 0
+
+    def add_batch(self, messages, acks_needed) -> int:
+        """
+        Register a batch of Kafka messages.
+
+        Parameters
+        ----------
+        messages: List[confluent_kafka.Message]
+            the messages of the batch
+
+        acks_needed: int
+            number of subscribers that must acknowledge the batch
+
+        Returns
+        -------
+        int
+            id of the batch, to be passed to ack or fail
+        """
+        offsets: Dict[Tuple[str, int], Tuple[int, int]] = dict()
+        for message in messages:
+            key = (message.topic(), message.partition())
+            offset = message.offset()
+            first, last = offsets.get(key, (offset, offset))
+            offsets[key] = (min(first, offset), max(last, offset))
+
+        with self.__lock:
+            batch_id = self.__next_id
+            self.__next_id += 1
+            if acks_needed <= 0:
+                self.__acked_messages += len(messages)
+            if not offsets:
+                return batch_id
+
+            self.__batches[batch_id] = [
+                acks_needed, False, len(messages), offsets
+            ]
+            for key in offsets:
+                self.__partitions.setdefault(key,
+                                             collections.deque()).append(batch_id)
+
+        return batch_id
+
+    def ack(self, batch_id):
+        """
+        Acknowledge a batch on behalf of one subscriber.
+        Unknown batches (e.g. of revoked partitions) are ignored.
+        """
+        with self.__lock:
+            batch = self.__batches.get(batch_id)
+            if batch is None:
+                return
+            batch[0] -= 1
+            if batch[0] == 0:
+                self.__acked_messages += batch[2]
+
+    def fail(self, batch_id):
+        """
+        Mark a batch as failed, its offsets will not be committed
+        and it has to be consumed again, see pop_failed.
+        """
+        with self.__lock:
+            batch = self.__batches.get(batch_id)
+            if batch is not None and not batch[1]:
+                batch[1] = True
+                self.failed_batches += 1
+
+    @property
+    def acked_messages(self):
+        """Messages fully acknowledged since the last pop_committable."""
+        return self.__acked_messages
+
+    @property
+    def pending_batches(self):
+        """Number of batches whose offsets have not been released yet."""
+        return len(self.__batches)
+
+    def pop_committable(self) -> Dict[Tuple[str, int], int]:
+        """
+        Release the batches acknowledged so far.
+
+        Returns
+        -------
+        Dict[Tuple[str, int], int]
+            for every partition that advanced, the offset to commit,
+            i.e. the offset of the next message to consume
+        """
+        committable: Dict[Tuple[str, int], int] = dict()
+        with self.__lock:
+            for key, batch_ids in self.__partitions.items():
+                while batch_ids:
+                    batch = self.__batches[batch_ids[0]]
+                    if batch[0] > 0 or batch[1]:
+                        break
+                    committable[key] = batch[3].pop(key)[1] + 1
+                    if not batch[3]:
+                        del self.__batches[batch_ids[0]]
+                    batch_ids.popleft()
+            self.__acked_messages = 0
+
+        return committable
+
+    def pop_failed(self) -> Dict[Tuple[str, int], int]:
+        """
+        Drop the first failed batch of every partition together with the
+        batches that follow it, which are consumed again anyway.
+
+        Returns
+        -------
+        Dict[Tuple[str, int], int]
+            for every partition with a failed batch, the offset to seek to,
+            i.e. the first offset of the failed batch
+        """
+        rewinds: Dict[Tuple[str, int], int] = dict()
+        with self.__lock:
+            for key, batch_ids in self.__partitions.items():
+                for i, batch_id in enumerate(batch_ids):
+                    batch = self.__batches[batch_id]
+                    if batch[1]:
+                        rewinds[key] = batch[3][key][0]
+                        break
+                else:
+                    continue
+
+                while len(batch_ids) > i:
+                    self.__drop(batch_ids.pop(), key)
+
+        return rewinds
+
+    def __drop(self, batch_id, key):
+        """Remove a partition from a batch, and the batch if it was the last."""
+        batch = self.__batches.get(batch_id)
+        if batch is None:
+            return
+        batch[3].pop(key, None)
+        if not batch[3]:
+            del self.__batches[batch_id]
+
+    def forget(self, partitions: List[Tuple[str, int]]):
+        """
+        Drop every batch of the given partitions, e.g. after they
+        have been revoked by a rebalance.
+        """
+        with self.__lock:
+            for key in partitions:
+                for batch_id in self.__partitions.pop(key, ()):
+                    self.__drop(batch_id, key)
@@ -1 +1,2 @@
 from .interface import Publisher, Subscriber
+from .queued_subscriber import QueueOverflowError, QueuedSubscriber
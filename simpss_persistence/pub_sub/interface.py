@@ -1,7 +1,7 @@
 """Interface for publishers."""
 
 from abc import ABC, abstractmethod
-from typing import Any
+from typing import Any, List
 
 
 class Publisher(ABC):
@@ -21,6 +21,14 @@ class Publisher(ABC):
     def publish(self, message: Any):
         raise NotImplementedError
 
+    def publish_batch(self, messages: List[Any]):
+        """
+        Send many messages to all subscribers.
+        Defaults to publishing them one at a time.
+        """
+        for message in messages:
+            self.publish(message)
+
 
 class Subscriber(ABC):
     """
@@ -38,3 +46,32 @@ class Subscriber(ABC):
     @abstractmethod
     def receive(self, message: Any):
         raise NotImplementedError
+
+    def receive_batch(self, messages: List[Any], on_done=None):
+        """
+        Receive many messages at once.
+        Defaults to receiving them one at a time, override it
+        in subscribers that can handle a whole batch.
+
+        on_done, if given, must be called once the batch has been
+        durably handled: on_done() on success, on_done(error) on failure.
+        """
+        for message in messages:
+            self.receive(message)
+        if on_done is not None:
+            on_done()
+
+    def outstanding(self) -> int:
+        """
+        Number of received messages not handled yet, used by the publisher
+        to stop sending while a subscriber is behind.
+        Subscribers that handle messages synchronously have none.
+        """
+        return 0
+
+    def flush(self, timeout=None):
+        """
+        Wait until all the received messages have been handled.
+        Subscribers that handle messages synchronously have nothing to wait for.
+        """
+        return True
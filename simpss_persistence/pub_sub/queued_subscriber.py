@@ -0,0 +1,281 @@
+"""Subscriber wrapper delivering messages from a dedicated thread."""
+
+import collections
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from typing import Any, List
+
+from simpss_common import metrics
+
+from ..custom_logging import get_logger
+from .interface import Publisher, Subscriber
+
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'spill')
+
+
+class QueueOverflowError(Exception):
+    """A batch was dropped because the subscriber queue was full."""
+
+
+class QueuedSubscriber(Subscriber):
+    """
+    Wraps a subscriber with a bounded queue and a worker thread, so that
+    a slow subscriber does not stall the publisher or the other subscribers.
+
+    When the queue is full the overflow policy decides what happens:
+    - 'block': the publisher waits for a free slot
+    - 'drop-oldest': the oldest queued batch is discarded, its on_done is
+      called with a QueueOverflowError
+    - 'spill': batches are appended to a file on disk and delivered, in
+      order, once the queue has been drained
+    """
+
+    def __init__(self,
+                 subscriber: Subscriber,
+                 name: str,
+                 max_size=100,
+                 overflow='block',
+                 spill_dir=None):
+        """
+        Parameters
+        ----------
+        subscriber: Subscriber
+            the wrapped subscriber
+
+        name: str
+            name of the subscriber, used for the thread and the logger
+
+        max_size: int
+            maximum number of batches in the queue
+
+        overflow: str
+            one of 'block', 'drop-oldest', 'spill'
+
+        spill_dir: str, optional
+            directory for the spill file, defaults to the system temp dir
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow should be one of {}, got {} instead".
+                             format(OVERFLOW_POLICIES, overflow))
+
+        self.subscriber = subscriber
+        self.sub_name = name
+        self.overflow = overflow
+        self.__logger = get_logger('queued-{}'.format(name))
+        self.__queue: queue.Queue = queue.Queue(maxsize=max_size)
+
+        self.processed = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.lag = 0.0
+        metrics.gauge('simpss_subscriber_queue_depth',
+                      'Batches waiting in the subscriber queue',
+                      subscriber=name).set_function(lambda: self.depth)
+        metrics.gauge('simpss_subscriber_lag_seconds',
+                      'Seconds the last delivered batch waited in the queue',
+                      subscriber=name).set_function(lambda: self.lag)
+        self._m_dropped = metrics.counter(
+            'simpss_subscriber_dropped_batches_total',
+            'Batches dropped because the subscriber queue was full',
+            subscriber=name)
+        self._m_spilled = metrics.counter(
+            'simpss_subscriber_spilled_batches_total',
+            'Batches spilled to disk because the subscriber queue was full',
+            subscriber=name)
+
+        # guards the spill, signalled when a batch is queued or spilled
+        self.__spill_ready = threading.Condition()
+        self.__spill_pending: collections.deque = collections.deque()
+        self.__spill_file = None
+        self.__spill_read_pos = 0
+        if overflow == 'spill':
+            self.__spill_file = tempfile.TemporaryFile(
+                mode='w+', prefix='spill-{}-'.format(name), dir=spill_dir)
+
+        self.__idle = threading.Condition()
+        self.__busy = 0
+        self.__outstanding = 0
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__work,
+                                         name='dispatch-{}'.format(name),
+                                         daemon=True)
+        self.__thread.start()
+
+    def set_subscriber_name(self, name):
+        self.sub_name = name
+
+    def subscribe(self, publisher: Publisher):
+        publisher.add_subscriber(self, self.sub_name)
+
+    def receive(self, message: Any):
+        self.receive_batch([message])
+
+    def receive_batch(self, messages: List[Any], on_done=None):
+        """
+        Enqueue a batch for the worker thread, applying the
+        overflow policy if the queue is full.
+        """
+        with self.__idle:
+            self.__busy += 1
+            self.__outstanding += len(messages)
+        item = (time.monotonic(), messages, on_done)
+
+        if self.overflow == 'block':
+            self.__queue.put(item)
+        elif self.overflow == 'drop-oldest':
+            self.__put_dropping(item)
+        else:
+            self.__put_spilling(item)
+
+    def flush(self, timeout=None):
+        """
+        Wait until every queued and spilled batch has been delivered,
+        then flush the wrapped subscriber.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.__idle:
+            if not self.__idle.wait_for(lambda: self.__busy == 0,
+                                        timeout=timeout):
+                return False
+        remaining = None if deadline is None else max(
+            0.0, deadline - time.monotonic())
+        return self.subscriber.flush(remaining)
+
+    def stop(self):
+        """Stop the worker thread after the queued batches are delivered."""
+        self.__running = False
+        with self.__idle:
+            self.__busy += 1
+        if self.__spill_file is None:
+            self.__queue.put(None)
+        else:
+            # the worker ends once the queue and the spill are empty
+            with self.__spill_ready:
+                self.__spill_ready.notify()
+        self.__thread.join()
+        if self.__spill_file is not None:
+            self.__spill_file.close()
+
+    def outstanding(self):
+        """
+        Messages queued, spilled or being delivered, plus the ones the
+        wrapped subscriber has not handled yet.
+        """
+        return self.__outstanding + self.subscriber.outstanding()
+
+    @property
+    def depth(self):
+        """Number of batches waiting to be delivered."""
+        return self.__queue.qsize() + len(self.__spill_pending)
+
+    def metrics(self):
+        """
+        Queue depth, seconds the last delivered batch waited in the queue,
+        and the counters of delivered, dropped and spilled batches.
+        """
+        return {
+            'depth': self.depth,
+            'lag': self.lag,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'spilled': self.spilled,
+        }
+
+    def __put_dropping(self, item):
+        while True:
+            try:
+                self.__queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            try:
+                _, dropped, dropped_on_done = self.__queue.get_nowait()
+            except queue.Empty:
+                continue
+            self.dropped += 1
+            self._m_dropped.inc()
+            self.__logger.warning("Queue full, dropped the oldest batch")
+            if dropped_on_done is not None:
+                dropped_on_done(QueueOverflowError(self.sub_name))
+            self.__done(len(dropped))
+
+    def __put_spilling(self, item):
+        with self.__spill_ready:
+            self.__spill_ready.notify()
+            # once spilling started, keep spilling to preserve the order
+            if not self.__spill_pending:
+                try:
+                    self.__queue.put_nowait(item)
+                    return
+                except queue.Full:
+                    pass
+
+            enqueued_at, messages, on_done = item
+            self.__spill_file.seek(0, os.SEEK_END)
+            self.__spill_file.write(json.dumps(messages) + '\n')
+            self.__spill_pending.append((enqueued_at, on_done))
+            self.spilled += 1
+            self._m_spilled.inc()
+
+    def __next_item(self):
+        """
+        Next batch to deliver: queued batches come first, as they are
+        older than every spilled one. With a spill, None once stop was
+        called and both the queue and the spill are empty.
+        """
+        if self.__spill_file is None:
+            return self.__queue.get()
+
+        with self.__spill_ready:
+            while True:
+                try:
+                    return self.__queue.get_nowait()
+                except queue.Empty:
+                    pass
+                if self.__spill_pending:
+                    break
+                if not self.__running:
+                    return None
+                self.__spill_ready.wait()
+
+            self.__spill_file.seek(self.__spill_read_pos)
+            line = self.__spill_file.readline()
+            self.__spill_read_pos = self.__spill_file.tell()
+            enqueued_at, on_done = self.__spill_pending.popleft()
+            if not self.__spill_pending:
+                self.__spill_file.seek(0)
+                self.__spill_file.truncate()
+                self.__spill_read_pos = 0
+        return enqueued_at, json.loads(line), on_done
+
+    def __work(self):
+        while True:
+            item = self.__next_item()
+            if item is None:
+                self.__done()
+                if not self.__running:
+                    return
+                continue
+
+            enqueued_at, messages, on_done = item
+            self.lag = time.monotonic() - enqueued_at
+            try:
+                self.subscriber.receive_batch(messages, on_done=on_done)
+            except Exception as e:
+                self.__logger.error(
+                    "Subscriber {} failed on a batch: {}".format(
+                        self.sub_name, e))
+                if on_done is not None:
+                    on_done(e)
+            self.processed += 1
+            self.__done(len(messages))
+
+    def __done(self, n_messages=0):
+        with self.__idle:
+            self.__busy -= 1
+            self.__outstanding -= n_messages
+            self.__idle.notify_all()
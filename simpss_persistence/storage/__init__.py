@@ -1,3 +1,5 @@
 """Storage package."""
 
 from .cassandra_storage import CassandraStorage
+from .schema import (BUCKET_COLUMN, compaction_window, sensor_data_table,
+                     time_buckets, to_epoch_ms)
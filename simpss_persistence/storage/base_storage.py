@@ -26,3 +26,10 @@ class BaseStorage(ABC):
     @abstractmethod
     def insert_row(self, row: Dict[str, Any]):
         raise NotImplementedError
+
+    def flush(self, timeout=None):
+        """
+        Wait for pending writes to complete.
+        Synchronous backends have nothing to wait for.
+        """
+        return True
@@ -2,16 +2,21 @@
 
 import datetime
 import logging
+import threading
 import time
 import warnings
 from typing import Any, Dict, List, Tuple
 
 from cassandra import cluster as cc
+from cassandra.query import BatchStatement, BatchType
+
+from simpss_common import metrics, tracing
 
 from ..custom_logging import get_logger
-from ..data_mapping import convert
+from ..data_mapping import compile_mapper
 from ..pub_sub import Publisher, Subscriber
 from .base_storage import BaseStorage
+from .schema import BUCKET_COLUMN, compaction_window, time_buckets
 
 
 class CassandraStorage(BaseStorage, Subscriber):
@@ -33,10 +38,80 @@ class CassandraStorage(BaseStorage, Subscriber):
     WARNING: it only works for compound primary keys in Cassandra!!!
     """
 
-    def __init__(self, cluster: cc.Cluster):
+    def __init__(self,
+                 cluster: cc.Cluster,
+                 async_writes=False,
+                 max_in_flight=128,
+                 batch_max_rows=50,
+                 batch_max_bytes=5 * 1024,
+                 time_bucket_seconds=None):
+        """
+        Parameters
+        ----------
+        cluster: cassandra.cluster.Cluster
+            the cluster to connect to
+
+        async_writes: bool
+            if True, rows are written with execute_async and insert_row
+            returns as soon as the request is sent. Call flush to wait
+            for all the outstanding writes.
+
+        max_in_flight: int
+            maximum number of concurrent asynchronous writes. When the window
+            is full, insert_row blocks until a write completes.
+
+        batch_max_rows: int
+            maximum number of rows in a single batch written by insert_rows
+
+        batch_max_bytes: int
+            approximate maximum size in bytes of the values in a single batch.
+            The default matches Cassandra's batch_size_warn_threshold_in_kb.
+
+        time_bucket_seconds: int, optional
+            width of the time buckets of a bucketed table, see
+            schema.sensor_data_table, a positive multiple of 60. The
+            time_bucket column is computed from the time_received column.
+            None for tables without it.
+        """
+        if max_in_flight < 1:
+            raise ValueError(
+                "max_in_flight should be at least 1, got {} instead".format(
+                    max_in_flight))
+        if batch_max_rows < 1 or batch_max_bytes < 1:
+            raise ValueError(
+                "batch limits should be positive, got {} rows and {} bytes".
+                format(batch_max_rows, batch_max_bytes))
+        if time_bucket_seconds is not None:
+            # the buckets must match a table schema.sensor_data_table can
+            # create, which raises for the widths it cannot compact
+            compaction_window(time_bucket_seconds)
+
         self.cluster = cluster
         self.__logger = get_logger(name='CassandraStorage')
 
+        self.async_writes = async_writes
+        self.max_in_flight = max_in_flight
+        self.batch_max_rows = batch_max_rows
+        self.batch_max_bytes = batch_max_bytes
+        self.time_bucket_seconds = time_bucket_seconds
+        self.write_errors = 0
+        self.__in_flight = 0
+        self.__rows_in_flight = 0
+        self.__in_flight_cv = threading.Condition()
+
+        self._m_write_seconds = metrics.histogram(
+            'simpss_cassandra_write_seconds',
+            'Latency of the writes sent to Cassandra')
+        self._m_rows = metrics.counter('simpss_cassandra_rows_written_total',
+                                       'Rows written to Cassandra')
+        self._m_errors = metrics.counter('simpss_cassandra_write_errors_total',
+                                         'Writes to Cassandra that failed')
+        metrics.gauge('simpss_cassandra_writes_in_flight',
+                      'Asynchronous writes not yet completed').set_function(
+                          lambda: self.__in_flight)
+        self._m_consume_to_store = tracing.hop_histogram('consume_to_store')
+        self._m_end_to_end = tracing.hop_histogram('end_to_end')
+
     def connect(self):
         """Connect to storage backend."""
         self.__logger.info("Connecting cluster")
@@ -44,7 +119,8 @@ class CassandraStorage(BaseStorage, Subscriber):
         self.__logger.info("Connected")
 
     def disconnect(self):
-        """Disconnect gracefully."""
+        """Disconnect gracefully, waiting for outstanding writes."""
+        self.flush()
         self.__logger.info("Disconnecting from cluster")
         self.session.shutdown()
         self.__logger.info("Disconnected. Goodbye.")
@@ -70,22 +146,264 @@ class CassandraStorage(BaseStorage, Subscriber):
         """
         self.mapping = data_to_db_mapping
         self.__columns = [v for _, v in data_to_db_mapping.items()]
+        self.__mapper = compile_mapper(
+            data_to_db_mapping,
+            batch_converters={'time_received': _parse_timestamps})
+        if self.time_bucket_seconds is not None:
+            if 'time_received' not in self.__columns:
+                raise ValueError(
+                    "A time_received column is needed for time buckets")
+            self.__time_index = self.__columns.index('time_received')
+            self.__columns.append(BUCKET_COLUMN)
         self.__prepare_statement(self.__columns)
 
+    def __map_batch(self, rows):
+        """Table values of the rows, with their time bucket if any."""
+        all_values = self.__mapper.map_batch(rows)
+        if self.time_bucket_seconds is None:
+            return all_values
+        buckets = time_buckets([v[self.__time_index] for v in all_values],
+                               self.time_bucket_seconds * 1000)
+        return [
+            values + (bucket, )
+            for values, bucket in zip(all_values, buckets)
+        ]
+
     def insert_row(self, row: Dict[str, Any]):
         """
         Insert a row into Cassandra. The row should have the right column names
         already defined, else an error from the database will be raised.
         """
-        converted_row = convert(row, self.mapping)
-        timestamp = converted_row.get('time_received', None)
-        if timestamp:
-            converted_row['time_received'] = datetime.datetime.fromisoformat(
-                timestamp)
-        values = tuple(
-            converted_row.get(column, None) for column in self.__columns)
+        values = self.__map_batch([row])[0]
+        trace = row.get(tracing.TRACE_KEY)
+
+        if self.async_writes:
+            completion = None
+            if trace is not None:
+                completion = _Completion(1, self.__traced([trace]))
+            self.__execute_async(self.__statement, values, completion)
+        else:
+            self.__execute(self.__statement, values)
+            if trace is not None:
+                self.__record_traces([trace])
+
+    def insert_rows(self, rows: List[Dict[str, Any]], on_done=None):
+        """
+        Insert many rows into Cassandra using UNLOGGED batches.
+
+        Rows are grouped by partition key, so that every batch touches a
+        single partition and is handled by one coordinator. Batches are
+        split when they exceed batch_max_rows or batch_max_bytes.
+
+        Parameters
+        ----------
+        rows: List[Dict[str, Any]]
+            the rows to insert
+
+        on_done: callable, optional
+            called as on_done() when all the rows have been written, or
+            as on_done(error) on the first failed write, or if a row
+            cannot be mapped to the table columns. Without it the error
+            is raised.
+        """
+        key_indexes = self.__statement.routing_key_indexes
+        try:
+            all_values = self.__map_batch(rows)
+        except Exception as e:
+            if on_done is None:
+                raise
+            on_done(e)
+            return
+        traces = [
+            row[tracing.TRACE_KEY] for row in rows if tracing.TRACE_KEY in row
+        ]
+        if not key_indexes:
+            # partition key not bound by the statement, cannot group
+            statements = [(self.__statement, values, 1)
+                          for values in all_values]
+        else:
+            partitions: Dict[Tuple, List[Tuple]] = dict()
+            for values in all_values:
+                key = tuple(values[i] for i in key_indexes)
+                partitions.setdefault(key, []).append(values)
+
+            statements = [(batch, None, n_rows)
+                          for partition_rows in partitions.values()
+                          for batch, n_rows in self.__make_batches(
+                              partition_rows)]
+
+        if not self.async_writes:
+            try:
+                for statement, values, n_rows in statements:
+                    self.__execute(statement, values, n_rows)
+            except Exception as e:
+                if on_done is None:
+                    raise
+                on_done(e)
+            else:
+                if traces:
+                    self.__record_traces(traces)
+                if on_done is not None:
+                    on_done()
+            return
+
+        if traces:
+            on_done = self.__traced(traces, on_done)
+        completion = _Completion(len(statements), on_done)
+        for statement, values, n_rows in statements:
+            self.__execute_async(statement, values, completion, n_rows)
+
+    def __traced(self, traces, on_done=None):
+        """
+        Wrap on_done to record the latency of the traced rows
+        once their writes succeeded.
+        """
+
+        def traced_on_done(error=None):
+            if error is None:
+                self.__record_traces(traces)
+            if on_done is None:
+                return
+            if error is None:
+                on_done()
+            else:
+                on_done(error)
+
+        return traced_on_done
+
+    def __record_traces(self, traces):
+        """Record the last hop and the total latency of stored rows."""
+        stored_at = time.time()
+        for trace in traces:
+            self._m_consume_to_store.observe(stored_at - trace['consumed'])
+            self._m_end_to_end.observe(stored_at - trace['received'])
+
+    def __make_batches(self, rows: List[Tuple]):
+        """
+        Split the rows of a single partition into UNLOGGED batches
+        respecting the size limits, together with their number of rows.
+        """
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        batch_rows = 0
+        batch_bytes = 0
+        for values in rows:
+            size = _estimate_size(values)
+            if batch_rows > 0 and (batch_rows >= self.batch_max_rows or
+                                   batch_bytes + size > self.batch_max_bytes):
+                yield batch, batch_rows
+                batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                batch_rows = 0
+                batch_bytes = 0
+
+            batch.add(self.__statement, values)
+            batch_rows += 1
+            batch_bytes += size
+
+        if batch_rows > 0:
+            yield batch, batch_rows
+
+    def flush(self, timeout=None):
+        """
+        Wait for all the outstanding asynchronous writes to complete.
+
+        Parameters
+        ----------
+        timeout: float, optional
+            maximum number of seconds to wait, None waits forever
+
+        Returns
+        -------
+        bool
+            True if there are no more writes in flight, False if the
+            timeout expired first.
+        """
+        with self.__in_flight_cv:
+            return self.__in_flight_cv.wait_for(lambda: self.__in_flight == 0,
+                                                timeout=timeout)
+
+    @property
+    def in_flight(self):
+        """Number of asynchronous writes not yet completed."""
+        return self.__in_flight
 
-        self.session.execute(self.__statement, values)
+    def outstanding(self):
+        """Number of rows of the asynchronous writes not yet completed."""
+        return self.__rows_in_flight
+
+    def __execute(self, statement, values=None, n_rows=1):
+        """Send a write and wait for its result."""
+        start = time.monotonic()
+        try:
+            self.session.execute(statement, values)
+        except Exception:
+            self.write_errors += 1
+            self._m_errors.inc()
+            raise
+        finally:
+            self._m_write_seconds.observe(time.monotonic() - start)
+        self._m_rows.inc(n_rows)
+
+    def __execute_async(self,
+                        statement,
+                        values=None,
+                        completion=None,
+                        n_rows=1):
+        """
+        Send a write without waiting for its result, blocking only
+        if the window of in-flight requests is full.
+        """
+        with self.__in_flight_cv:
+            while self.__in_flight >= self.max_in_flight:
+                self.__in_flight_cv.wait()
+            self.__in_flight += 1
+            self.__rows_in_flight += n_rows
+
+        start = time.monotonic()
+        try:
+            future = self.session.execute_async(statement, values)
+        except Exception as e:
+            self._m_errors.inc()
+            if completion is None:
+                self.__release_slot(n_rows, failed=True)
+                raise
+            completion.failure(e)
+            self.__release_slot(n_rows, failed=True)
+            return
+
+        future.add_callbacks(callback=self.__on_write_success,
+                             callback_args=(completion, start, n_rows),
+                             errback=self.__on_write_error,
+                             errback_args=(completion, start, n_rows))
+
+    def __on_write_success(self, _result, completion=None, start=None,
+                           n_rows=1):
+        """Called by the driver event loop when a write succeeds."""
+        if start is not None:
+            self._m_write_seconds.observe(time.monotonic() - start)
+        self._m_rows.inc(n_rows)
+        # on_done runs before the slot is released, so flush returns
+        # only after every callback of the completed writes
+        if completion is not None:
+            completion.success()
+        self.__release_slot(n_rows)
+
+    def __on_write_error(self, exc, completion=None, start=None, n_rows=1):
+        """Called by the driver event loop when a write fails."""
+        if start is not None:
+            self._m_write_seconds.observe(time.monotonic() - start)
+        self._m_errors.inc()
+        self.__logger.error("Asynchronous write failed: {}".format(exc))
+        if completion is not None:
+            completion.failure(exc)
+        self.__release_slot(n_rows, failed=True)
+
+    def __release_slot(self, n_rows=1, failed=False):
+        with self.__in_flight_cv:
+            if failed:
+                self.write_errors += 1
+            self.__in_flight -= 1
+            self.__rows_in_flight -= n_rows
+            self.__in_flight_cv.notify_all()
 
     def __prepare_statement(self, columns):
         """
@@ -127,3 +445,83 @@ class CassandraStorage(BaseStorage, Subscriber):
             raise ValueError("Message should be a dict, got {} instead".format(
                 str(type(message))))
         self.insert_row(message)
+
+    def receive_batch(self, messages, on_done=None):
+        """
+        Receive a batch of messages from the publisher and insert
+        them into Cassandra with batch statements.
+        on_done is called when all of them have been written.
+        """
+        for message in messages:
+            if not isinstance(message, dict):
+                raise ValueError(
+                    "Message should be a dict, got {} instead".format(
+                        str(type(message))))
+        self.insert_rows(messages, on_done)
+
+
+class _Completion(object):
+    """
+    Calls on_done once all the writes of a group succeeded,
+    or with the error of the first write that failed.
+    """
+
+    def __init__(self, n_writes, on_done=None):
+        self.__lock = threading.Lock()
+        self.__missing = n_writes
+        self.__on_done = on_done
+        if n_writes == 0:
+            self.__done()
+
+    def success(self):
+        with self.__lock:
+            self.__missing -= 1
+            done = self.__missing == 0
+        if done:
+            self.__done()
+
+    def failure(self, error):
+        self.__done(error)
+
+    def __done(self, error=None):
+        with self.__lock:
+            on_done, self.__on_done = self.__on_done, None
+        if on_done is None:
+            return
+        if error is None:
+            on_done()
+        else:
+            on_done(error)
+
+
+def _parse_timestamps(values):
+    """
+    Parse the ISO formatted timestamps written by the producer.
+
+    Epoch milliseconds are left as they are, the driver writes ints to
+    timestamp columns directly, so batches without ISO strings are
+    returned unchanged.
+    """
+    if not any(type(value) is str for value in values):
+        return values
+    parse = datetime.datetime.fromisoformat
+    return [
+        parse(value) if type(value) is str and value else value
+        for value in values
+    ]
+
+
+def _estimate_size(values: Tuple) -> int:
+    """
+    Cheap estimate of the serialized size of a row, used to keep
+    batches under the configured byte limit.
+    """
+    size = 0
+    for value in values:
+        if value is None:
+            continue
+        elif isinstance(value, (str, bytes)):
+            size += len(value)
+        else:
+            size += 8
+    return size
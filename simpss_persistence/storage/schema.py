@@ -0,0 +1,114 @@
+"""Layouts of the sensor_data table."""
+
+import calendar
+import datetime
+from typing import List, Optional, Sequence, Tuple
+
+BUCKET_COLUMN = 'time_bucket'
+
+_COLUMNS = """
+        time_received timestamp,
+        sensor_group text,
+        sensor_id int,
+        uptime int,
+        temperature int,
+        pressure int,
+        humidity int,
+        ix int,
+        iy int,
+        iz int,
+        mask int,"""
+
+# TimeWindowCompactionStrategy units, largest first
+_WINDOW_UNITS = (('DAYS', 86400), ('HOURS', 3600), ('MINUTES', 60))
+
+
+def sensor_data_table(keyspace,
+                      name,
+                      bucket_seconds: Optional[int] = None,
+                      ttl: Optional[int] = None) -> str:
+    """
+    CQL creating the sensor data table, if it does not exist.
+
+    Parameters
+    ----------
+    keyspace, name: str
+        keyspace and name of the table
+
+    bucket_seconds: int, optional
+        width of the time buckets. If None, the original layout with a
+        partition per sensor group. Else every partition holds a sensor
+        for one bucket, PRIMARY KEY ((sensor_id, time_bucket),
+        time_received), compacted with TimeWindowCompactionStrategy in
+        windows of one bucket.
+
+    ttl: int, optional
+        seconds the rows are kept, only for the bucketed layout
+    """
+    if bucket_seconds is None:
+        if ttl:
+            raise ValueError("ttl is only supported with time buckets")
+        return """
+    CREATE TABLE IF NOT EXISTS %s.%s (%s
+        PRIMARY KEY (sensor_group, sensor_id, time_received)
+    )
+    """ % (keyspace, name, _COLUMNS)
+
+    unit, size = compaction_window(bucket_seconds)
+    query = """
+    CREATE TABLE IF NOT EXISTS %s.%s (%s
+        %s timestamp,
+        PRIMARY KEY ((sensor_id, %s), time_received)
+    ) WITH compaction = {
+        'class': 'TimeWindowCompactionStrategy',
+        'compaction_window_unit': '%s',
+        'compaction_window_size': %d
+    }""" % (keyspace, name, _COLUMNS, BUCKET_COLUMN, BUCKET_COLUMN, unit,
+            size)
+    if ttl:
+        query += " AND default_time_to_live = %d" % ttl
+    return query + "\n    "
+
+
+def compaction_window(bucket_seconds) -> Tuple[str, int]:
+    """
+    TimeWindowCompactionStrategy window matching a bucket width,
+    as unit and size, e.g. ('HOURS', 6) for 21600 seconds.
+    """
+    if bucket_seconds < 60 or bucket_seconds % 60:
+        raise ValueError(
+            "bucket_seconds should be a positive multiple of 60, "
+            "got {} instead".format(bucket_seconds))
+    for unit, seconds in _WINDOW_UNITS:
+        if bucket_seconds % seconds == 0:
+            return unit, bucket_seconds // seconds
+
+
+def to_epoch_ms(value) -> int:
+    """
+    Milliseconds since the epoch of a timestamp column value. Naive
+    datetimes are UTC, as for the Cassandra driver.
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc)
+        return (calendar.timegm(value.timetuple()) * 1000 +
+                value.microsecond // 1000)
+    return int(value)
+
+
+def time_buckets(values: Sequence, bucket_ms: int) -> List[Optional[int]]:
+    """
+    Start, in epoch milliseconds, of the bucket of every timestamp, given
+    as epoch milliseconds or datetimes. None stays None.
+    """
+    buckets = []
+    for value in values:
+        if value is None:
+            buckets.append(None)
+        elif type(value) is int:
+            buckets.append(value - value % bucket_ms)
+        else:
+            ms = to_epoch_ms(value)
+            buckets.append(ms - ms % bucket_ms)
+    return buckets
@@ -0,0 +1 @@
+from .pool import CountingSubscriber, WorkerPool
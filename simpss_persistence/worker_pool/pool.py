@@ -0,0 +1,170 @@
+"""Supervised pool of worker processes."""
+
+import multiprocessing as mp
+import time
+from typing import Any, Callable, List
+
+from ..custom_logging import get_logger
+from ..pub_sub import Publisher, Subscriber
+
+
+class WorkerPool(object):
+    """
+    Runs the same target function in n_workers processes, restarts
+    the ones that die and periodically logs their combined throughput.
+
+    The target is called as target(worker_id, counter, *args), where
+    counter is a shared multiprocessing.Value the worker increments
+    with the number of messages it handled.
+    """
+
+    def __init__(self,
+                 target: Callable,
+                 n_workers: int,
+                 args=(),
+                 restart_delay=5.0,
+                 report_every=10.0,
+                 name='worker-pool'):
+        """
+        Parameters
+        ----------
+        target: callable
+            function run by every worker, must be importable (picklable)
+
+        n_workers: int
+            number of worker processes
+
+        args: tuple
+            extra positional arguments for target
+
+        restart_delay: float
+            seconds to wait before restarting a dead worker
+
+        report_every: float
+            seconds between two throughput reports
+        """
+        if n_workers < 1:
+            raise ValueError(
+                "n_workers should be at least 1, got {} instead".format(
+                    n_workers))
+
+        self.target = target
+        self.n_workers = n_workers
+        self.args = tuple(args)
+        self.restart_delay = restart_delay
+        self.report_every = report_every
+        self.restarts = 0
+        self.__logger = get_logger(name)
+
+        self.counters = [mp.Value('Q', 0) for _ in range(n_workers)]
+        self.__processes: List[Any] = [None] * n_workers
+        self.__died_at: List[Any] = [None] * n_workers
+
+    def run(self):
+        """
+        Start the workers and supervise them until interrupted.
+        """
+        for worker_id in range(self.n_workers):
+            self.__start(worker_id)
+
+        last_report = time.monotonic()
+        last_total = 0
+        try:
+            while True:
+                time.sleep(min(1.0, self.report_every))
+                self.__supervise()
+
+                now = time.monotonic()
+                if now - last_report >= self.report_every:
+                    total = self.total()
+                    self.__logger.info(
+                        "Workers alive: {}/{}, messages: {} ({:.1f} msg/s), "
+                        "per worker: {}, restarts: {}".format(
+                            self.alive(), self.n_workers, total,
+                            (total - last_total) / (now - last_report),
+                            [c.value for c in self.counters], self.restarts))
+                    last_report = now
+                    last_total = total
+        except KeyboardInterrupt:
+            self.__logger.info("Stopping workers")
+        finally:
+            self.stop()
+
+    def stop(self, timeout=10.0):
+        """
+        Wait for the workers to exit, terminating the ones that
+        do not exit within timeout seconds.
+        """
+        deadline = time.monotonic() + timeout
+        for process in self.__processes:
+            if process is not None:
+                process.join(max(0.0, deadline - time.monotonic()))
+        for process in self.__processes:
+            if process is not None and process.is_alive():
+                self.__logger.warning(
+                    "Terminating worker {}".format(process.name))
+                process.terminate()
+                process.join()
+        self.__logger.info("All workers stopped, messages: {}".format(
+            self.total()))
+
+    def alive(self):
+        """Number of workers currently running."""
+        return sum(1 for p in self.__processes
+                   if p is not None and p.is_alive())
+
+    def total(self):
+        """Messages handled by all the workers since the pool started."""
+        return sum(c.value for c in self.counters)
+
+    def __start(self, worker_id):
+        process = mp.Process(target=self.target,
+                             name='worker-{}'.format(worker_id),
+                             args=(worker_id, self.counters[worker_id]) +
+                             self.args)
+        process.start()
+        self.__processes[worker_id] = process
+        self.__died_at[worker_id] = None
+        self.__logger.info("Started worker {} with pid {}".format(
+            worker_id, process.pid))
+
+    def __supervise(self):
+        """Restart the workers that died at least restart_delay ago."""
+        now = time.monotonic()
+        for worker_id, process in enumerate(self.__processes):
+            if process.is_alive():
+                continue
+
+            if self.__died_at[worker_id] is None:
+                self.__died_at[worker_id] = now
+                self.__logger.error(
+                    "Worker {} died with exit code {}, restarting in {}s".
+                    format(worker_id, process.exitcode, self.restart_delay))
+            elif now - self.__died_at[worker_id] >= self.restart_delay:
+                self.restarts += 1
+                self.__start(worker_id)
+
+
+class CountingSubscriber(Subscriber):
+    """
+    Subscriber that counts the messages it receives into
+    a shared multiprocessing.Value.
+    """
+
+    def __init__(self, counter):
+        self.counter = counter
+
+    def set_subscriber_name(self, name):
+        self.sub_name = name
+
+    def subscribe(self, publisher: Publisher):
+        publisher.add_subscriber(self, self.sub_name)
+
+    def receive(self, message):
+        self.receive_batch([message])
+
+    def receive_batch(self, messages, on_done=None):
+        with self.counter.get_lock():
+            self.counter.value += len(messages)
+        if on_done is not None:
+            on_done()
@@ -53,23 +53,9 @@ def create_database(db_name, replication_factor,
     LOGGER.debug("query executed")
 
 
-def create_table(keyspace, name, session):
-    query = """
-    CREATE TABLE IF NOT EXISTS %s.%s (
-        time_received timestamp,
-        sensor_group text,
-        sensor_id int,
-        uptime int,
-        temperature int,
-        pressure int,
-        humidity int,
-        ix int,
-        iy int,
-        iz int,
-        mask int,
-        PRIMARY KEY (sensor_group, sensor_id, time_received)
-    )
-    """ % (keyspace, name)
+def create_table(keyspace, name, session, bucket_seconds=None, ttl=None):
+    query = simpss_persistence.storage.sensor_data_table(
+        keyspace, name, bucket_seconds, ttl)
     LOGGER.debug("Create table: executing query {}".format(query))
     session.execute(query)
     LOGGER.debug("query executed")
@@ -80,15 +66,18 @@ if __name__ == "__main__":
                           'localhost').split(';')
     keyspace = os.getenv('CASSANDRA_KEYSPACE', 'simpss')
     replication_factor = str(os.getenv('CASSANDRA_REPLICATION', '3'))
+    bucket_seconds = int(os.getenv('CASSANDRA_BUCKET_SECONDS', '0')) or None
+    ttl = int(os.getenv('CASSANDRA_TTL', '0')) or None
 
     cluster = cassandra.cluster.Cluster(addresses)
     session = cluster.connect()
     create_database(keyspace, replication_factor, session)
-    create_table(keyspace, 'sensor_data', session)
+    create_table(keyspace, 'sensor_data', session, bucket_seconds, ttl)
     session.shutdown()
 
     cc_cluster = cassandra.cluster.Cluster(addresses)
-    cc = simpss_persistence.storage.CassandraStorage(cc_cluster)
+    cc = simpss_persistence.storage.CassandraStorage(
+        cc_cluster, time_bucket_seconds=bucket_seconds)
 
     # KAFKA
     bootstrap_servers = str(
@@ -0,0 +1,32 @@
+"""Load test with a fleet of virtual sensors publishing to MQTT."""
+
+import os
+
+import mocks
+
+if __name__ == "__main__":
+    n_sensors = int(os.environ.get("FLEET_SENSORS", 0))
+    first_id = int(os.environ.get("FLEET_FIRST_ID", 1000))
+    rate = float(os.environ.get("FLEET_RATE", 1000))
+    processes = int(os.environ.get("FLEET_PROCESSES", 1))
+    n_clients = int(os.environ.get("FLEET_CLIENTS", 1))
+    data_path = os.environ.get("FLEET_DATA", None)
+    duration = os.environ.get("FLEET_DURATION", None)
+
+    if n_sensors > 0:
+        sensor_ids = list(range(first_id, first_id + n_sensors))
+    else:
+        sensor_ids = mocks.read_sensor_ids(
+            os.path.join(os.getcwd(), 'sensor_group.csv'))
+
+    kwargs = dict(address=str(os.environ.get("MQTT_ADDRESS", 'localhost')),
+                  topic=str(os.environ.get("MQTT_TOPIC", 'simpss')),
+                  qos=int(os.environ.get("MQTT_QOS", 0)),
+                  n_clients=n_clients,
+                  data_path=data_path,
+                  duration=float(duration) if duration else None)
+
+    if processes > 1:
+        mocks.run_fleet_processes(sensor_ids, rate, processes, **kwargs)
+    else:
+        mocks.run_fleet(sensor_ids, rate, **kwargs)
@@ -0,0 +1,215 @@
+"""
+Open-loop load test of the pipeline stages at fixed offered rates.
+
+Every stage gets messages on a fixed schedule, independent of their
+completions, and the latency is measured from the scheduled send time,
+see mocks.load. Stages:
+- mqtt: publish to the MQTT broker, completed on the broker ack
+- kafka: produce to Kafka, completed on the delivery report
+- cassandra: asynchronous insert with CassandraStorage, completed on
+  the write ack. The sensor_data table must exist.
+"""
+
+import datetime
+import itertools
+import json
+import os
+import threading
+
+import cassandra
+import confluent_kafka
+import paho.mqtt.client as mq
+
+from mocks.load import Stage, format_report, run_open_loop
+import simpss_persistence
+
+LOGGER = simpss_persistence.custom_logging.get_logger('open-loop')
+
+SENSOR_IDS = (120, 121, 122, 123)
+
+
+def sample_reading(i):
+    """The i-th reading, as written to Kafka and Cassandra."""
+    return {
+        'id': SENSOR_IDS[i % len(SENSOR_IDS)],
+        'uptime': i,
+        'T': 2315,
+        'P': 101325,
+        'H': 4521,
+        'Ix': -235,
+        'Iy': 118,
+        'Iz': 983,
+        'M': 56,
+        'time_received': datetime.datetime.utcnow().isoformat(),
+        'sensor_group': 'g1',
+    }
+
+
+class MqttStage(Stage):
+    def __init__(self, address, port, topic, qos):
+        super().__init__('mqtt')
+        self.topic = topic
+        self.qos = qos
+        self.__counter = itertools.count()
+        self.__lock = threading.Lock()
+        self.__tokens = dict()
+        # acks arriving before publish returned their mid
+        self.__early_acks = dict()
+
+        self.client = mq.Client(client_id='open-loop', clean_session=True)
+        self.client.max_inflight_messages_set(65535)
+        self.client.on_publish = self.__on_publish
+        self.client.connect(address, port=port, keepalive=60)
+        self.client.loop_start()
+
+    def send(self, intended):
+        token = self.begin(intended)
+        reading = sample_reading(next(self.__counter))
+        del reading['time_received'], reading['sensor_group']
+        info = self.client.publish(self.topic,
+                                   json.dumps(reading),
+                                   qos=self.qos)
+        if info.rc != mq.MQTT_ERR_SUCCESS:
+            self.end(token, error=info.rc)
+            return
+        with self.__lock:
+            acked_at = self.__early_acks.pop(info.mid, None)
+            if acked_at is None:
+                self.__tokens[info.mid] = token
+        if acked_at is not None:
+            self.end(token, now=acked_at)
+
+    def __on_publish(self, client, userdata, mid):
+        now = self.clock()
+        with self.__lock:
+            token = self.__tokens.pop(mid, None)
+            if token is None:
+                self.__early_acks[mid] = now
+        if token is not None:
+            self.end(token, now=now)
+
+    def close(self):
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+class KafkaStage(Stage):
+    def __init__(self, bootstrap_servers, topic):
+        super().__init__('kafka')
+        self.topic = topic
+        self.__counter = itertools.count()
+        self.producer = confluent_kafka.Producer({
+            'bootstrap.servers': bootstrap_servers,
+            'linger.ms': 1,
+        })
+        self.__polling = True
+        self.__poller = threading.Thread(target=self.__poll, daemon=True)
+        self.__poller.start()
+
+    def send(self, intended):
+        token = self.begin(intended)
+        payload = json.dumps(sample_reading(next(self.__counter)))
+
+        def on_delivery(err, msg):
+            self.end(token, error=err)
+
+        while True:
+            try:
+                self.producer.produce(self.topic,
+                                      payload,
+                                      callback=on_delivery)
+                return
+            except BufferError:
+                # the wait is part of the latency of this message
+                self.producer.poll(0.01)
+
+    def __poll(self):
+        while self.__polling:
+            self.producer.poll(0.1)
+
+    def close(self):
+        self.__polling = False
+        self.__poller.join()
+        self.producer.flush(10)
+
+
+class CassandraStage(Stage):
+    def __init__(self, addresses, keyspace, max_in_flight):
+        super().__init__('cassandra')
+        self.__counter = itertools.count()
+        self.storage = simpss_persistence.storage.CassandraStorage(
+            cassandra.cluster.Cluster(addresses),
+            async_writes=True,
+            max_in_flight=max_in_flight)
+        self.storage.connect()
+        self.storage.set_keyspace_table(keyspace, 'sensor_data')
+        self.storage.set_name_mapping({
+            'sensor_group': 'sensor_group',
+            'id': 'sensor_id',
+            'time_received': 'time_received',
+            'uptime': 'uptime',
+            'T': 'temperature',
+            'P': 'pressure',
+            'H': 'humidity',
+            'Ix': 'ix',
+            'Iy': 'iy',
+            'Iz': 'iz',
+            'M': 'mask',
+        })
+
+    def send(self, intended):
+        token = self.begin(intended)
+
+        def on_done(error=None):
+            self.end(token, error=error)
+
+        # blocks while the window of writes in flight is full
+        self.storage.insert_rows([sample_reading(next(self.__counter))],
+                                 on_done=on_done)
+
+    def close(self):
+        self.storage.disconnect()
+
+
+def make_stage(name):
+    if name == 'mqtt':
+        return MqttStage(str(os.environ.get("MQTT_ADDRESS", 'localhost')),
+                         1883, str(os.environ.get("MQTT_TOPIC", 'simpss')),
+                         int(os.environ.get("MQTT_QOS", 1)))
+    if name == 'kafka':
+        return KafkaStage(
+            str(os.environ.get('KAFKA_BOOTSTRAP_SERVERS', 'localhost:9092')),
+            str(os.environ.get('KAFKA_TOPIC', 'g1')))
+    if name == 'cassandra':
+        return CassandraStage(
+            os.getenv('CASSANDRA_CLUSTER_ADDRESSES', 'localhost').split(';'),
+            os.getenv('CASSANDRA_KEYSPACE', 'simpss'),
+            int(os.getenv('CASSANDRA_MAX_IN_FLIGHT', '128')))
+    raise ValueError("Unknown stage {}".format(name))
+
+
+if __name__ == "__main__":
+    stage_names = os.environ.get("LOAD_STAGES", 'mqtt').split(',')
+    rates = [
+        float(r)
+        for r in os.environ.get("LOAD_RATES", '100,1000,5000').split(',')
+    ]
+    duration = float(os.environ.get("LOAD_DURATION", 30))
+    drain_timeout = float(os.environ.get("LOAD_DRAIN_TIMEOUT", 10))
+
+    results = []
+    for stage_name in stage_names:
+        stage = make_stage(stage_name)
+        try:
+            for rate in rates:
+                LOGGER.info("{} at {} msg/s for {} s".format(
+                    stage_name, rate, duration))
+                results.append(
+                    run_open_loop(stage, rate, duration, drain_timeout))
+                print(format_report(results[-1:]))
+        finally:
+            stage.close()
+
+    print()
+    print("latencies in ms, measured from the scheduled send time")
+    print(format_report(results))
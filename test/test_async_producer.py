@@ -0,0 +1,179 @@
+"""Test for the asyncio MQTT Kafka producer, without brokers."""
+
+import asyncio
+import json
+import socket
+
+from simpss.producers import AsyncMqttKafkaProducer
+
+MQTT_CONFIG = {
+    'client-id': 'test',
+    'address': 'localhost',
+    'port': 1883,
+    'transport': 'tcp',
+    'topic': ['simpss', 'simpss-2'],
+    'qos': 0,
+    'max-inflight': 100,
+    'payload-key': 'id',
+}
+
+KAFKA_CONFIG = {
+    'bootstrap.servers': 'localhost:9092',
+    'group.id': 'test',
+    'client.id': 'test',
+}
+
+
+class FakeKafkaProducer(object):
+    """Kafka producer with a local queue of room messages."""
+
+    def __init__(self, room):
+        self.room = room
+        self.produced = []
+
+    def produce(self, topic, message, **kwargs):
+        if len(self.produced) >= self.room:
+            raise BufferError()
+        self.produced.append((topic, message, kwargs.get('key')))
+
+    def poll(self, timeout):
+        return 0
+
+
+class FakeMessage(object):
+    def __init__(self, reading):
+        self.payload = json.dumps(reading).encode('utf-8')
+
+
+class FakeMqttClient(object):
+    """MQTT client reading and writing a real socket."""
+
+    def __init__(self, producer, sock):
+        self.producer = producer
+        self.sock = sock
+        self.reads = 0
+        self.writes = 0
+
+    def loop_read(self):
+        self.reads += 1
+        self.sock.recv(1024)
+
+    def loop_write(self):
+        # like paho, stop watching the socket once nothing is left to write
+        self.writes += 1
+        self.producer._on_socket_unregister_write(self, None, self.sock)
+
+
+def make_producer(room, max_backlog=2, **kwargs):
+    producer = AsyncMqttKafkaProducer([MQTT_CONFIG],
+                                      KAFKA_CONFIG, {120: 'g1'},
+                                      max_backlog=max_backlog,
+                                      codec='stdlib',
+                                      timestamp_format='epoch_ms',
+                                      **kwargs)
+    producer._kf_producer = FakeKafkaProducer(room)
+    return producer
+
+
+def test_messages_are_produced_directly():
+    """Readings go to the topic of their group, keyed by sensor."""
+    producer = make_producer(room=10)
+    userdata = {'payload-key': 'id'}
+    producer._on_mqtt_message(None, userdata, FakeMessage({'id': 120}))
+    producer._on_mqtt_message(None, userdata, FakeMessage({'id': 999}))
+
+    produced = producer._kf_producer.produced
+    assert len(produced) == 1
+    topic, message, key = produced[0]
+    assert (topic, key) == ('g1', b'120')
+    reading = json.loads(message)
+    assert reading['sensor_group'] == 'g1'
+    assert isinstance(reading['time_received'], int)
+
+
+def test_backlog_pauses_and_keeps_order():
+    """A full Kafka queue fills the backlog, which pauses the sockets."""
+    producer = make_producer(room=1)
+    userdata = {'payload-key': 'id'}
+    for uptime in range(3):
+        producer._on_mqtt_message(None, userdata,
+                                  FakeMessage({
+                                      'id': 120,
+                                      'uptime': uptime
+                                  }))
+
+    assert len(producer._kf_producer.produced) == 1
+    assert producer.metrics()['backlog'] == 2
+    assert producer.metrics()['paused']
+
+    producer._kf_producer.room = 10
+    producer._AsyncMqttKafkaProducer__flush_backlog()
+
+    uptimes = [
+        json.loads(message)['uptime']
+        for _, message, _ in producer._kf_producer.produced
+    ]
+    assert uptimes == [0, 1, 2]
+    assert producer.metrics() == {
+        'backlog': 0,
+        'paused': False,
+        'buffer_full_waits': 1,
+    }
+
+
+def test_dead_letters_wait_in_the_backlog():
+    """Dead letters finding the Kafka queue full are not dropped."""
+    producer = make_producer(room=1,
+                             dead_letter_topic='dlq',
+                             dead_letter_batch_size=1)
+    userdata = {'payload-key': 'id'}
+    producer._on_mqtt_message(None, userdata, FakeMessage({'id': 120}))
+    producer._on_mqtt_message(None, userdata, FakeMessage({'id': 999}))
+    producer._on_mqtt_message(None, userdata, FakeMessage({'id': 120}))
+    assert producer.metrics()['backlog'] == 2
+
+    producer._kf_producer.room = 10
+    producer._AsyncMqttKafkaProducer__flush_backlog()
+    assert [topic for topic, _, _ in producer._kf_producer.produced
+            ] == ['g1', 'dlq', 'g1']
+
+
+def test_sockets_are_watched_by_the_event_loop():
+    """The MQTT sockets are read and written when the event loop says so."""
+    producer = make_producer(room=10)
+    loop = asyncio.new_event_loop()
+    producer._AsyncMqttKafkaProducer__loop = loop
+    sock, peer = socket.socketpair()
+    sock.setblocking(False)
+    client = FakeMqttClient(producer, sock)
+
+    def run():
+        loop.run_until_complete(asyncio.sleep(0.05))
+
+    try:
+        producer._on_socket_open(client, None, sock)
+        peer.send(b'x')
+        run()
+        assert client.reads == 1
+
+        producer._on_socket_register_write(client, None, sock)
+        run()
+        assert client.writes == 1
+
+        producer._AsyncMqttKafkaProducer__pause(True)
+        peer.send(b'x')
+        run()
+        assert client.reads == 1
+        producer._AsyncMqttKafkaProducer__pause(False)
+        run()
+        assert client.reads == 2
+
+        producer._on_socket_register_write(client, None, sock)
+        producer._on_socket_close(client, None, sock)
+        assert not loop.remove_reader(sock)
+        assert not loop.remove_writer(sock)
+        assert client.writes == 1
+    finally:
+        loop.close()
+        sock.close()
+        peer.close()
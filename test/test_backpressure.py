@@ -0,0 +1,94 @@
+"""Test for the partition pause/resume flow control of the consumer."""
+
+import pytest
+
+from simpss_persistence.kafka_consumer import KafkaConsumer
+from simpss_persistence.pub_sub import Subscriber
+
+
+class FakeKafka(object):
+    """The parts of confluent_kafka.Consumer used for flow control."""
+
+    def __init__(self, partitions):
+        self.partitions = partitions
+        self.paused = set()
+
+    def assignment(self):
+        return list(self.partitions)
+
+    def assign(self, partitions):
+        self.partitions = list(partitions)
+
+    def pause(self, partitions):
+        self.paused.update(partitions)
+
+    def resume(self, partitions):
+        self.paused.difference_update(partitions)
+
+
+class BacklogSubscriber(Subscriber):
+    def __init__(self, backlog=0):
+        self.backlog = backlog
+
+    def set_subscriber_name(self, name):
+        pass
+
+    def subscribe(self, publisher):
+        pass
+
+    def receive(self, message):
+        pass
+
+    def outstanding(self):
+        return self.backlog
+
+
+def make_consumer(**kwargs):
+    consumer = KafkaConsumer('localhost:9092', 'test', **kwargs)
+    consumer.kafka = FakeKafka(['p0', 'p1'])
+    return consumer
+
+
+def test_pause_above_high_resume_below_low():
+    """Partitions are paused at the high and resumed at the low watermark."""
+    consumer = make_consumer(high_watermark=100, low_watermark=20)
+    fast, slow = BacklogSubscriber(), BacklogSubscriber()
+    consumer.add_subscriber(fast, 'fast')
+    consumer.add_subscriber(slow, 'slow')
+    apply = consumer._KafkaConsumer__apply_backpressure
+
+    slow.backlog = 99
+    apply()
+    assert not consumer.paused
+
+    slow.backlog = 100
+    apply()
+    assert consumer.paused
+    assert consumer.kafka.paused == {'p0', 'p1'}
+
+    # between the watermarks nothing changes
+    slow.backlog = 50
+    apply()
+    assert consumer.paused
+
+    slow.backlog = 20
+    apply()
+    assert not consumer.paused
+    assert consumer.kafka.paused == set()
+    assert consumer.pauses == 1
+    assert consumer.metrics()['outstanding'] == 20
+
+
+def test_assigned_partitions_are_paused_while_paused():
+    consumer = make_consumer(high_watermark=10)
+    consumer.add_subscriber(BacklogSubscriber(10), 'slow')
+    consumer._KafkaConsumer__apply_backpressure()
+
+    consumer._KafkaConsumer__on_assign(consumer.kafka, ['p2'])
+    assert 'p2' in consumer.kafka.paused
+
+
+@pytest.mark.parametrize('high, low', [(10, 10), (10, -1), (10, 20)])
+def test_invalid_watermarks(high, low):
+    with pytest.raises(ValueError):
+        make_consumer(high_watermark=high, low_watermark=low)
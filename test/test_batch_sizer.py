@@ -0,0 +1,62 @@
+"""Test for the adaptive batch sizer."""
+
+import pytest
+
+from simpss_persistence.kafka_consumer import AdaptiveBatchSizer
+
+
+def test_grows_when_full_and_fast():
+    """Full batches processed within the target make the batch grow."""
+    sizer = AdaptiveBatchSizer(batch_size=10, latency_target=0.5)
+    sizer.update(10, 0.1)
+    assert sizer.batch_size == 15
+
+    sizer.update(15, 0.1)
+    assert sizer.batch_size == 22
+
+
+def test_shrinks_when_slow():
+    """Batches slower than the target make the batch shrink."""
+    sizer = AdaptiveBatchSizer(batch_size=100, latency_target=0.5)
+    sizer.update(100, 0.8)
+    assert sizer.batch_size == 50
+
+
+def test_respects_bounds():
+    """Batch size and timeout never leave the configured bounds."""
+    sizer = AdaptiveBatchSizer(batch_size=8,
+                               timeout=1.0,
+                               min_batch_size=4,
+                               max_batch_size=10,
+                               min_timeout=0.25)
+    for _ in range(10):
+        sizer.update(sizer.batch_size, 0.0)
+    assert sizer.batch_size == 10
+
+    for _ in range(10):
+        sizer.update(sizer.batch_size, 10.0)
+    assert sizer.batch_size == 4
+
+    for _ in range(10):
+        sizer.update(1, 0.0)
+    assert sizer.timeout == 0.25
+
+    for _ in range(10):
+        sizer.update(0, 0.0)
+    assert sizer.timeout == 1.0
+
+
+def test_fixed_mode_never_changes():
+    """When not adaptive, only the last batch outcome is recorded."""
+    sizer = AdaptiveBatchSizer(batch_size=10, timeout=1.0, adaptive=False)
+    sizer.update(10, 0.0)
+    sizer.update(1, 10.0)
+    assert sizer.batch_size == 10
+    assert sizer.timeout == 1.0
+    assert sizer.metrics()['last_batch_received'] == 1
+
+
+def test_invalid_bounds_raise():
+    """Inconsistent bounds are rejected."""
+    with pytest.raises(ValueError):
+        AdaptiveBatchSizer(batch_size=10, max_batch_size=5)
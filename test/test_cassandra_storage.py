@@ -0,0 +1,236 @@
+"""Test for the Cassandra storage, with a fake session."""
+
+import datetime
+import threading
+
+import pytest
+from cassandra.query import BatchStatement, SimpleStatement
+
+from simpss_persistence.storage import CassandraStorage
+from simpss_persistence.storage.cassandra_storage import (_estimate_size,
+                                                          _parse_timestamps)
+
+MAPPING = {
+    'sensor_group': 'sensor_group',
+    'id': 'sensor_id',
+    'time_received': 'time_received',
+    'T': 'temperature',
+}
+
+
+class FakeFuture(object):
+    """Response future completed by the test."""
+
+    def add_callbacks(self, callback, errback, callback_args=(),
+                      errback_args=()):
+        self.callback = callback
+        self.callback_args = callback_args
+        self.errback = errback
+        self.errback_args = errback_args
+
+    def succeed(self):
+        self.callback(None, *self.callback_args)
+
+    def fail(self, error):
+        self.errback(error, *self.errback_args)
+
+
+class FakeSession(object):
+    """Session recording the writes, partitioned by the first column."""
+
+    def __init__(self):
+        self.executed = []
+        self.futures = []
+
+    def prepare(self, query):
+        statement = SimpleStatement(query.replace('?', '%s'))
+        statement.routing_key_indexes = [0]
+        return statement
+
+    def execute(self, statement, values=None):
+        self.executed.append((statement, values))
+
+    def execute_async(self, statement, values=None):
+        future = FakeFuture()
+        self.futures.append((statement, values, future))
+        return future
+
+
+def make_storage(**kwargs):
+    storage = CassandraStorage(None, **kwargs)
+    storage.session = FakeSession()
+    storage.set_keyspace_table('simpss', 'sensor_data')
+    storage.set_name_mapping(MAPPING)
+    return storage
+
+
+def rows(group, n, time_received=1546300800000):
+    return [{
+        'sensor_group': group,
+        'id': i,
+        'time_received': time_received,
+        'T': 20
+    } for i in range(n)]
+
+
+def test_estimate_size():
+    assert _estimate_size(('abc', b'xy', 5, None, 1.5)) == 21
+
+
+def test_parse_timestamps():
+    """ISO strings are parsed, epoch milliseconds are left as they are."""
+    epoch = [1546300800000, 1546300801000]
+    assert _parse_timestamps(epoch) is epoch
+    assert _parse_timestamps([]) == []
+    assert _parse_timestamps(
+        ['2019-01-01T01:30:00.250000', 1546300800000, None]) == [
+            datetime.datetime(2019, 1, 1, 1, 30, 0, 250000), 1546300800000,
+            None
+        ]
+
+
+def test_mixed_timestamp_batch():
+    """A batch with readings of both timestamp formats is written."""
+    storage = make_storage()
+    storage.insert_rows(
+        rows('g1', 1, time_received='2019-01-01T01:30:00') +
+        rows('g1', 1, time_received=1546300800000))
+
+    (batch, _), = storage.session.executed
+    assert len(batch) == 2
+
+
+def test_batches_group_partitions_and_respect_row_limit():
+    """Every batch holds rows of one partition, at most batch_max_rows."""
+    storage = make_storage(batch_max_rows=3)
+    storage.insert_rows(rows('g1', 5) + rows('g2', 1))
+
+    executed = storage.session.executed
+    assert all(isinstance(batch, BatchStatement) for batch, _ in executed)
+    assert sorted(len(batch) for batch, _ in executed) == [1, 2, 3]
+
+
+def test_batches_respect_byte_limit():
+    # every row is 2 + 8 + 8 + 8 bytes
+    storage = make_storage(batch_max_bytes=60)
+    storage.insert_rows(rows('g1', 5))
+
+    assert [len(batch) for batch, _ in storage.session.executed] == [2, 2, 1]
+
+
+def test_in_flight_window_blocks_when_full():
+    """With a full window insert_row waits for a write to complete."""
+    storage = make_storage(async_writes=True, max_in_flight=2)
+    for row in rows('g1', 2):
+        storage.insert_row(row)
+    assert storage.in_flight == 2
+
+    writer = threading.Thread(target=storage.insert_row,
+                              args=(rows('g1', 1)[0], ))
+    writer.start()
+    writer.join(timeout=0.1)
+    assert writer.is_alive()
+
+    storage.session.futures[0][2].succeed()
+    writer.join(timeout=5.0)
+    assert not writer.is_alive()
+    assert storage.in_flight == 2
+
+    for _, _, future in storage.session.futures[1:]:
+        future.succeed()
+    assert storage.flush(timeout=1.0)
+
+
+def test_receive_batch_calls_on_done_once():
+    """on_done is called once all the batches of the rows are written."""
+    storage = make_storage(async_writes=True, batch_max_rows=2)
+    done = []
+    storage.receive_batch(rows('g1', 5),
+                          on_done=lambda error=None: done.append(error))
+
+    assert storage.outstanding() == 5
+    futures = [future for _, _, future in storage.session.futures]
+    assert len(futures) == 3
+    futures[0].succeed()
+    assert storage.outstanding() == 3
+    for future in futures[1:]:
+        future.succeed()
+
+    assert done == [None]
+    assert storage.outstanding() == 0
+    assert storage.in_flight == 0
+
+
+def test_flush_waits_for_on_done():
+    """The slot of a write is released only after its on_done ran."""
+    storage = make_storage(async_writes=True)
+    in_flight = []
+    for future_index, fail in enumerate([False, True]):
+        storage.receive_batch(
+            rows('g1', 1),
+            on_done=lambda error=None: in_flight.append(storage.in_flight))
+        future = storage.session.futures[future_index][2]
+        if fail:
+            future.fail(RuntimeError('write timeout'))
+        else:
+            future.succeed()
+
+    assert in_flight == [1, 1]
+    assert storage.flush(timeout=1.0)
+
+
+def test_failed_write_reports_the_error():
+    storage = make_storage(async_writes=True, batch_max_rows=2)
+    done = []
+    storage.receive_batch(rows('g1', 3),
+                          on_done=lambda error=None: done.append(error))
+
+    error = RuntimeError('write timeout')
+    first, second = [future for _, _, future in storage.session.futures]
+    first.fail(error)
+    second.succeed()
+
+    assert done == [error]
+    assert storage.write_errors == 1
+    assert storage.flush(timeout=1.0)
+
+
+def test_receive_batch_rejects_non_dict_messages():
+    storage = make_storage()
+    with pytest.raises(ValueError):
+        storage.receive_batch([{'id': 1}, 'not a row'])
+
+
+def test_time_bucket_column():
+    """The bucket start is appended to the values of bucketed tables."""
+    storage = make_storage(time_bucket_seconds=3600)
+    hour = 3600 * 1000
+    storage.insert_row(rows('g1', 1, time_received=1546300800000 + 90000)[0])
+    storage.insert_row(
+        rows('g1', 1, time_received='2019-01-01T01:30:00')[0])
+
+    (first, values), (second, iso_values) = storage.session.executed
+    assert 'time_bucket' in first.query_string
+    assert values[-1] == 1546300800000
+    assert iso_values[2] == datetime.datetime(2019, 1, 1, 1, 30)
+    assert iso_values[-1] == 1546300800000 + hour
+
+    for bucket_seconds in (0, 90):
+        with pytest.raises(ValueError):
+            make_storage(time_bucket_seconds=bucket_seconds)
+
+
+@pytest.mark.parametrize('async_writes', [False, True])
+def test_unmappable_rows_report_the_error(async_writes):
+    """A row without a mapped field fails the batch through on_done."""
+    storage = make_storage(async_writes=async_writes)
+    bad_rows = rows('g1', 2)
+    del bad_rows[1]['T']
+    done = []
+    storage.insert_rows(bad_rows,
+                        on_done=lambda error=None: done.append(error))
+
+    assert len(done) == 1 and isinstance(done[0], ValueError)
+    assert storage.session.executed == storage.session.futures == []
+    with pytest.raises(ValueError):
+        storage.insert_rows(bad_rows)
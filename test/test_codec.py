@@ -0,0 +1,52 @@
+"""Test for the JSON codecs."""
+
+import pytest
+
+from simpss_common.codec import JsonCodec, available_codecs, get_codec
+
+READING = {
+    'id': 120,
+    'uptime': 123456,
+    'T': 2315,
+    'Ix': -235,
+    'time_received': '2019-03-01T10:00:00.123456',
+    'sensor_group': 'gruppo è',
+}
+
+
+@pytest.mark.parametrize('name', available_codecs())
+def test_round_trip(name):
+    """Every codec encodes to UTF-8 bytes and decodes bytes and str."""
+    codec = get_codec(name)
+    encoded = codec.dumps(READING)
+
+    assert isinstance(encoded, bytes)
+    assert codec.loads(encoded) == READING
+    assert codec.loads(encoded.decode('utf-8')) == READING
+
+
+def test_codecs_are_compatible():
+    """Messages encoded by one codec are decoded by all the others."""
+    for writer in available_codecs():
+        encoded = get_codec(writer).dumps(READING)
+        for reader in available_codecs():
+            assert get_codec(reader).loads(encoded) == READING
+
+
+def test_get_codec():
+    """Codecs are selected by name, by instance or automatically."""
+    assert get_codec('stdlib').name == 'stdlib'
+    assert get_codec('auto').name == available_codecs()[0]
+
+    codec = get_codec('stdlib')
+    assert get_codec(codec) is codec
+    assert isinstance(codec, JsonCodec)
+
+    with pytest.raises(ValueError):
+        get_codec('not-a-codec')
+
+
+def test_get_codec_from_environment(monkeypatch):
+    """Without a name, the codec is read from SIMPSS_JSON_CODEC."""
+    monkeypatch.setenv('SIMPSS_JSON_CODEC', 'stdlib')
+    assert get_codec().name == 'stdlib'
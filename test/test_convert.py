@@ -2,7 +2,7 @@
 
 import pytest
 
-from simpss_persistence.data_mapping import convert
+from simpss_persistence.data_mapping import compile_mapper, convert
 
 
 def test_convert_ok():
@@ -64,3 +64,68 @@ def test_convert_raises():
 
     with pytest.raises(ValueError):
         convert(original, mapping)
+
+
+def test_compiled_mapper_ok():
+    """Test that the compiled mapper returns the values ordered as the columns."""
+    original = {
+        'time_received': 123,
+        'sensor_group': 2,
+        'id': 3,
+        'P': 432,
+        'extra': 'ignored',
+    }
+
+    mapping = {
+        'sensor_group': 'sensor_group',
+        'id': 'sensor_id',
+        'time_received': 'time_received',
+        'P': 'pressure',
+    }
+
+    mapper = compile_mapper(mapping, converters={'pressure': lambda p: p * 2})
+    assert mapper.columns == [
+        'sensor_group', 'sensor_id', 'time_received', 'pressure'
+    ]
+    assert mapper(original) == (2, 3, 123, 864)
+    assert mapper.map_batch([original, original]) == [(2, 3, 123, 864)] * 2
+
+
+def test_compiled_mapper_batch_converters():
+    """Test that batch converters get all the values of their column."""
+    calls = []
+
+    def double_all(values):
+        calls.append(len(values))
+        return [v * 2 for v in values]
+
+    mapper = compile_mapper({'id': 'sensor_id', 'P': 'pressure'},
+                            batch_converters={'pressure': double_all})
+    assert mapper.map_batch([{'id': 1, 'P': 10}, {'id': 2, 'P': 20}]) == [
+        (1, 20), (2, 40)
+    ]
+    assert calls == [2]
+    assert mapper.map_batch([]) == []
+
+
+def test_compiled_mapper_unchanged_batch():
+    """Test that rows are kept when a batch converter returns its input."""
+    mapper = compile_mapper({'id': 'sensor_id', 'P': 'pressure'},
+                            batch_converters={'pressure': lambda v: v})
+    assert mapper.map_batch([{'id': 1, 'P': 10}, {'id': 2, 'P': 20}]) == [
+        (1, 10), (2, 20)
+    ]
+
+
+def test_compiled_mapper_single_column():
+    """Test that a single column mapping still returns tuples."""
+    mapper = compile_mapper({'id': 'sensor_id'})
+    assert mapper.map_batch([{'id': 1}, {'id': 2}]) == [(1, ), (2, )]
+
+
+def test_compiled_mapper_raises():
+    """Test that the compiled mapper raises if a key is missing in the source."""
+    mapper = compile_mapper({'id': 'sensor_id', 'P': 'pressure'})
+
+    with pytest.raises(ValueError):
+        mapper({'id': 3})
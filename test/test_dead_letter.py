@@ -0,0 +1,60 @@
+"""Test for the dead-letter queue."""
+
+import pytest
+
+from simpss_common.dead_letter import (DEAD_LETTER_HEADERS, MALFORMED,
+                                       UNKNOWN_SENSOR, DeadLetterQueue)
+
+
+class FakeTopic(object):
+    def __init__(self):
+        self.messages = []
+
+    def send(self, topic, value, headers):
+        self.messages.append((topic, value, dict(headers)))
+
+
+def test_sent_in_batches():
+    """Dead letters wait until a batch is full."""
+    kafka = FakeTopic()
+    dlq = DeadLetterQueue('producer', kafka.send, 'dlq', batch_size=3)
+
+    dlq.add(b'{bad', MALFORMED, 'Expecting value')
+    dlq.add(b'{"id": 999}', UNKNOWN_SENSOR, 'sensor id 999')
+    assert kafka.messages == []
+
+    dlq.add(b'[]', MALFORMED)
+    assert [value for _, value, _ in kafka.messages
+           ] == [b'{bad', b'{"id": 999}', b'[]']
+    topic, _, headers = kafka.messages[1]
+    assert topic == 'dlq'
+    assert headers == dict(
+        zip(DEAD_LETTER_HEADERS, ('unknown_sensor', 'sensor id 999',
+                                  'producer')))
+
+
+def test_flush_after_interval():
+    kafka = FakeTopic()
+    dlq = DeadLetterQueue('consumer',
+                          kafka.send,
+                          'dlq',
+                          batch_size=100,
+                          interval=0.0)
+    dlq.add(b'x', MALFORMED)
+    dlq.maybe_flush()
+
+    assert len(kafka.messages) == 1
+
+
+def test_without_topic():
+    """Without a topic dead letters are only counted."""
+    dlq = DeadLetterQueue('producer')
+    dlq.add(b'x', MALFORMED)
+    dlq.flush()
+
+    assert dlq.dead_letters == 1
+
+
+def test_topic_needs_send():
+    with pytest.raises(ValueError):
+        DeadLetterQueue('producer', topic='dlq')
@@ -0,0 +1,118 @@
+"""Test for the disk spool."""
+
+import mmap
+import os
+import queue
+
+import pytest
+
+from simpss_common.codec import WireFormat
+from simpss_common.spool import DiskSpool, SpooledQueue
+
+PAGE = mmap.PAGESIZE
+
+
+def records(n, size=100):
+    return [bytes([i % 256]) * size for i in range(n)]
+
+
+def read_all(spool):
+    read = []
+    while True:
+        try:
+            read.append(spool.get_nowait())
+        except queue.Empty:
+            return read
+
+
+def segment_files(directory):
+    return sorted(f for f in os.listdir(str(directory)) if f != 'position')
+
+
+def test_records_are_read_in_order(tmp_path):
+    """Records rotate over segments and come back in order."""
+    spool = DiskSpool(str(tmp_path), segment_bytes=PAGE, max_bytes=PAGE * 10)
+    for record in records(100):
+        assert spool.put(record)
+
+    assert len(segment_files(tmp_path)) > 1
+    assert spool.qsize() == 100
+    assert read_all(spool) == records(100)
+
+    for _ in range(100):
+        spool.task_done()
+    assert spool.size_bytes == 0
+    assert len(segment_files(tmp_path)) == 1
+    spool.close()
+
+
+def test_unprocessed_records_survive_a_restart(tmp_path):
+    """Records read but not marked done are read again after reopening."""
+    spool = DiskSpool(str(tmp_path), segment_bytes=PAGE, max_bytes=PAGE * 10)
+    for record in records(50):
+        spool.put(record)
+    read_all(spool)
+    for _ in range(30):
+        spool.task_done()
+    spool.close()
+
+    spool = DiskSpool(str(tmp_path), segment_bytes=PAGE, max_bytes=PAGE * 10)
+    assert spool.qsize() == 20
+    spool.put(b'new')
+    assert read_all(spool) == records(50)[30:] + [b'new']
+    spool.close()
+
+
+def test_torn_write_is_ignored(tmp_path):
+    """A record with a bad checksum ends the records of a segment."""
+    spool = DiskSpool(str(tmp_path), segment_bytes=PAGE, max_bytes=PAGE * 10)
+    spool.put(b'first')
+    spool.put(b'second')
+    spool.close()
+
+    path = os.path.join(str(tmp_path), segment_files(tmp_path)[0])
+    with open(path, 'r+b') as f:
+        f.seek(8 + 5 + 8)
+        f.write(b'X')
+
+    spool = DiskSpool(str(tmp_path), segment_bytes=PAGE, max_bytes=PAGE * 10)
+    assert spool.qsize() == 1
+    spool.put(b'third')
+    assert read_all(spool) == [b'first', b'third']
+    spool.close()
+
+
+def test_full_spool_drops(tmp_path):
+    """Records over max_bytes are dropped until some are processed."""
+    spool = DiskSpool(str(tmp_path), segment_bytes=PAGE, max_bytes=PAGE)
+    accepted = sum(spool.put(record) for record in records(100))
+
+    assert accepted == PAGE // 108
+    assert spool.dropped == 100 - accepted
+    spool.get()
+    spool.task_done()
+    assert spool.put(b'x' * 100)
+    spool.close()
+
+
+def test_invalid_arguments(tmp_path):
+    with pytest.raises(ValueError):
+        DiskSpool(str(tmp_path), fsync='sometimes')
+    with pytest.raises(ValueError):
+        DiskSpool(str(tmp_path), segment_bytes=PAGE, max_bytes=PAGE - 1)
+
+
+def test_spooled_queue(tmp_path):
+    """Producer queue items keep reading, wait time and trace time."""
+    spooled = SpooledQueue(
+        DiskSpool(str(tmp_path), segment_bytes=PAGE, max_bytes=PAGE),
+        WireFormat('stdlib', binary=True))
+    reading = {'id': 120, 'T': 2315, 'sensor_group': 'g1'}
+    spooled.put((0.0, reading, None))
+    spooled.put((0.0, reading, 1234.5))
+
+    assert spooled.get()[1:] == (reading, None)
+    assert spooled.get_nowait()[1:] == (reading, 1234.5)
+    with pytest.raises(queue.Empty):
+        spooled.get(timeout=0.01)
+    spooled.close()
@@ -0,0 +1,91 @@
+"""Test for the open-loop load generator."""
+
+import pytest
+
+from mocks.load import LatencyHistogram, Stage, format_report, run_open_loop
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class StallingStage(Stage):
+    """Completes every message at once, but blocks once for stall seconds."""
+
+    def __init__(self, clock, stall_at, stall):
+        super().__init__('fake', clock=clock)
+        self.stall_at = stall_at
+        self.stall = stall
+        self.sent = 0
+
+    def send(self, intended):
+        token = self.begin(intended)
+        if self.sent == self.stall_at:
+            self.clock.sleep(self.stall)
+        self.sent += 1
+        self.end(token)
+
+
+def test_percentiles_within_precision():
+    """Percentiles are within the relative error of the histogram."""
+    histogram = LatencyHistogram(significant_digits=2)
+    for i in range(1, 10001):
+        histogram.record(i / 1000.0)
+
+    assert histogram.count == 10000
+    assert histogram.percentile(50) == pytest.approx(5.0, rel=0.01)
+    assert histogram.percentile(99) == pytest.approx(9.9, rel=0.01)
+    assert histogram.percentile(100) == pytest.approx(10.0)
+    assert histogram.mean == pytest.approx(5.0005)
+
+
+def test_merge():
+    a = LatencyHistogram()
+    b = LatencyHistogram()
+    a.record(0.001)
+    b.record(0.1)
+    a.merge(b)
+
+    assert a.count == 2
+    assert a.max == pytest.approx(0.1)
+
+
+def test_stall_is_not_omitted():
+    """Messages scheduled during a stall are late and their latency shows."""
+    clock = FakeClock()
+    stage = StallingStage(clock, stall_at=10, stall=0.5)
+
+    result = run_open_loop(stage, rate=100, duration=1.0, sleep=clock.sleep)
+
+    assert result['sent'] == 100
+    assert result['completed'] == 100
+    # the stalled message and the ~50 scheduled while it blocked are late
+    assert result['percentiles'][50.0] > 0.0
+    assert result['percentiles'][99.0] == pytest.approx(0.5, rel=0.02)
+    assert 'fake' in format_report([result])
+
+
+def test_pending_messages_are_timeouts():
+    """Messages never completed are recorded when the drain times out."""
+
+    class LosingStage(Stage):
+        def send(self, intended):
+            self.begin(intended)
+
+    clock = FakeClock()
+    stage = LosingStage('lost', clock=clock)
+    result = run_open_loop(stage,
+                           rate=10,
+                           duration=1.0,
+                           drain_timeout=0.0,
+                           sleep=clock.sleep)
+
+    assert result['timeouts'] == 10
+    assert stage.histogram.count == 10
@@ -0,0 +1,62 @@
+"""Test for the metrics registry."""
+
+import urllib.request
+
+import pytest
+
+from simpss_common.metrics import Registry, start_http_server
+
+
+def test_same_metric_is_returned():
+    """Asking twice for a metric with the same labels returns it again."""
+    registry = Registry()
+    a = registry.counter('requests_total', 'Requests', stage='producer')
+    b = registry.counter('requests_total', 'Requests', stage='producer')
+    c = registry.counter('requests_total', 'Requests', stage='consumer')
+
+    assert a is b
+    assert a is not c
+
+
+def test_type_clash():
+    """A name cannot be registered with two metric types."""
+    registry = Registry()
+    registry.counter('things')
+    with pytest.raises(ValueError):
+        registry.gauge('things')
+
+
+def test_render():
+    """Counters, gauges and histograms are rendered in text format."""
+    registry = Registry()
+    registry.counter('msgs_total', 'Messages', topic='g1').inc(3)
+    registry.gauge('depth', 'Queue depth').set_function(lambda: 7)
+    hist = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    hist.observe_many([0.05, 0.5, 2.0])
+
+    lines = registry.render().splitlines()
+
+    assert '# TYPE msgs_total counter' in lines
+    assert 'msgs_total{topic="g1"} 3' in lines
+    assert 'depth 7' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'latency_seconds_count 3' in lines
+    assert 'latency_seconds_sum 2.55' in lines
+
+
+def test_http_server():
+    """The server returns the rendered registry."""
+    registry = Registry()
+    registry.counter('served_total').inc()
+    server = start_http_server(0, registry=registry)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(
+                'http://localhost:{}/metrics'.format(port)) as response:
+            body = response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+
+    assert 'served_total 1' in body
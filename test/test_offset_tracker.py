@@ -0,0 +1,235 @@
+"""Test for the offset tracker."""
+
+import json
+
+import pytest
+
+from simpss_persistence.kafka_consumer import KafkaConsumer, OffsetTracker
+from simpss_persistence.pub_sub import Subscriber
+
+
+class FakeMessage(object):
+    """Minimal stand-in for a confluent_kafka Message."""
+
+    def __init__(self, offset, partition=0, topic='g1'):
+        self._offset = offset
+        self._partition = partition
+        self._topic = topic
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def value(self):
+        return json.dumps({'id': self._offset}).encode('utf-8')
+
+
+def test_commit_after_all_acks():
+    """A batch is committable only when every subscriber acked it."""
+    tracker = OffsetTracker()
+    batch = tracker.add_batch([FakeMessage(0), FakeMessage(1)], 2)
+
+    tracker.ack(batch)
+    assert tracker.pop_committable() == {}
+
+    tracker.ack(batch)
+    assert tracker.pop_committable() == {('g1', 0): 2}
+    assert tracker.pending_batches == 0
+
+
+def test_offsets_advance_in_order():
+    """A later batch acked first does not move the offset past an earlier one."""
+    tracker = OffsetTracker()
+    first = tracker.add_batch([FakeMessage(0), FakeMessage(5, 1)], 1)
+    second = tracker.add_batch([FakeMessage(1), FakeMessage(6, 1)], 1)
+
+    tracker.ack(second)
+    assert tracker.pop_committable() == {}
+
+    tracker.ack(first)
+    assert tracker.pop_committable() == {('g1', 0): 2, ('g1', 1): 7}
+
+
+def test_failed_batch_blocks_partition():
+    """Offsets never advance over a failed batch."""
+    tracker = OffsetTracker()
+    failed = tracker.add_batch([FakeMessage(0)], 1)
+    later = tracker.add_batch([FakeMessage(1)], 1)
+
+    tracker.fail(failed)
+    tracker.ack(later)
+    assert tracker.pop_committable() == {}
+    assert tracker.failed_batches == 1
+
+
+def test_failed_batch_is_rewound():
+    """The failed batch and the later ones of its partition are dropped."""
+    tracker = OffsetTracker()
+    acked = tracker.add_batch([FakeMessage(0)], 1)
+    failed = tracker.add_batch([FakeMessage(1), FakeMessage(2),
+                                FakeMessage(7, 1)], 1)
+    later = tracker.add_batch([FakeMessage(3), FakeMessage(8, 1)], 1)
+
+    tracker.ack(acked)
+    tracker.fail(failed)
+    tracker.ack(later)
+    assert tracker.pop_failed() == {('g1', 0): 1, ('g1', 1): 7}
+    assert tracker.pop_committable() == {('g1', 0): 1}
+    assert tracker.pending_batches == 0
+    assert tracker.pop_failed() == {}
+
+    # the partition advances again once the batch is consumed again
+    again = tracker.add_batch([FakeMessage(1), FakeMessage(2)], 1)
+    tracker.ack(again)
+    assert tracker.pop_committable() == {('g1', 0): 3}
+
+
+def test_forget_revoked_partitions():
+    """Revoked partitions are dropped and late acks are ignored."""
+    tracker = OffsetTracker()
+    batch = tracker.add_batch([FakeMessage(0), FakeMessage(3, 1)], 1)
+
+    tracker.forget([('g1', 1)])
+    tracker.ack(batch)
+    assert tracker.pop_committable() == {('g1', 0): 1}
+
+    tracker.ack(batch)
+    assert tracker.pop_committable() == {}
+
+
+def test_acked_messages_count():
+    """The count of acknowledged messages resets at every pop."""
+    tracker = OffsetTracker()
+    batch = tracker.add_batch([FakeMessage(0), FakeMessage(1)], 1)
+    tracker.add_batch([FakeMessage(2)], 0)
+    assert tracker.acked_messages == 1
+
+    tracker.ack(batch)
+    assert tracker.acked_messages == 3
+
+    tracker.pop_committable()
+    assert tracker.acked_messages == 0
+
+
+class FakeKafka(object):
+    """The parts of confluent_kafka.Consumer used for committing."""
+
+    def __init__(self):
+        self.seeks = []
+        self.commits = []
+
+    def seek(self, partition):
+        self.seeks.append((partition.topic, partition.partition,
+                           partition.offset))
+
+    def commit(self, offsets, asynchronous=True):
+        self.commits.append([(p.topic, p.partition, p.offset)
+                             for p in offsets])
+
+
+class FlakySubscriber(Subscriber):
+    """Fails the batches while failing is set."""
+
+    def __init__(self):
+        self.failing = True
+
+    def set_subscriber_name(self, name):
+        pass
+
+    def subscribe(self, publisher):
+        pass
+
+    def receive(self, message):
+        pass
+
+    def receive_batch(self, messages, on_done=None):
+        on_done(RuntimeError('write failed') if self.failing else None)
+
+
+def test_consumer_recovers_after_failed_batch():
+    """A failed batch is consumed again and its partition commits again."""
+    consumer = KafkaConsumer('localhost:9092', 'test', manual_commit=True)
+    consumer.kafka = FakeKafka()
+    subscriber = FlakySubscriber()
+    consumer.add_subscriber(subscriber, 'flaky')
+    rewind = consumer._KafkaConsumer__rewind_failed
+
+    consumer.publish_batch([FakeMessage(0), FakeMessage(1)])
+    subscriber.failing = False
+    consumer.publish_batch([FakeMessage(2)])
+    rewind()
+    consumer.commit()
+    assert consumer.kafka.seeks == [('g1', 0, 0)]
+    assert consumer.kafka.commits == []
+
+    consumer.publish_batch([FakeMessage(0), FakeMessage(1), FakeMessage(2)])
+    rewind()
+    consumer.commit()
+    assert consumer.kafka.seeks == [('g1', 0, 0)]
+    assert consumer.kafka.commits == [[('g1', 0, 3)]]
+
+
+class RecordingSubscriber(FlakySubscriber):
+    """Records the batches it receives and acknowledges them."""
+
+    def __init__(self):
+        self.failing = False
+        self.received = []
+
+    def receive_batch(self, messages, on_done=None):
+        self.received += messages
+        on_done()
+
+
+class UnmappableMessage(FakeMessage):
+    def value(self):
+        return json.dumps({'T': 20}).encode('utf-8')
+
+
+def test_messages_without_required_fields_are_dead_letters():
+    """They are not handed to the subscribers, and their offsets commit."""
+    consumer = KafkaConsumer('localhost:9092',
+                             'test',
+                             manual_commit=True,
+                             required_fields=['id'])
+    consumer.kafka = FakeKafka()
+    subscriber = RecordingSubscriber()
+    consumer.add_subscriber(subscriber, 'recording')
+
+    consumer.publish_batch([FakeMessage(0), UnmappableMessage(1)])
+    consumer.commit()
+
+    assert subscriber.received == [{'id': 0}]
+    assert consumer.dead_letters.dead_letters == 1
+    assert consumer.kafka.commits == [[('g1', 0, 2)]]
+
+
+class BrokenKafka(FakeKafka):
+    """Kafka consumer failing on consume."""
+
+    def __init__(self):
+        super().__init__()
+        self.closed = False
+
+    def consume(self, num_messages, timeout):
+        raise RuntimeError('broken consumer')
+
+    def close(self):
+        self.closed = True
+
+
+def test_consumer_shuts_down_on_errors():
+    """An error stops the consumer, closes it and is raised again."""
+    consumer = KafkaConsumer('localhost:9092', 'test', manual_commit=True)
+    consumer.kafka = BrokenKafka()
+    consumer.add_subscriber(RecordingSubscriber(), 'recording')
+
+    with pytest.raises(RuntimeError):
+        consumer.start_consuming()
+    assert consumer.kafka.closed
+    assert not consumer.running
@@ -0,0 +1,272 @@
+"""Test for the MQTT Kafka producer, without brokers."""
+
+import datetime
+import json
+import threading
+import time
+
+import pytest
+
+from simpss.producers import MqttKafkaProducer
+
+MQTT_CONFIG = {
+    'client-id': 'test',
+    'address': 'localhost',
+    'port': 1883,
+    'transport': 'tcp',
+    'topic': 'simpss',
+    'qos': 0,
+    'max-inflight': 100,
+    'payload-key': 'id',
+}
+
+USERDATA = {'payload-key': 'id'}
+
+KAFKA_CONFIG = {
+    'bootstrap.servers': 'localhost:9092',
+    'group.id': 'test',
+    'client.id': 'test',
+}
+
+
+class FakeKafkaProducer(object):
+    """
+    Kafka producer with a local queue of room messages,
+    emptied by poll as if they were delivered.
+    """
+
+    def __init__(self, room):
+        self.room = room
+        self.queued = []
+        self.produced = []
+        self.polls = 0
+
+    def produce(self, topic, message, callback=None, **kwargs):
+        if len(self.queued) >= self.room:
+            raise BufferError()
+        self.queued.append(callback)
+        self.produced.append((topic, message, kwargs))
+
+    def poll(self, timeout):
+        self.polls += 1
+        delivered, self.queued = self.queued, []
+        for callback in delivered:
+            callback(None, FakeDelivery())
+        return len(delivered)
+
+    def flush(self, timeout=None):
+        return 0
+
+
+class FakeDelivery(object):
+    def topic(self):
+        return 'g1'
+
+    def partition(self):
+        return 0
+
+
+class FakeMqttClient(object):
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def unsubscribe(self, topic):
+        pass
+
+
+class FakeMessage(object):
+    def __init__(self, payload):
+        self.payload = payload
+
+
+def reading(sensor_id=120, **fields):
+    fields['id'] = sensor_id
+    return FakeMessage(json.dumps(fields).encode('utf-8'))
+
+
+def make_producer(room=100, **kwargs):
+    kwargs.setdefault('codec', 'stdlib')
+    producer = MqttKafkaProducer(MQTT_CONFIG, KAFKA_CONFIG, {
+        120: 'g1',
+        121: 'g2'
+    }, **kwargs)
+    producer._kf_producer = FakeKafkaProducer(room)
+    producer._mq_client = FakeMqttClient()
+    return producer
+
+
+def test_readings_go_to_their_group_keyed_by_sensor():
+    producer = make_producer(timestamp_format='epoch_ms')
+    for sensor_id in (120, 121, 120):
+        producer._on_mqtt_message(None, USERDATA, reading(sensor_id))
+    assert producer.drain_batch() == 3
+
+    produced = producer._kf_producer.produced
+    assert [(topic, kwargs['key']) for topic, _, kwargs in produced] == [
+        ('g1', b'120'), ('g2', b'121'), ('g1', b'120')
+    ]
+    # the key of a sensor is built once
+    assert produced[0][2]['key'] is produced[2][2]['key']
+    message = json.loads(produced[0][1])
+    assert message['sensor_group'] == 'g1'
+    assert isinstance(message['time_received'], int)
+
+
+@pytest.mark.parametrize('timestamp_format', ['iso', 'epoch_ms'])
+def test_time_received(timestamp_format):
+    """Readings are stamped in the configured format."""
+    producer = make_producer(timestamp_format=timestamp_format)
+    before = time.time()
+    producer._on_mqtt_message(None, USERDATA, reading())
+    after = time.time()
+    producer.drain_batch()
+
+    stamp = json.loads(producer._kf_producer.produced[0][1])['time_received']
+    if timestamp_format == 'epoch_ms':
+        assert int(before * 1000) <= stamp <= int(after * 1000) + 1
+    else:
+        # naive UTC
+        stamp = datetime.datetime.fromisoformat(stamp).replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+        assert before - 0.001 <= stamp <= after + 0.001
+
+
+def test_partitioner_and_unkeyed_messages():
+    producer = make_producer(partitioner=lambda key, message: int(key) % 4)
+    producer._on_mqtt_message(None, USERDATA, reading(121))
+    producer.drain_batch()
+    _, _, kwargs = producer._kf_producer.produced[0]
+    assert (kwargs['key'], kwargs['partition']) == (b'121', 1)
+
+    producer = make_producer(keyed=False)
+    producer._on_mqtt_message(None, USERDATA, reading(121))
+    producer.drain_batch()
+    _, _, kwargs = producer._kf_producer.produced[0]
+    assert kwargs['key'] is None and 'partition' not in kwargs
+
+
+def test_invalid_payloads_go_to_the_dead_letters():
+    producer = make_producer(dead_letter_topic='dlq', dead_letter_batch_size=2)
+    producer._on_mqtt_message(None, USERDATA, FakeMessage(b'{bad'))
+    producer._on_mqtt_message(None, USERDATA, reading(999))
+
+    produced = producer._kf_producer.produced
+    assert [(topic, message) for topic, message, _ in produced] == [
+        ('dlq', b'{bad'), ('dlq', reading(999).payload)
+    ]
+    assert producer.queue.qsize() == 0
+
+
+def test_drain_batch_groups_messages():
+    producer = make_producer(drain_batch_size=4, drain_interval=0.01)
+    for uptime in range(10):
+        producer._on_mqtt_message(None, USERDATA, reading(uptime=uptime))
+
+    assert [producer.drain_batch() for _ in range(4)] == [4, 4, 2, 0]
+    assert producer.metrics()['last_drain_batch'] == 2
+    uptimes = [
+        json.loads(message)['uptime']
+        for _, message, _ in producer._kf_producer.produced
+    ]
+    assert uptimes == list(range(10))
+
+
+def test_full_kafka_queue_waits_for_deliveries():
+    """Without a poller thread produce serves the delivery reports itself."""
+    producer = make_producer(room=1)
+    for _ in range(3):
+        producer.produce('g1', b'x')
+
+    assert len(producer._kf_producer.produced) == 3
+    assert producer.buffer_full_waits == 2
+    assert producer.messages_sent_to_kafka == 2
+
+
+def test_full_kafka_queue_waits_for_the_poller():
+    producer = make_producer(room=1, kafka_timeout=0.01)
+    producer._MqttKafkaProducer__start_poller()
+    try:
+        for _ in range(20):
+            producer.produce('g1', b'x')
+    finally:
+        producer._MqttKafkaProducer__stop_poller()
+
+    assert len(producer._kf_producer.produced) == 20
+
+
+def test_dead_letters_do_not_block_the_poller():
+    """Dead letters waiting for room are sent once the poller serves it."""
+    producer = make_producer(room=1,
+                             kafka_timeout=0.01,
+                             dead_letter_topic='dlq',
+                             dead_letter_batch_size=100)
+    producer._dead_letters.interval = 0.0
+    producer._on_mqtt_message(None, USERDATA, FakeMessage(b'{bad'))
+    producer._on_mqtt_message(None, USERDATA, FakeMessage(b'[]'))
+    producer._MqttKafkaProducer__start_poller()
+    try:
+        flusher = threading.Thread(target=producer._dead_letters.maybe_flush)
+        flusher.start()
+        flusher.join(timeout=5.0)
+        assert not flusher.is_alive()
+
+        polls = producer._kf_producer.polls
+        time.sleep(0.1)
+        assert producer._kf_producer.polls > polls
+    finally:
+        producer._MqttKafkaProducer__stop_poller()
+
+    assert [topic for topic, _, _ in producer._kf_producer.produced
+            ] == ['dlq', 'dlq']
+
+
+def test_produce_from_the_poller_polls_inline():
+    """A send from the poller thread cannot wait for the poller."""
+    producer = make_producer(room=1, kafka_timeout=0.01)
+
+    def produce_as_poller():
+        producer._MqttKafkaProducer__poller = threading.current_thread()
+        for _ in range(3):
+            producer.produce('dlq', b'x')
+
+    poller = threading.Thread(target=produce_as_poller, daemon=True)
+    poller.start()
+    poller.join(timeout=5.0)
+    assert not poller.is_alive()
+    assert len(producer._kf_producer.produced) == 3
+
+
+def test_dead_drain_thread_stops_the_producer():
+    """If the drain thread dies the producer exits with status 1."""
+    producer = make_producer(threaded=True)
+
+    def broken_get(*args, **kwargs):
+        raise RuntimeError('broken queue')
+
+    producer.queue.get = broken_get
+    with pytest.raises(SystemExit) as exit_info:
+        producer._MqttKafkaProducer__run_threaded()
+    assert exit_info.value.code == 1
+
+
+def test_spool_replays_after_restart(tmp_path):
+    """Readings not produced yet are produced by the next producer."""
+    producer = make_producer(spool_dir=str(tmp_path))
+    for uptime in range(5):
+        producer._on_mqtt_message(None, USERDATA, reading(uptime=uptime))
+    producer._drain_batch_size = 2
+    assert producer.drain_batch() == 2
+    producer.queue.close()
+
+    producer = make_producer(spool_dir=str(tmp_path))
+    assert producer.queue.qsize() == 3
+    assert producer.drain_batch() == 3
+    uptimes = [
+        json.loads(message)['uptime']
+        for _, message, _ in producer._kf_producer.produced
+    ]
+    assert uptimes == [2, 3, 4]
+    producer.queue.close()
@@ -0,0 +1,131 @@
+"""Test for the queued subscriber."""
+
+import threading
+
+from simpss_persistence.pub_sub import (QueuedSubscriber, QueueOverflowError,
+                                        Subscriber)
+
+
+class SlowSubscriber(Subscriber):
+    """Subscriber that waits for a gate before handling each batch."""
+
+    def __init__(self):
+        self.received = []
+        self.gate = threading.Event()
+
+    def set_subscriber_name(self, name):
+        pass
+
+    def subscribe(self, publisher):
+        pass
+
+    def receive(self, message):
+        self.gate.wait()
+        self.received.append(message)
+
+
+def test_block_delivers_everything_in_order():
+    """With the block policy every message is delivered, in order."""
+    inner = SlowSubscriber()
+    inner.gate.set()
+    queued = QueuedSubscriber(inner, 'sub', max_size=2)
+
+    for i in range(10):
+        queued.receive_batch([{'n': i}])
+    assert queued.flush(timeout=5.0)
+    queued.stop()
+
+    assert inner.received == [{'n': i} for i in range(10)]
+    assert queued.metrics()['processed'] == 10
+
+
+def test_drop_oldest_reports_dropped_batches():
+    """Dropped batches are counted and their on_done gets an error."""
+    inner = SlowSubscriber()
+    queued = QueuedSubscriber(inner, 'sub', max_size=2, overflow='drop-oldest')
+    errors = []
+
+    def on_done(error=None):
+        if error is not None:
+            errors.append(error)
+
+    for i in range(6):
+        queued.receive_batch([{'n': i}], on_done=on_done)
+    inner.gate.set()
+    assert queued.flush(timeout=5.0)
+    queued.stop()
+
+    assert queued.dropped >= 1
+    assert len(inner.received) + queued.dropped == 6
+    assert len(errors) == queued.dropped
+    assert all(isinstance(e, QueueOverflowError) for e in errors)
+    assert inner.received[-1] == {'n': 5}
+
+
+def test_spill_delivers_everything_in_order(tmp_path):
+    """With the spill policy overflowing batches go to disk and come back in order."""
+    inner = SlowSubscriber()
+    queued = QueuedSubscriber(inner,
+                              'sub',
+                              max_size=2,
+                              overflow='spill',
+                              spill_dir=str(tmp_path))
+
+    for i in range(10):
+        queued.receive_batch([{'n': i}])
+    assert queued.spilled > 0
+    inner.gate.set()
+    assert queued.flush(timeout=5.0)
+    queued.stop()
+
+    assert inner.received == [{'n': i} for i in range(10)]
+    assert queued.depth == 0
+
+
+def test_outstanding_counts_undelivered_messages():
+    """Queued and in progress messages are outstanding until handled."""
+    inner = SlowSubscriber()
+    queued = QueuedSubscriber(inner, 'sub', max_size=10)
+
+    for i in range(3):
+        queued.receive_batch([{'n': i}, {'n': i}])
+    assert queued.outstanding() == 6
+
+    inner.gate.set()
+    assert queued.flush(timeout=5.0)
+    queued.stop()
+    assert queued.outstanding() == 0
+
+
+def test_spill_drains_without_waiting(tmp_path):
+    """Spilled batches are delivered as fast as the subscriber takes them."""
+    inner = SlowSubscriber()
+    queued = QueuedSubscriber(inner,
+                              'sub',
+                              max_size=2,
+                              overflow='spill',
+                              spill_dir=str(tmp_path))
+
+    for i in range(50):
+        queued.receive_batch([{'n': i}])
+    assert queued.spilled >= 40
+    inner.gate.set()
+    assert queued.flush(timeout=1.0)
+    queued.stop()
+
+
+def test_stop_delivers_spilled_batches(tmp_path):
+    """stop without flush still delivers the spilled batches."""
+    inner = SlowSubscriber()
+    queued = QueuedSubscriber(inner,
+                              'sub',
+                              max_size=2,
+                              overflow='spill',
+                              spill_dir=str(tmp_path))
+
+    for i in range(10):
+        queued.receive_batch([{'n': i}])
+    inner.gate.set()
+    queued.stop()
+
+    assert inner.received == [{'n': i} for i in range(10)]
@@ -0,0 +1,121 @@
+"""Test for the sensor_data table layouts."""
+
+import collections
+import datetime
+
+import cassandra
+import pytest
+
+import migrate_sensor_data
+from migrate_sensor_data import MAX_TOKEN, MIN_TOKEN, token_ranges
+from simpss_persistence.storage import (compaction_window, sensor_data_table,
+                                        time_buckets)
+
+HOUR_MS = 3600 * 1000
+
+
+@pytest.mark.parametrize('bucket_seconds, window', [
+    (86400, ('DAYS', 1)),
+    (7 * 86400, ('DAYS', 7)),
+    (21600, ('HOURS', 6)),
+    (900, ('MINUTES', 15)),
+])
+def test_compaction_window(bucket_seconds, window):
+    assert compaction_window(bucket_seconds) == window
+
+
+@pytest.mark.parametrize('bucket_seconds', [0, 30, 90])
+def test_invalid_compaction_window(bucket_seconds):
+    with pytest.raises(ValueError):
+        compaction_window(bucket_seconds)
+
+
+def test_time_buckets():
+    """Epoch milliseconds and datetimes give the start of their bucket."""
+    ms = 1546300800000 + 90 * 60 * 1000  # 2019-01-01 01:30 UTC
+    naive = datetime.datetime(2019, 1, 1, 1, 30, 15, 250000)
+    aware = datetime.datetime(2019, 1, 1, 3, 30, tzinfo=datetime.timezone(
+        datetime.timedelta(hours=2)))
+
+    assert time_buckets([ms, naive, aware, None], HOUR_MS) == [
+        1546300800000 + HOUR_MS,
+        1546300800000 + HOUR_MS,
+        1546300800000 + HOUR_MS,
+        None,
+    ]
+
+
+def test_bucketed_table():
+    query = sensor_data_table('simpss', 'data', 21600, ttl=86400)
+
+    assert "PRIMARY KEY ((sensor_id, time_bucket), time_received)" in query
+    assert "'TimeWindowCompactionStrategy'" in query
+    assert "'compaction_window_unit': 'HOURS'" in query
+    assert "'compaction_window_size': 6" in query
+    assert "default_time_to_live = 86400" in query
+
+
+def test_original_table():
+    query = sensor_data_table('simpss', 'sensor_data')
+
+    assert "PRIMARY KEY (sensor_group, sensor_id, time_received)" in query
+    assert "time_bucket" not in query
+    with pytest.raises(ValueError):
+        sensor_data_table('simpss', 'sensor_data', ttl=3600)
+
+
+def test_token_ranges_cover_the_ring():
+    ranges = token_ranges(7)
+
+    assert len(ranges) == 7
+    assert ranges[0][0] == MIN_TOKEN
+    assert ranges[-1][1] == MAX_TOKEN
+    assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+    with pytest.raises(ValueError):
+        token_ranges(0)
+
+
+Row = collections.namedtuple('Row', ['sensor_id', 'time_received'])
+
+
+class FailingSession(object):
+    """Session whose reads time out after n_rows rows."""
+
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+
+    def execute(self, query, values):
+        for i in range(self.n_rows):
+            yield Row(i, 1546300800000)
+        raise cassandra.ReadTimeout('timed out')
+
+
+class RecordingStorage(object):
+    def __init__(self):
+        self.inserted = []
+        self.flushed = False
+
+    def insert_rows(self, rows, on_done=None):
+        self.inserted += rows
+
+    def flush(self):
+        self.flushed = True
+
+
+def test_failed_read_fails_the_range(monkeypatch):
+    """A read timeout is returned as an error of its range."""
+    storage = RecordingStorage()
+    monkeypatch.setattr(
+        migrate_sensor_data, '_worker', {
+            'session': FailingSession(3),
+            'storage': storage,
+            'ttl': None,
+            'select': None,
+        })
+
+    index, copied, skipped, errors = migrate_sensor_data.copy_range(
+        (4, (MIN_TOKEN, MAX_TOKEN)))
+
+    assert (index, copied, skipped) == (4, 3, 0)
+    assert len(errors) == 1 and 'timed out' in errors[0]
+    assert len(storage.inserted) == 3 and storage.flushed
@@ -0,0 +1,64 @@
+"""Test for the sensor registry."""
+
+import os
+
+import pytest
+
+from simpss_common.sensors import SensorRegistry, read_sensor_groups
+
+
+def write(path, text):
+    path.write_text(text)
+    # make sure the change is seen even on coarse mtime filesystems
+    st = os.stat(str(path))
+    os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def test_read(tmp_path):
+    path = tmp_path / 'sensors.csv'
+    write(path, 'sensor_id,group_id\n120, g1\n121,g2 \n\n')
+
+    assert read_sensor_groups(str(path)) == {120: 'g1', 121: 'g2'}
+
+
+def test_columns_by_name(tmp_path):
+    path = tmp_path / 'sensors.csv'
+    write(path, 'group_id,sensor_id\ng1,120\n')
+
+    assert read_sensor_groups(str(path)) == {120: 'g1'}
+
+
+@pytest.mark.parametrize('text', [
+    'sensor_id,group_id\n120,g1\n120,g2\n',
+    'sensor_id,group_id\n120,\n',
+    'sensor_id,group_id\n120\n',
+    'sensor,group\n120,g1\n',
+    '',
+])
+def test_invalid_files(tmp_path, text):
+    path = tmp_path / 'sensors.csv'
+    write(path, text)
+
+    with pytest.raises(ValueError):
+        read_sensor_groups(str(path))
+
+
+def test_reload(tmp_path):
+    """A changed file replaces the mapping, an invalid one is ignored."""
+    path = tmp_path / 'sensors.csv'
+    write(path, 'sensor_id,group_id\n120,g1\n')
+    registry = SensorRegistry(str(path), reload_interval=0)
+
+    assert registry[120] == 'g1'
+    assert not registry.reload()
+
+    write(path, 'sensor_id,group_id\n120,g1\n121,g2\n')
+    assert registry.reload()
+    assert registry[121] == 'g2'
+    assert registry.groups() == {'g1', 'g2'}
+
+    write(path, 'sensor_id,group_id\n120,g1\n120,g2\n')
+    assert not registry.reload()
+    assert len(registry) == 2
+    with pytest.raises(KeyError):
+        registry[122]
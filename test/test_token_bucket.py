@@ -0,0 +1,77 @@
+"""Test for the token bucket of the sensor fleet."""
+
+import asyncio
+import time
+
+import pytest
+
+from mocks.fleet import TokenBucket, iter_readings
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_waiters_are_spaced_by_the_rate():
+    """Callers taking tokens from an empty bucket wait their turn."""
+    clock = FakeClock()
+    bucket = TokenBucket(100, clock=clock)
+
+    waits = [bucket.reserve() for _ in range(5)]
+
+    assert waits == pytest.approx([0.01, 0.02, 0.03, 0.04, 0.05])
+
+
+def test_refill_is_capped():
+    """After a pause, at most capacity tokens are available at once."""
+    clock = FakeClock()
+    bucket = TokenBucket(100, capacity=3, clock=clock)
+    clock.now = 10.0
+
+    waits = [bucket.reserve() for _ in range(4)]
+
+    assert waits[:3] == [0.0, 0.0, 0.0]
+    assert waits[3] == pytest.approx(0.01)
+
+
+def test_invalid_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+
+def test_aggregate_rate():
+    """Many coroutines sharing a bucket do not go over its rate."""
+    bucket = TokenBucket(2000)
+    done = []
+
+    async def worker():
+        for _ in range(10):
+            await bucket.acquire()
+            done.append(time.monotonic())
+
+    async def run():
+        await asyncio.gather(*[worker() for _ in range(50)])
+
+    start = time.monotonic()
+    asyncio.run(run())
+    elapsed = time.monotonic() - start
+
+    assert len(done) == 500
+    # only a lower bound, a loaded machine can always be slower
+    assert elapsed >= 0.24
+
+
+def test_iter_readings_loops(tmp_path):
+    """The data file is read line by line and replayed at its end."""
+    path = tmp_path / 'log.txt'
+    path.write_text('{"id": 1, "T": 20}\nnot json\n\n{"id": 2, "T": 21}\n')
+
+    readings = iter_readings(str(path), loop=True)
+    ids = [next(readings)['id'] for _ in range(5)]
+
+    assert ids == [1, 2, 1, 2, 1]
+    assert [r['id'] for r in iter_readings(str(path), loop=False)] == [1, 2]
@@ -0,0 +1,42 @@
+"""Test for the trace stamps."""
+
+import pytest
+
+from simpss_common.tracing import (TRACE_HEADER, Sampler, decode_header,
+                                   encode_header, find_header, hop_histogram)
+
+
+def test_header_round_trip():
+    """The stamps are decoded as they were encoded."""
+    value = encode_header(1551434400.123456, 1551434400.5)
+
+    assert decode_header(value) == (1551434400.123456, 1551434400.5)
+
+
+def test_malformed_header():
+    """A header of the wrong size is ignored."""
+    assert decode_header(b'abc') is None
+    assert decode_header(None) is None
+
+
+def test_find_header():
+    """The trace header is found among the other headers."""
+    value = encode_header(1.0, 2.0)
+    headers = [('other', b'x'), (TRACE_HEADER, value)]
+
+    assert find_header(headers) == value
+    assert find_header([('other', b'x')]) is None
+    assert find_header(None) is None
+
+
+def test_sampler():
+    """Rate 0 never samples, rate 1 always does."""
+    assert not any(Sampler(0.0).sample() for _ in range(100))
+    assert all(Sampler(1.0).sample() for _ in range(100))
+    with pytest.raises(ValueError):
+        Sampler(1.5)
+
+
+def test_unknown_hop():
+    with pytest.raises(ValueError):
+        hop_histogram('mqtt_to_cassandra')
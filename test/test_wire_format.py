@@ -0,0 +1,76 @@
+"""Test for the binary wire format."""
+
+import pytest
+
+from simpss_common.codec import WireFormat
+from simpss_common.codec.wire_format import (MAGIC, SCHEMA_SENSOR_V2,
+                                             decode_binary)
+
+READING = {
+    'id': 120,
+    'uptime': 2**40,
+    'T': 2315,
+    'P': 101325,
+    'H': 4521,
+    'Ix': -235,
+    'Iy': 118,
+    'Iz': 983,
+    'M': 56,
+    'time_received': '2019-03-01T10:00:00.123456',
+    'sensor_group': 'g1',
+}
+
+
+def test_binary_round_trip():
+    """A reading is encoded in binary, smaller than JSON, and decoded back."""
+    binary = WireFormat('stdlib', binary=True)
+    encoded = binary.dumps(READING)
+
+    assert encoded[0] == MAGIC
+    assert len(encoded) < len(WireFormat('stdlib').dumps(READING))
+    assert binary.loads(encoded) == READING
+
+
+def test_epoch_ms_round_trip():
+    """Epoch milliseconds use schema 2, smaller than the ISO schema."""
+    binary = WireFormat('stdlib', binary=True)
+    reading = dict(READING, time_received=1551434400123)
+    encoded = binary.dumps(reading)
+
+    assert encoded[:2] == bytes([MAGIC, SCHEMA_SENSOR_V2])
+    assert len(encoded) < len(binary.dumps(READING))
+    assert binary.loads(encoded) == reading
+
+
+def test_json_is_still_accepted():
+    """A reader accepts both JSON and binary messages."""
+    reader = WireFormat('stdlib')
+    assert reader.loads(WireFormat('stdlib').dumps(READING)) == READING
+    assert reader.loads(WireFormat('stdlib',
+                                   binary=True).dumps(READING)) == READING
+
+
+@pytest.mark.parametrize('change', [
+    {'extra': 1},
+    {'T': 'not an int'},
+    {'P': 2**40},
+])
+def test_fallback_to_json(change):
+    """Messages that do not fit the schema are written as JSON."""
+    message = dict(READING, **change)
+    binary = WireFormat('stdlib', binary=True)
+    encoded = binary.dumps(message)
+
+    assert encoded[0] != MAGIC
+    assert binary.loads(encoded) == message
+
+
+def test_invalid_binary_raises():
+    """Truncated messages and unknown schemas are rejected."""
+    encoded = WireFormat('stdlib', binary=True).dumps(READING)
+
+    with pytest.raises(ValueError):
+        decode_binary(encoded[:-1])
+
+    with pytest.raises(ValueError):
+        decode_binary(bytes([MAGIC, 99]) + encoded[2:])
@@ -0,0 +1,77 @@
+"""Test for the supervised worker pool."""
+
+import multiprocessing as mp
+import sys
+import time
+
+from simpss_persistence.worker_pool import CountingSubscriber, WorkerPool
+
+
+def count(worker_id, counter, n, exit_code=0):
+    """Count n messages and exit."""
+    with counter.get_lock():
+        counter.value += n + worker_id
+    sys.exit(exit_code)
+
+
+def sleep(worker_id, counter):
+    time.sleep(60)
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_workers_count_and_stop():
+    pool = WorkerPool(count, 2, args=(5, ))
+    for worker_id in range(2):
+        pool._WorkerPool__start(worker_id)
+    pool.stop(timeout=10.0)
+
+    assert pool.alive() == 0
+    assert pool.total() == 11
+    assert [c.value for c in pool.counters] == [5, 6]
+
+
+def test_dead_workers_are_restarted():
+    """Workers that died are started again after restart_delay."""
+    pool = WorkerPool(count, 2, args=(1, 1), restart_delay=0.0)
+    for worker_id in range(2):
+        pool._WorkerPool__start(worker_id)
+    wait_for(lambda: pool.alive() == 0)
+
+    supervise = pool._WorkerPool__supervise
+    supervise()
+    assert pool.restarts == 0
+    supervise()
+    assert pool.restarts == 2
+
+    pool.stop(timeout=10.0)
+    assert pool.total() == 6
+
+
+def test_stuck_workers_are_terminated():
+    pool = WorkerPool(sleep, 1)
+    pool._WorkerPool__start(0)
+    wait_for(lambda: pool.alive() == 1)
+
+    start = time.monotonic()
+    pool.stop(timeout=0.2)
+    assert pool.alive() == 0
+    assert time.monotonic() - start < 10.0
+
+
+def test_counting_subscriber():
+    counter = mp.Value('Q', 0)
+    subscriber = CountingSubscriber(counter)
+    done = []
+
+    subscriber.receive({'id': 1})
+    subscriber.receive_batch([{'id': 2}, {'id': 3}],
+                             on_done=lambda error=None: done.append(error))
+
+    assert counter.value == 3
+    assert done == [None]
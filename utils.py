@@ -3,7 +3,7 @@
 import logging
 from typing import Dict
 
-import pandas as pd
+from simpss_common.sensors import read_sensor_groups
 
 
 def get_logger(name='link-mqtt-kafka') -> logging.Logger:
@@ -22,19 +22,4 @@ def read_sensor_group_mapping(file_path) -> Dict[int, str]:
     """Read the mapping from sensor_id to group_id and return
     a dict.
     """
-    table = pd.read_csv(file_path)
-
-    # check that all strings and ids have values
-    if table.isna().any().any():
-        raise ValueError("sensor file contains missing values")
-
-    # check that there are no repeated sensor_id
-    if table.duplicated(subset=['sensor_id'], keep=False).any():
-        raise ValueError("column 'sensor_id' contains duplicates, not allowed")
-
-    result = {
-        int(row['sensor_id']): str.strip(row['group_id'])
-        for _, row in table.iterrows()
-    }
-
-    return result
+    return read_sensor_groups(file_path)